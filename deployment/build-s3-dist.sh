@@ -30,6 +30,36 @@ fi
 template_dir="$PWD"
 dist_dir="$template_dir/dist"
 source_dir="$template_dir/../source"
+staging_dir="$dist_dir/staging"
+
+# Interpreter of the functions' Lambda runtime (Runtime in the templates).
+# When it is installed, the zips also ship the bytecode it compiles:
+# /var/task is read-only, so Lambda would otherwise compile every module
+# on every cold start. Bytecode of another Python version is never shipped.
+lambda_python="python3.6"
+
+# Packs a function directory and lib into dist/<zip name>, without bytecode
+# caches or other local leftovers. Files get a fixed UTC timestamp, so that
+# the bytecode stays valid once Lambda unzips them (zip keeps 2s, local time).
+package_function() {
+    function_dir="$1"
+    zip_name="$2"
+    rm -rf "$staging_dir"
+    mkdir -p "$staging_dir"
+    cp -R "$source_dir/$function_dir/." "$staging_dir"
+    cp -R "$source_dir/lib/." "$staging_dir"
+    find "$staging_dir" -type d -name '__pycache__' -prune -exec rm -rf {} +
+    find "$staging_dir" -type f \( -name '*.pyc' -o -name '.DS_Store' \) -delete
+    find "$staging_dir" -type f -exec env TZ=UTC touch -t 201801010000 {} +
+    if command -v $lambda_python > /dev/null; then
+        echo "$lambda_python -m compileall -q -d /var/task $staging_dir"
+        $lambda_python -m compileall -q -d /var/task "$staging_dir"
+    else
+        echo "$lambda_python not found: packing without bytecode"
+    fi
+    (cd "$staging_dir" && TZ=UTC zip -q -r9 -X "$dist_dir/$zip_name" .)
+    rm -rf "$staging_dir"
+}
 
 echo "------------------------------------------------------------------------------"
 echo "[Init] Clean old dist folder"
@@ -114,13 +144,11 @@ echo ""
 echo "------------------------------------------------------------------------------"
 echo "[Packing] Threat Feed"
 echo "------------------------------------------------------------------------------"
-cd $source_dir/custom-resource
-zip -q -r9 $dist_dir/custom-resource.zip *
+package_function custom-resource custom-resource.zip
 echo ""
 echo "------------------------------------------------------------------------------"
 echo "[Packing] Embargoed Countries Parser"
 echo "------------------------------------------------------------------------------"
-cd $source_dir/embargoed-countries-parser
-zip -q -r9 $dist_dir/embargoed-countries-parser.zip *
+package_function embargoed-countries-parser embargoed-countries-parser.zip
 echo ""
 cd $template_dir
\ No newline at end of file
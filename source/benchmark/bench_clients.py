@@ -0,0 +1,75 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.   #
+#                                                                            #
+#  Licensed under the Amazon Software License (the "License"). You may not   #
+#  use this file except in compliance with the License. A copy of the        #
+#  License is located at                                                     #
+#                                                                            #
+#      http://aws.amazon.com/asl/                                            #
+#                                                                            #
+#  or in the "license" file accompanying this file. This file is distributed #
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,        #
+#  express or implied. See the License for the specific language governing   #
+#  permissions and limitations under the License.                            #
+##############################################################################
+
+#------------------------------------------------------------------------------
+# Per-invocation client overhead: building fresh boto3 clients in every
+# function (former behaviour) vs the shared factory in source/lib/clients.py.
+# No AWS call is made; only client construction is measured. Needs boto3.
+#
+# cd source/benchmark
+# python bench_clients.py [invocations]     (default: 50)
+#------------------------------------------------------------------------------
+
+import importlib
+import os
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, '..', 'lib'))
+
+# client lookups made by one custom resource DELETE and one parser sync
+CUSTOM_RESOURCE_DELETE = ['waf'] * 4
+PARSER_SYNC = ['s3', 'waf']
+
+def fresh(services):
+    import boto3
+    for service in services:
+        boto3.client(service, region_name='us-east-1')
+
+def shared(services):
+    from clients import get_client
+    for service in services:
+        get_client(service, 'us-east-1')
+
+def measure(invoke, services, invocations):
+    start = time.time()
+    invoke(services)
+    first = time.time() - start
+
+    start = time.time()
+    for _ in range(invocations):
+        invoke(services)
+    return first, (time.time() - start) / invocations
+
+def main(invocations):
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+
+    # loaded up front so that the first call of the first scenario does not
+    # include it
+    start = time.time()
+    importlib.import_module('boto3')
+    print('import boto3: %.1f ms'%((time.time() - start) * 1000))
+    print('%-24s %-8s %16s %20s'%('scenario', 'mode', 'first call (ms)', 'warm invocation (ms)'))
+    for name, services in [('custom resource DELETE', CUSTOM_RESOURCE_DELETE), ('parser sync', PARSER_SYNC)]:
+        for mode, invoke in [('fresh', fresh), ('shared', shared)]:
+            first, warm = measure(invoke, services, invocations)
+            print('%-24s %-8s %16.1f %20.2f'%(name, mode, first * 1000, warm * 1000))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50)
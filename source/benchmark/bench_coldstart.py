@@ -0,0 +1,128 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.   #
+#                                                                            #
+#  Licensed under the Amazon Software License (the "License"). You may not   #
+#  use this file except in compliance with the License. A copy of the        #
+#  License is located at                                                     #
+#                                                                            #
+#      http://aws.amazon.com/asl/                                            #
+#                                                                            #
+#  or in the "license" file accompanying this file. This file is distributed #
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,        #
+#  express or implied. See the License for the specific language governing   #
+#  permissions and limitations under the License.                            #
+##############################################################################
+
+#------------------------------------------------------------------------------
+# Cold start cost of each Lambda function: import time of its handler module
+# (python -X importtime, median over fresh interpreters), alone and with the
+# boto3 session the first AWS call loads, the number of modules imported and
+# the size of its deployment zip as build-s3-dist.sh packs it. Lists the
+# slowest imports of the handler module.
+#
+# Each function is staged like its zip, without bytecode caches, and run
+# without writing any: like Lambda, whose read-only /var/task gets none, it
+# compiles its own modules on every cold start.
+#
+# cd source/benchmark
+# python bench_coldstart.py [runs]     (default: 9)
+#------------------------------------------------------------------------------
+
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import zipfile
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR = os.path.join(BENCHMARK_DIR, '..')
+LIB_DIR = os.path.join(SOURCE_DIR, 'lib')
+HANDLERS = [('parser', os.path.join(SOURCE_DIR, 'embargoed-countries-parser')), ('custom-resource', os.path.join(SOURCE_DIR, 'custom-resource'))]
+# what the first invocation imports on top of the handler module
+SCENARIOS = [('handler', 'import lambda_function'), ('handler + boto3', 'import lambda_function, boto3.session')]
+TOP_IMPORTS = 5
+
+def stage(directory, package_dir):
+    # copies what build-s3-dist.sh zips (function directory, then lib) into
+    # package_dir; returns the size of the zip in bytes
+    for base in [directory, LIB_DIR]:
+        shutil.copytree(base, package_dir, ignore=shutil.ignore_patterns('__pycache__', '*.pyc', '.DS_Store'), dirs_exist_ok=True)
+
+    package_path = package_dir + '.zip'
+    with zipfile.ZipFile(package_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=9) as package:
+        for root, dirs, files in os.walk(package_dir):
+            for name in files:
+                package.write(os.path.join(root, name), os.path.relpath(os.path.join(root, name), package_dir))
+    return os.path.getsize(package_path)
+
+def import_times(package_dir, code):
+    # {module: (cumulative us, depth, parent)} of one fresh interpreter, or
+    # None when the import fails (e.g. boto3 not installed). -X importtime
+    # lists the imports of a module before the module itself.
+    env = dict(os.environ, PYTHONPATH=package_dir, PYTHONDONTWRITEBYTECODE='1')
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=package_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        return None
+
+    modules = {}
+    children = {}
+    for line in process.stderr.decode('utf-8').splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        name = name.strip()
+        modules[name] = [int(cumulative_us), depth, None]
+        for child in children.pop(depth + 1, []):
+            modules[child][2] = name
+        children.setdefault(depth, []).append(name)
+    return modules
+
+def measure(directory, code, runs):
+    # modules loaded by the interpreter startup are not the handler's cost
+    startup = set(import_times(directory, 'pass'))
+    samples = []
+    for _ in range(runs):
+        modules = import_times(directory, code)
+        if modules is None:
+            return None
+        samples.append(modules)
+
+    totals = [sum(c for name, (c, depth, parent) in m.items() if depth == 0 and name not in startup) for m in samples]
+    return {'median_ms': statistics.median(totals) / 1000.0, 'min_ms': min(totals) / 1000.0, 'modules': len(set(samples[0]) - startup), 'samples': samples}
+
+def slowest_imports(samples):
+    # direct imports of lambda_function by median cumulative time
+    names = [name for name, (c, depth, parent) in samples[0].items() if parent == 'lambda_function']
+    return sorted(((statistics.median(m[name][0] for m in samples if name in m) / 1000.0, name) for name in names), reverse=True)[:TOP_IMPORTS]
+
+def main(runs):
+    print('%-16s %-16s %12s %10s %8s %14s'%('handler', 'scenario', 'median (ms)', 'min (ms)', 'modules', 'package (KB)'))
+    slowest = []
+    staging_dir = tempfile.mkdtemp(prefix='bench-coldstart-')
+    try:
+        for handler, directory in HANDLERS:
+            package_dir = os.path.join(staging_dir, handler)
+            size = stage(directory, package_dir)
+            for scenario, code in SCENARIOS:
+                result = measure(package_dir, code, runs)
+                if result is None:
+                    print('%-16s %-16s %12s'%(handler, scenario, 'import failed'))
+                    continue
+                print('%-16s %-16s %12.1f %10.1f %8d %14.1f'%(handler, scenario, result['median_ms'], result['min_ms'], result['modules'], size / 1024.0))
+                if scenario == 'handler':
+                    slowest.append((handler, slowest_imports(result['samples'])))
+    finally:
+        shutil.rmtree(staging_dir)
+
+    for handler, imports in slowest:
+        print('\n%s: slowest imports of lambda_function'%handler)
+        for ms, name in imports:
+            print('  %-30s %8.1f ms'%(name, ms))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 9)
@@ -0,0 +1,144 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.   #
+#                                                                            #
+#  Licensed under the Amazon Software License (the "License"). You may not   #
+#  use this file except in compliance with the License. A copy of the        #
+#  License is located at                                                     #
+#                                                                            #
+#      http://aws.amazon.com/asl/                                            #
+#                                                                            #
+#  or in the "license" file accompanying this file. This file is distributed #
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,        #
+#  express or implied. See the License for the specific language governing   #
+#  permissions and limitations under the License.                            #
+##############################################################################
+
+#------------------------------------------------------------------------------
+# Compares the ingest of the embargo file: the legacy download-to-/tmp path,
+# the streaming reader used by the parser (alone, and with the aggregation
+# the parser runs next) and the binary snapshot (.embs, converted beforehand)
+# read in place. Every measurement runs in a fresh interpreter so peak RSS is
+# not polluted by previous scenarios.
+#
+# cd source/benchmark
+# python bench_ingest.py [entries ...]     (default: 1000 100000 1000000)
+#------------------------------------------------------------------------------
+
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+PARSER_DIR = os.path.join(BENCHMARK_DIR, '..', 'embargoed-countries-parser')
+sys.path.append(os.path.join(BENCHMARK_DIR, '..', 'lib'))
+
+from sync_state import SNAPSHOT_SUFFIX
+
+DEFAULT_SIZES = [1000, 100000, 1000000]
+COUNTRIES = ['IQ', 'IR', 'LB', 'BY', 'BI', 'LY', 'CD', 'CU', 'CF', 'ZW', 'SS', 'VE', 'SD', 'SY', 'UA', 'SO']
+IPS_PER_GROUP = 1000
+
+def ipv4(index):
+    # every other /32 so that the aggregation cannot merge entries
+    value = (10 << 24) + 2 * index
+    return '%d.%d.%d.%d/32'%(value >> 24 & 255, value >> 16 & 255, value >> 8 & 255, value & 255)
+
+def write_embargo_file(path, entries):
+    # written incrementally so the generator does not need the whole document in memory
+    with open(path, 'w') as f:
+        f.write('{\n    "embargoed-countries": [\n')
+        f.write(',\n'.join('        {"name": "%s", "code": "%s"}'%(c, c) for c in COUNTRIES))
+        f.write('\n    ],\n    "embargoed-ips": [\n')
+        for start in range(0, entries, IPS_PER_GROUP):
+            if start > 0:
+                f.write(',\n')
+            f.write('        {\n            "name": "group-%d",\n            "ips": ['%start)
+            f.write(', '.join('{"Type": "IPV4", "Value": "%s"}'%ipv4(i) for i in range(start, min(start + IPS_PER_GROUP, entries))))
+            f.write(']\n        }')
+        f.write('\n    ]\n}\n')
+
+def ingest_legacy(path):
+    # mirrors the former update_conditions: download_file to /tmp, read it back, json.loads
+    local_file_path = os.path.join(tempfile.gettempdir(), 'bench-%d-%s'%(os.getpid(), os.path.basename(path)))
+    shutil.copyfile(path, local_file_path)
+    try:
+        json_data = json.loads(open(local_file_path).read())
+        json_embargoed_countries = [e['code'] for e in json_data['embargoed-countries']]
+        json_embargoed_ips = {}
+        for e in json_data['embargoed-ips']:
+            for ip in e['ips']:
+                json_embargoed_ips[ip['Value']] = ip['Type']
+    finally:
+        os.remove(local_file_path)
+
+    return json_embargoed_countries, json_embargoed_ips
+
+def ingest_stream(path):
+    sys.path.insert(0, PARSER_DIR)
+    from embargo_file import read_embargo_file
+    with open(path, 'rb') as body:
+        return read_embargo_file(body)
+
+def ingest_aggregate(path):
+    countries, ips = ingest_stream(path)
+    import cidr
+    return countries, cidr.aggregate(ips)
+
+def ingest_snapshot(path):
+    # the parser reads the object body in one go; every entry is walked once
+    sys.path.insert(0, PARSER_DIR)
+    import snapshot
+    with open(path + SNAPSHOT_SUFFIX, 'rb') as body:
+        embargo = snapshot.load(body.read())
+    for entry in embargo.entries():
+        pass
+    return embargo.countries(), embargo
+
+MODES = {'legacy': ingest_legacy, 'stream': ingest_stream, 'aggregate': ingest_aggregate, 'snapshot': ingest_snapshot}
+
+def run_child(mode, path):
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    countries, ips = MODES[mode](path)
+    elapsed = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'seconds': elapsed, 'peak_kb': peak, 'delta_kb': peak - baseline, 'countries': len(countries), 'ips': len(ips)}))
+
+def convert_snapshot(path):
+    # in a child as well: the conversion is not part of the measurements
+    subprocess.check_call([sys.executable, os.path.join(PARSER_DIR, 'snapshot.py'), path, path + SNAPSHOT_SUFFIX], stdout=subprocess.DEVNULL)
+
+def measure(mode, path):
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', mode, path])
+    return json.loads(output.decode('utf-8'))
+
+def main(sizes):
+    work_dir = tempfile.mkdtemp(prefix='bench-ingest-')
+    try:
+        print('%-10s %-9s %12s %10s %14s %14s'%('entries', 'mode', 'file (MB)', 'time (s)', 'peak RSS (MB)', 'RSS delta (MB)'))
+        for entries in sizes:
+            path = os.path.join(work_dir, 'embargoed-countries-%d.json'%entries)
+            write_embargo_file(path, entries)
+            convert_snapshot(path)
+            for mode in ['legacy', 'stream', 'aggregate', 'snapshot']:
+                r = measure(mode, path)
+                assert r['ips'] == entries
+                size_mb = os.path.getsize(path + SNAPSHOT_SUFFIX if mode == 'snapshot' else path) / 1048576.0
+                print('%-10d %-9s %12.1f %10.3f %14.1f %14.1f'%(entries, mode, size_mb, r['seconds'], r['peak_kb'] / 1024.0, r['delta_kb'] / 1024.0))
+            os.remove(path)
+            os.remove(path + SNAPSHOT_SUFFIX)
+    finally:
+        shutil.rmtree(work_dir)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        run_child(sys.argv[2], sys.argv[3])
+    else:
+        main([int(a) for a in sys.argv[1:]] or DEFAULT_SIZES)
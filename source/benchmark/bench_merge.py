@@ -0,0 +1,77 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.   #
+#                                                                            #
+#  Licensed under the Amazon Software License (the "License"). You may not   #
+#  use this file except in compliance with the License. A copy of the        #
+#  License is located at                                                     #
+#                                                                            #
+#      http://aws.amazon.com/asl/                                            #
+#                                                                            #
+#  or in the "license" file accompanying this file. This file is distributed #
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,        #
+#  express or implied. See the License for the specific language governing   #
+#  permissions and limitations under the License.                            #
+##############################################################################
+
+#------------------------------------------------------------------------------
+# Compares the two ways the parser can bring the merged embargo set up to
+# date after one feed changed: merging every feed again from scratch, and
+# deciding only the changed feed's delta (merge.apply_change). Three feeds
+# share the entries: two deny feeds and an allow feed with a higher priority
+# exempting every 50th entry. Parsing the feeds is left out, although a full
+# rebuild would also have to read every feed again.
+#
+# cd source/benchmark
+# python bench_merge.py [entries ...]     (default: 1000 10000 100000)
+#------------------------------------------------------------------------------
+
+import os
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(BENCHMARK_DIR, '..', 'embargoed-countries-parser'), os.path.join(BENCHMARK_DIR, '..', 'lib')]
+
+import merge
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+CHURNS = [0.001, 0.01, 0.1]
+ALLOW_EVERY = 50
+
+def ipv4(index):
+    # every other /32 so that neither aggregation nor merging joins entries
+    value = (10 << 24) + 2 * index
+    return '%d.%d.%d.%d/32'%(value >> 24 & 255, value >> 16 & 255, value >> 8 & 255, value & 255)
+
+def feed(name, indexes, priority=0, effect=merge.DENY, generation=0):
+    # synthetic /32s are canonical and never adjacent: already aggregated
+    return merge.contribution(name, '"%s-%d"'%(name, generation), [], dict((ipv4(i), 'IPV4') for i in indexes), priority, effect)
+
+def main(sizes):
+    print('%-10s %7s %12s %14s %16s %9s'%('entries', 'churn', 'delta', 'rebuild (s)', 'incremental (s)', 'speedup'))
+    for entries in sizes:
+        half = entries // 2
+        others = [feed('b', range(half, entries)), feed('exempt', range(0, entries, ALLOW_EVERY), 10, merge.ALLOW)]
+        old = feed('a', range(0, half))
+        merged = merge.rebuild(others + [old])
+        for churn in CHURNS:
+            # the first churn * entries of feed a move past the end of the list
+            replaced = max(1, int(entries * churn))
+            new = feed('a', range(replaced, half + replaced), generation = replaced)
+
+            start = time.time()
+            rebuilt = merge.rebuild(others + [new])
+            rebuild_seconds = time.time() - start
+
+            updated = {'sources': dict(merged['sources']), 'countries': dict(merged['countries']), 'ips': dict(merged['ips']), 'descriptors': dict(merged['descriptors'])}
+            start = time.time()
+            delta = merge.apply_change(updated, old, new, others)
+            incremental_seconds = time.time() - start
+
+            assert updated['ips'] == rebuilt['ips'] and updated['descriptors'] == rebuilt['descriptors']
+            print('%-10d %7.3f %12d %14.3f %16.3f %8.1fx'%(entries, churn, delta['intervals'], rebuild_seconds, incremental_seconds, rebuild_seconds / max(incremental_seconds, 1e-6)))
+
+if __name__ == '__main__':
+    main([int(a) for a in sys.argv[1:]] or DEFAULT_SIZES)
@@ -0,0 +1,232 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.   #
+#                                                                            #
+#  Licensed under the Amazon Software License (the "License"). You may not   #
+#  use this file except in compliance with the License. A copy of the        #
+#  License is located at                                                     #
+#                                                                            #
+#      http://aws.amazon.com/asl/                                            #
+#                                                                            #
+#  or in the "license" file accompanying this file. This file is distributed #
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,        #
+#  express or implied. See the License for the specific language governing   #
+#  permissions and limitations under the License.                            #
+##############################################################################
+
+#------------------------------------------------------------------------------
+# Offline load test of both Lambda handlers against the fakes in fakes.py.
+# Synthetic embargo files of increasing size and churn are replayed through
+# the parser (first sync, unchanged re-upload, incremental sync from the
+# state cache, a burst of uploads coalesced into one sync) and the custom resource DELETE teardown. Each scenario runs
+# in a fresh interpreter; API call counts, wall time and peak RSS are
+# reported per phase.
+#
+# cd source/benchmark
+# python bench_sync.py --sizes 1000,10000,100000 --churn 0,0.01,0.1 --latency 0.02
+# python bench_sync.py --format snapshot     (binary .embs files instead of JSON)
+#------------------------------------------------------------------------------
+
+import argparse
+import importlib.util
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR = os.path.join(BENCHMARK_DIR, '..')
+PARSER_DIR = os.path.join(SOURCE_DIR, 'embargoed-countries-parser')
+CUSTOM_RESOURCE_DIR = os.path.join(SOURCE_DIR, 'custom-resource')
+LIB_DIR = os.path.join(SOURCE_DIR, 'lib')
+sys.path.append(LIB_DIR)
+
+from sync_state import SNAPSHOT_SUFFIX
+
+BUCKET = 'embargoed-countries-bucket'
+OBJECT_KEYS = {'json': 'embargoed-countries.json', 'snapshot': 'embargoed-countries' + SNAPSHOT_SUFFIX}
+# uploads queued back to back and delivered as one SQS batch
+BURST_UPLOADS = 10
+COUNTRIES = ['IQ', 'IR', 'LB', 'BY', 'BI', 'LY', 'CD', 'CU', 'CF', 'ZW', 'SS', 'VE', 'SD', 'SY', 'UA', 'SO']
+
+def ipv4(index):
+    # every other /32 so that the aggregation stage cannot merge entries
+    value = (10 << 24) + 2 * index
+    return '%d.%d.%d.%d/32'%(value >> 24 & 255, value >> 16 & 255, value >> 8 & 255, value & 255)
+
+def embargo_ips(entries, generation, churn):
+    # generation g replaces the first churn * entries of generation g - 1
+    replaced = int(entries * churn)
+    first = generation * replaced
+    return [ipv4(i) for i in range(first, first + entries)]
+
+def embargo_countries(generation):
+    # one country rotates out per generation, so that the geo match set
+    # changes along with the IP sets
+    return [c for c in COUNTRIES if c != COUNTRIES[generation % len(COUNTRIES)]]
+
+def embargo_document(countries, ips):
+    return json.dumps({
+        'embargoed-countries': [{'name': c, 'code': c} for c in countries],
+        'embargoed-ips': [{'name': 'synthetic', 'ips': [{'Type': 'IPV4', 'Value': v} for v in ips]}]
+    }).encode('utf-8')
+
+def load_handler(name, directory):
+    # both functions ship a module called lambda_function
+    sys.path[:0] = [directory, LIB_DIR, BENCHMARK_DIR]
+    spec = importlib.util.spec_from_file_location(name, os.path.join(directory, 'lambda_function.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def services(args):
+    import fakes
+    waf = fakes.FakeWAF(latency=args['latency'], throttle_rate=args['throttle'], max_descriptors=args['capacity'])
+    s3 = fakes.FakeS3(latency=args['latency'])
+    return waf, s3
+
+def measure_phase(name, waf, s3, run):
+    for service in [waf, s3]:
+        service.calls.clear()
+        service.throttles = 0
+
+    start = time.time()
+    response = json.loads(run())
+    elapsed = time.time() - start
+    return {
+        'phase': name,
+        'status': response.get('statusCode') or response.get('StatusCode') or ('500' if response.get('batchItemFailures') else '200'),
+        'seconds': elapsed,
+        'waf_calls': waf.api_calls(),
+        'waf_updates': sum(v for k, v in waf.calls.items() if k.startswith('Update') or k.startswith('Delete')),
+        's3_calls': s3.api_calls(),
+        'throttles': waf.throttles + s3.throttles,
+        'peak_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+
+def scenario_parser(args):
+    import fakes
+    waf, s3 = services(args)
+    entries, churn = args['entries'], args['churn']
+    geo_match_set_id = waf.add_geo_match_set(countries=COUNTRIES)
+    ip_set_id = waf.add_ip_set(descriptors=dict((v, 'IPV4') for v in embargo_ips(entries, 0, churn)))
+    ip_set_ids = [ip_set_id] + [waf.add_ip_set() for shard in range(1, args['shards'])]
+    def waf_ips():
+        return sorted(v for i in ip_set_ids for v in waf.ip_sets[i])
+
+    os.environ.update({'LOG_LEVEL': 'ERROR', 'API_TYPE': 'waf', 'GEO_MATCH_SET_ID': geo_match_set_id, 'IP_SET_ID': ip_set_id, 'IP_SET_IDS': ','.join(ip_set_ids), 'STATE_BUCKET': BUCKET})
+    parser = load_handler('parser_lambda_function', PARSER_DIR)
+    fakes.install(waf, s3)
+
+    import snapshot
+    object_key = OBJECT_KEYS[args['format']]
+    event = {'Records': [{'s3': {'bucket': {'name': BUCKET}, 'object': {'key': object_key}}}]}
+    def upload(generation):
+        ips = embargo_ips(entries, generation, churn)
+        if args['format'] == 'snapshot':
+            # synthetic /32s are canonical and never adjacent: already aggregated
+            s3.objects[(BUCKET, object_key)] = snapshot.build(embargo_countries(generation), dict((v, 'IPV4') for v in ips))
+        else:
+            s3.objects[(BUCKET, object_key)] = embargo_document(embargo_countries(generation), ips)
+    def sync():
+        return parser.lambda_handler(event, None)
+
+    phases = []
+    upload(1)
+    phases.append(measure_phase('first sync', waf, s3, sync))
+    phases.append(measure_phase('same object', waf, s3, sync))
+    upload(2)
+    phases.append(measure_phase('cached sync', waf, s3, sync))
+    assert len(waf_ips()) == entries
+
+    import ingest
+    queue = ingest.MemoryQueue()
+    for generation in range(3, 3 + BURST_UPLOADS):
+        upload(generation)
+        queue.send_object_created(BUCKET, object_key)
+    batch = queue.receive(BURST_UPLOADS)
+    phases.append(measure_phase('burst of %d'%BURST_UPLOADS, waf, s3, lambda: json.dumps(parser.lambda_handler(batch, None))))
+    assert waf_ips() == sorted(embargo_ips(entries, 2 + BURST_UPLOADS, churn))
+    assert waf.geo_match_sets[geo_match_set_id] == set(embargo_countries(2 + BURST_UPLOADS))
+    return phases
+
+def scenario_custom_resource(args):
+    import fakes
+    waf, s3 = services(args)
+    entries = args['entries']
+    geo_match_set_id = waf.add_geo_match_set(countries=COUNTRIES)
+    ip_set_id = waf.add_ip_set(descriptors=dict((v, 'IPV4') for v in embargo_ips(entries, 0, 0)))
+    rule_id_ip = waf.add_rule(predicates=[{'Negated': False, 'Type': 'IPMatch', 'DataId': ip_set_id}])
+    rule_id_geo = waf.add_rule(predicates=[{'Negated': False, 'Type': 'GeoMatch', 'DataId': geo_match_set_id}])
+    web_acl_id = waf.add_web_acl(rules=[
+        {'Priority': 100, 'RuleId': rule_id_ip, 'Action': {'Type': 'BLOCK'}, 'Type': 'REGULAR'},
+        {'Priority': 101, 'RuleId': rule_id_geo, 'Action': {'Type': 'BLOCK'}, 'Type': 'REGULAR'}
+    ])
+
+    os.environ.update({'LOG_LEVEL': 'ERROR', 'API_TYPE': 'waf'})
+    custom_resource = load_handler('custom_resource_lambda_function', CUSTOM_RESOURCE_DIR)
+    fakes.install(waf, s3)
+
+    event = {
+        'RequestType': 'Delete',
+        'RequestId': 'benchmark-delete',
+        'ResourceType': 'Custom::WafAssociations',
+        'LogicalResourceId': 'WafAssociations',
+        'ResourceProperties': {
+            'WebAclId': web_acl_id, 'RuleAction': 'BLOCK',
+            'IpSetId': ip_set_id, 'RuleIdIp': rule_id_ip, 'RulePriorityIp': '100',
+            'GeoMatchSetId': geo_match_set_id, 'RuleIdGeo': rule_id_geo, 'RulePriorityGeo': '101',
+            'StateBucket': BUCKET
+        }
+    }
+    phases = [measure_phase('delete', waf, s3, lambda: custom_resource.lambda_handler(event, None))]
+    assert len(waf.ip_sets[ip_set_id]) == 0 and geo_match_set_id not in waf.geo_match_sets
+    return phases
+
+def run_child(args):
+    scenario = scenario_parser if args['handler'] == 'parser' else scenario_custom_resource
+    print(json.dumps(scenario(args)))
+
+def run_scenario(args):
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child', json.dumps(args)], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, errors = process.communicate()
+    if process.returncode != 0:
+        return None, errors.decode('utf-8').strip().splitlines()[-1]
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1]), None
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline load test of the embargoed countries Lambda handlers')
+    parser.add_argument('--sizes', default='1000,10000,100000', help='comma separated entry counts')
+    parser.add_argument('--churn', default='0,0.01,0.1', help='comma separated fraction of entries replaced per upload')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every fake API call')
+    parser.add_argument('--throttle', type=float, default=0.0, help='probability that a WAF call attempt is throttled')
+    parser.add_argument('--capacity', type=int, default=None, help='IP set descriptor limit (default: unlimited)')
+    parser.add_argument('--shards', type=int, default=1, help='IP sets the parser spreads the descriptors over')
+    parser.add_argument('--format', default='json', choices=sorted(OBJECT_KEYS), help='embargo file format the parser syncs from')
+    parser.add_argument('--handlers', default='parser,custom-resource')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.child:
+        run_child(json.loads(options.child))
+        return
+
+    print('%-16s %8s %6s %-13s %6s %9s %9s %8s %9s %10s %9s'%('handler', 'entries', 'churn', 'phase', 'status', 'WAF calls', 'WAF upd.', 'S3 calls', 'throttles', 'time (s)', 'RSS (MB)'))
+    for handler in options.handlers.split(','):
+        for entries in [int(v) for v in options.sizes.split(',')]:
+            churns = [float(v) for v in options.churn.split(',')] if handler == 'parser' else [0.0]
+            for churn in churns:
+                args = {'handler': handler, 'entries': entries, 'churn': churn, 'latency': options.latency, 'throttle': options.throttle, 'capacity': options.capacity, 'shards': options.shards, 'format': options.format}
+                phases, error = run_scenario(args)
+                if error is not None:
+                    print('%-16s %8d %6.2f %s'%(handler, entries, churn, error))
+                    continue
+                for p in phases:
+                    print('%-16s %8d %6.2f %-13s %6s %9d %9d %8d %9d %10.3f %9.1f'%(handler, entries, churn, p['phase'], p['status'], p['waf_calls'], p['waf_updates'], p['s3_calls'], p['throttles'], p['seconds'], p['peak_kb'] / 1024.0))
+
+if __name__ == '__main__':
+    main()
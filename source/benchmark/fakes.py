@@ -0,0 +1,450 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.   #
+#                                                                            #
+#  Licensed under the Amazon Software License (the "License"). You may not   #
+#  use this file except in compliance with the License. A copy of the        #
+#  License is located at                                                     #
+#                                                                            #
+#      http://aws.amazon.com/asl/                                            #
+#                                                                            #
+#  or in the "license" file accompanying this file. This file is distributed #
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,        #
+#  express or implied. See the License for the specific language governing   #
+#  permissions and limitations under the License.                            #
+##############################################################################
+
+#------------------------------------------------------------------------------
+# In-process stand-ins for the AWS WAF Classic and S3 calls made by both
+# Lambda functions. They keep just enough state to behave like the services
+# (single-use change tokens, per-call update limits, set capacity, missing
+# items) and can add latency and throttling. Errors carry a botocore-style
+# .response so the functions handle them exactly like ClientError.
+#------------------------------------------------------------------------------
+
+import collections
+import functools
+import hashlib
+import io
+import random
+import threading
+import time
+import uuid
+
+class FakeClientError(Exception):
+    def __init__(self, code, operation_name, message=''):
+        Exception.__init__(self, "An error occurred (%s) when calling the %s operation: %s"%(code, operation_name, message))
+        self.response = {'Error': {'Code': code, 'Message': message}}
+        self.operation_name = operation_name
+
+class FakeService(object):
+    # latency: seconds added to every call, half of it before the call reaches
+    # the service state and half after, like a network round trip;
+    # throttle_rate: probability that an attempt is throttled. Throttled
+    # attempts are retried here with backoff, like botocore's retry handler
+    # does, and counted in self.throttles.
+
+    def __init__(self, latency=0.0, throttle_rate=0.0, max_attempts=8, seed=0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.max_attempts = max_attempts
+        self.calls = collections.Counter()
+        self.throttles = 0
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+
+    def _call(self, operation_name):
+        attempt = 0
+        while True:
+            with self._lock:
+                self.calls[operation_name] += 1
+                throttled = self.throttle_rate > 0 and self._random.random() < self.throttle_rate
+                if throttled:
+                    self.throttles += 1
+
+            if self.latency > 0:
+                time.sleep(self.latency / 2 if not throttled else self.latency)
+            if not throttled:
+                return
+
+            attempt += 1
+            if attempt >= self.max_attempts:
+                raise FakeClientError('ThrottlingException', operation_name, 'Rate exceeded')
+            time.sleep(min(1.0, 0.01 * (2 ** attempt)))
+
+    def _respond(self):
+        # second half of the latency, once the call went through
+        if self.latency > 0:
+            time.sleep(self.latency / 2)
+
+    def api_calls(self):
+        return sum(self.calls.values())
+
+class FakeWAF(FakeService):
+    def __init__(self, max_updates=1000, max_descriptors=10000, **kwargs):
+        FakeService.__init__(self, **kwargs)
+        self.max_updates = max_updates
+        self.max_descriptors = max_descriptors
+        self.ip_sets = {}
+        self.geo_match_sets = {}
+        self.rules = {}
+        self.web_acls = {}
+        self.names = {}
+        self._token = 0
+
+    #--------------------------------------------------------------------------
+    # Test setup helpers (no API call is recorded)
+    #--------------------------------------------------------------------------
+    def add_ip_set(self, ip_set_id=None, descriptors=None):
+        ip_set_id = ip_set_id or str(uuid.uuid4())
+        self.ip_sets[ip_set_id] = dict(descriptors or {})
+        return ip_set_id
+
+    def add_geo_match_set(self, geo_match_set_id=None, countries=None):
+        geo_match_set_id = geo_match_set_id or str(uuid.uuid4())
+        self.geo_match_sets[geo_match_set_id] = set(countries or [])
+        return geo_match_set_id
+
+    def add_rule(self, rule_id=None, predicates=None):
+        rule_id = rule_id or str(uuid.uuid4())
+        self.rules[rule_id] = list(predicates or [])
+        return rule_id
+
+    def add_web_acl(self, web_acl_id=None, rules=None, default_action='ALLOW'):
+        web_acl_id = web_acl_id or str(uuid.uuid4())
+        self.web_acls[web_acl_id] = {'WebACLId': web_acl_id, 'DefaultAction': {'Type': default_action}, 'Rules': list(rules or [])}
+        return web_acl_id
+
+    #--------------------------------------------------------------------------
+    # Change tokens: the same token is returned until an update consumes it
+    #--------------------------------------------------------------------------
+    def _consume_token(self, operation_name, change_token):
+        if change_token != 'token-%d'%self._token:
+            raise FakeClientError('WAFStaleDataException', operation_name, 'The change token has already been used')
+        self._token += 1
+
+    def _check_updates(self, operation_name, updates):
+        if len(updates) == 0:
+            raise FakeClientError('WAFInvalidParameterException', operation_name, 'Updates must not be empty')
+        if len(updates) > self.max_updates:
+            raise FakeClientError('WAFLimitsExceededException', operation_name, '%d updates in one request'%len(updates))
+
+    def _lookup(self, collection, item_id, operation_name):
+        if item_id not in collection:
+            raise FakeClientError('WAFNonexistentItemException', operation_name, '%s not found'%item_id)
+        return collection[item_id]
+
+    def get_change_token(self):
+        self._call('GetChangeToken')
+        with self._lock:
+            return {'ChangeToken': 'token-%d'%self._token}
+
+    def get_ip_set(self, IPSetId):
+        self._call('GetIPSet')
+        with self._lock:
+            ip_set = self._lookup(self.ip_sets, IPSetId, 'GetIPSet')
+            return {'IPSet': {'IPSetId': IPSetId, 'IPSetDescriptors': [{'Type': t, 'Value': v} for v, t in ip_set.items()]}}
+
+    def update_ip_set(self, IPSetId, ChangeToken, Updates):
+        self._call('UpdateIPSet')
+        with self._lock:
+            ip_set = self._lookup(self.ip_sets, IPSetId, 'UpdateIPSet')
+            self._check_updates('UpdateIPSet', Updates)
+            self._consume_token('UpdateIPSet', ChangeToken)
+
+            result = dict(ip_set)
+            for u in Updates:
+                value = u['IPSetDescriptor']['Value']
+                if u['Action'] == 'INSERT':
+                    if value in result:
+                        raise FakeClientError('WAFInvalidOperationException', 'UpdateIPSet', '%s already exists'%value)
+                    result[value] = u['IPSetDescriptor']['Type']
+                else:
+                    if value not in result:
+                        raise FakeClientError('WAFNonexistentItemException', 'UpdateIPSet', '%s not found'%value)
+                    del result[value]
+
+            if self.max_descriptors is not None and len(result) > self.max_descriptors:
+                raise FakeClientError('WAFLimitsExceededException', 'UpdateIPSet', 'IP set holds more than %d descriptors'%self.max_descriptors)
+
+            self.ip_sets[IPSetId] = result
+            return {'ChangeToken': ChangeToken}
+
+    def get_geo_match_set(self, GeoMatchSetId):
+        self._call('GetGeoMatchSet')
+        with self._lock:
+            geo_match_set = self._lookup(self.geo_match_sets, GeoMatchSetId, 'GetGeoMatchSet')
+            return {'GeoMatchSet': {'GeoMatchSetId': GeoMatchSetId, 'GeoMatchConstraints': [{'Type': 'Country', 'Value': c} for c in geo_match_set]}}
+
+    def update_geo_match_set(self, GeoMatchSetId, ChangeToken, Updates):
+        self._call('UpdateGeoMatchSet')
+        with self._lock:
+            geo_match_set = self._lookup(self.geo_match_sets, GeoMatchSetId, 'UpdateGeoMatchSet')
+            self._check_updates('UpdateGeoMatchSet', Updates)
+            self._consume_token('UpdateGeoMatchSet', ChangeToken)
+
+            result = set(geo_match_set)
+            for u in Updates:
+                value = u['GeoMatchConstraint']['Value']
+                if u['Action'] == 'INSERT':
+                    if value in result:
+                        raise FakeClientError('WAFInvalidOperationException', 'UpdateGeoMatchSet', '%s already exists'%value)
+                    result.add(value)
+                else:
+                    if value not in result:
+                        raise FakeClientError('WAFNonexistentItemException', 'UpdateGeoMatchSet', '%s not found'%value)
+                    result.remove(value)
+
+            self.geo_match_sets[GeoMatchSetId] = result
+            return {'ChangeToken': ChangeToken}
+
+    def create_geo_match_set(self, Name, ChangeToken):
+        self._call('CreateGeoMatchSet')
+        with self._lock:
+            self._consume_token('CreateGeoMatchSet', ChangeToken)
+            geo_match_set_id = self.add_geo_match_set()
+            return {'GeoMatchSet': {'GeoMatchSetId': geo_match_set_id, 'Name': Name, 'GeoMatchConstraints': []}, 'ChangeToken': ChangeToken}
+
+    def delete_geo_match_set(self, GeoMatchSetId, ChangeToken):
+        self._call('DeleteGeoMatchSet')
+        with self._lock:
+            geo_match_set = self._lookup(self.geo_match_sets, GeoMatchSetId, 'DeleteGeoMatchSet')
+            if len(geo_match_set) > 0:
+                raise FakeClientError('WAFNonEmptyEntityException', 'DeleteGeoMatchSet', 'GeoMatchSet is not empty')
+            if any(p['DataId'] == GeoMatchSetId for predicates in self.rules.values() for p in predicates):
+                raise FakeClientError('WAFReferencedItemException', 'DeleteGeoMatchSet', 'GeoMatchSet is used by a rule')
+            self._consume_token('DeleteGeoMatchSet', ChangeToken)
+            del self.geo_match_sets[GeoMatchSetId]
+            return {'ChangeToken': ChangeToken}
+
+    def update_rule(self, RuleId, ChangeToken, Updates):
+        self._call('UpdateRule')
+        with self._lock:
+            predicates = self._lookup(self.rules, RuleId, 'UpdateRule')
+            self._check_updates('UpdateRule', Updates)
+            self._consume_token('UpdateRule', ChangeToken)
+
+            result = list(predicates)
+            for u in Updates:
+                if u['Action'] == 'INSERT':
+                    if u['Predicate'] in result:
+                        raise FakeClientError('WAFInvalidOperationException', 'UpdateRule', 'Predicate already exists')
+                    result.append(u['Predicate'])
+                else:
+                    if u['Predicate'] not in result:
+                        raise FakeClientError('WAFNonexistentItemException', 'UpdateRule', 'Predicate not found')
+                    result.remove(u['Predicate'])
+
+            self.rules[RuleId] = result
+            return {'ChangeToken': ChangeToken}
+
+    def create_ip_set(self, Name, ChangeToken):
+        self._call('CreateIPSet')
+        with self._lock:
+            self._consume_token('CreateIPSet', ChangeToken)
+            ip_set_id = self.add_ip_set()
+            self.names[ip_set_id] = Name
+            return {'IPSet': {'IPSetId': ip_set_id, 'Name': Name, 'IPSetDescriptors': []}, 'ChangeToken': ChangeToken}
+
+    def delete_ip_set(self, IPSetId, ChangeToken):
+        self._call('DeleteIPSet')
+        with self._lock:
+            ip_set = self._lookup(self.ip_sets, IPSetId, 'DeleteIPSet')
+            if len(ip_set) > 0:
+                raise FakeClientError('WAFNonEmptyEntityException', 'DeleteIPSet', 'IPSet is not empty')
+            if any(p['DataId'] == IPSetId for predicates in self.rules.values() for p in predicates):
+                raise FakeClientError('WAFReferencedItemException', 'DeleteIPSet', 'IPSet is used by a rule')
+            self._consume_token('DeleteIPSet', ChangeToken)
+            del self.ip_sets[IPSetId]
+            return {'ChangeToken': ChangeToken}
+
+    def create_rule(self, Name, MetricName, ChangeToken):
+        self._call('CreateRule')
+        with self._lock:
+            self._consume_token('CreateRule', ChangeToken)
+            rule_id = self.add_rule()
+            self.names[rule_id] = Name
+            return {'Rule': {'RuleId': rule_id, 'Name': Name, 'MetricName': MetricName, 'Predicates': []}, 'ChangeToken': ChangeToken}
+
+    def delete_rule(self, RuleId, ChangeToken):
+        self._call('DeleteRule')
+        with self._lock:
+            predicates = self._lookup(self.rules, RuleId, 'DeleteRule')
+            if len(predicates) > 0:
+                raise FakeClientError('WAFNonEmptyEntityException', 'DeleteRule', 'Rule is not empty')
+            if any(r['RuleId'] == RuleId for web_acl in self.web_acls.values() for r in web_acl['Rules']):
+                raise FakeClientError('WAFReferencedItemException', 'DeleteRule', 'Rule is used by a WebACL')
+            self._consume_token('DeleteRule', ChangeToken)
+            del self.rules[RuleId]
+            return {'ChangeToken': ChangeToken}
+
+    def get_rule(self, RuleId):
+        self._call('GetRule')
+        with self._lock:
+            predicates = self._lookup(self.rules, RuleId, 'GetRule')
+            return {'Rule': {'RuleId': RuleId, 'Name': self.names.get(RuleId, RuleId), 'Predicates': list(predicates)}}
+
+    def _list(self, operation_name, collection, items_key, id_key, NextMarker=None, Limit=100):
+        self._call(operation_name)
+        with self._lock:
+            ids = sorted(collection)
+            start = ids.index(NextMarker) if NextMarker in ids else 0
+            page = ids[start:start + Limit]
+            response = {items_key: [{id_key: i, 'Name': self.names.get(i, i)} for i in page]}
+            if start + Limit < len(ids):
+                response['NextMarker'] = ids[start + Limit]
+            return response
+
+    def list_ip_sets(self, NextMarker=None, Limit=100):
+        return self._list('ListIPSets', self.ip_sets, 'IPSets', 'IPSetId', NextMarker, Limit)
+
+    def list_rules(self, NextMarker=None, Limit=100):
+        return self._list('ListRules', self.rules, 'Rules', 'RuleId', NextMarker, Limit)
+
+    def get_web_acl(self, WebACLId):
+        self._call('GetWebACL')
+        with self._lock:
+            web_acl = self._lookup(self.web_acls, WebACLId, 'GetWebACL')
+            return {'WebACL': {'WebACLId': WebACLId, 'DefaultAction': dict(web_acl['DefaultAction']), 'Rules': list(web_acl['Rules'])}}
+
+    def update_web_acl(self, WebACLId, ChangeToken, Updates, DefaultAction=None):
+        self._call('UpdateWebACL')
+        with self._lock:
+            web_acl = self._lookup(self.web_acls, WebACLId, 'UpdateWebACL')
+            self._check_updates('UpdateWebACL', Updates)
+            self._consume_token('UpdateWebACL', ChangeToken)
+
+            rules = list(web_acl['Rules'])
+            for u in Updates:
+                rule = u['ActivatedRule']
+                if u['Action'] == 'INSERT':
+                    if any(r['RuleId'] == rule['RuleId'] or r['Priority'] == rule['Priority'] for r in rules):
+                        raise FakeClientError('WAFInvalidOperationException', 'UpdateWebACL', 'Rule or priority already in use')
+                    rules.append(rule)
+                else:
+                    if rule not in rules:
+                        raise FakeClientError('WAFNonexistentItemException', 'UpdateWebACL', 'Rule not found')
+                    rules.remove(rule)
+
+            web_acl['Rules'] = rules
+            if DefaultAction is not None:
+                web_acl['DefaultAction'] = DefaultAction
+            return {'ChangeToken': ChangeToken}
+
+class FakePaginator(object):
+    def __init__(self, s3, page_size=1000):
+        self._s3 = s3
+        self._page_size = page_size
+
+    def paginate(self, Bucket, Prefix=''):
+        keys = sorted(k for b, k in list(self._s3.objects) if b == Bucket and k.startswith(Prefix))
+        for start in range(0, max(1, len(keys)), self._page_size):
+            self._s3._call('ListObjectsV2')
+            self._s3._respond()
+            page = keys[start:start + self._page_size]
+            yield {'Contents': [{'Key': k} for k in page]} if page else {}
+
+class FakeS3(FakeService):
+    def __init__(self, **kwargs):
+        FakeService.__init__(self, **kwargs)
+        self.objects = {}
+        self.notifications = {}
+
+    def _etag(self, data):
+        return '"%s"'%hashlib.md5(data).hexdigest()
+
+    def _object(self, Bucket, Key, operation_name):
+        if (Bucket, Key) not in self.objects:
+            raise FakeClientError('NoSuchKey', operation_name, 'The specified key does not exist.')
+        return self.objects[(Bucket, Key)]
+
+    def head_object(self, Bucket, Key):
+        self._call('HeadObject')
+        data = self._object(Bucket, Key, 'HeadObject')
+        return {'ETag': self._etag(data), 'ContentLength': len(data)}
+
+    def get_object(self, Bucket, Key, IfMatch=None, IfNoneMatch=None, Range=None):
+        self._call('GetObject')
+        data = self._object(Bucket, Key, 'GetObject')
+        if IfMatch is not None and IfMatch != self._etag(data):
+            raise FakeClientError('PreconditionFailed', 'GetObject', 'At least one of the pre-conditions you specified did not hold')
+        if IfNoneMatch is not None and IfNoneMatch == self._etag(data):
+            raise FakeClientError('304', 'GetObject', 'Not Modified')
+        return {'Body': io.BytesIO(data), 'ETag': self._etag(data), 'ContentLength': len(data)}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._call('PutObject')
+        data = Body.read() if hasattr(Body, 'read') else Body
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self.objects[(Bucket, Key)] = data
+        return {'ETag': self._etag(data)}
+
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        self._call('PutObject')
+        with open(Filename, 'rb') as f:
+            self.objects[(Bucket, Key)] = f.read()
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, **kwargs):
+        self._call('PutObject')
+        self.objects[(Bucket, Key)] = Fileobj.read()
+
+    def delete_object(self, Bucket, Key):
+        self._call('DeleteObject')
+        self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def delete_objects(self, Bucket, Delete):
+        self._call('DeleteObjects')
+        for o in Delete['Objects']:
+            self.objects.pop((Bucket, o['Key']), None)
+        return {}
+
+    def get_paginator(self, operation_name):
+        return FakePaginator(self)
+
+    def put_bucket_notification_configuration(self, Bucket, NotificationConfiguration):
+        self._call('PutBucketNotificationConfiguration')
+        self.notifications[Bucket] = NotificationConfiguration
+        return {}
+
+def _round_trip(method):
+    @functools.wraps(method)
+    def call(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._respond()
+    return call
+
+# every API call of the fakes waits for its response, errors included
+for service in [FakeWAF, FakeS3]:
+    for name, method in list(vars(service).items()):
+        if callable(method) and not name.startswith('_') and not name.startswith('add_') and name != 'get_paginator':
+            setattr(service, name, _round_trip(method))
+
+def install(waf=None, s3=None):
+    # Routes the shared client factory (source/lib/clients.py) to the fakes:
+    # every WAF API type/region gets `waf`, S3 gets `s3`. Returns a function
+    # restoring the real factory.
+    import clients
+    original = clients.get_client
+
+    def get_client(service_name, region_name=None):
+        return s3 if service_name == 's3' else waf
+
+    clients.get_client = get_client
+    patched = []
+    import sys
+    for module in list(sys.modules.values()):
+        if getattr(module, 'get_client', None) is original and module is not clients:
+            module.get_client = get_client
+            patched.append(module)
+
+    def uninstall():
+        clients.get_client = original
+        for module in patched:
+            module.get_client = original
+
+    return uninstall
@@ -15,11 +15,81 @@
 #  permissions and limitations under the License.                            #
 ##############################################################################
 
-import boto3
 import logging
 import json
-from botocore.vendored import requests
+import metrics
+import re
+import sync_state
+from clients import get_client
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from ip_shards import shard_index
 from os import environ
+from waf_batch import apply_updates, call_with_change_token, error_code
+
+PATCH_PREFIX = 'patches/'
+# feeds merged by the parser, see its merge.py; deleting one also triggers it
+SOURCES_PREFIX = 'sources/'
+HTTP_TIMEOUT = 60
+# Copies of the origin embargo file: objects above the threshold go in
+# concurrent parts of the chunk size, server side or streamed
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+MULTIPART_CHUNKSIZE = 16 * 1024 * 1024
+# The account may not read the origin through the S3 API (cross-account)
+COPY_FALLBACK_ERRORS = ['AccessDenied', '403', 'AllAccessDisabled']
+
+# bucket name -> region, kept for warm invocations
+_bucket_regions = {}
+
+#------------------------------------------------------------------------------
+# HTTP through urllib, imported on first use: botocore.vendored.requests is
+# gone from recent botocore releases and pulled all of botocore in at import
+#------------------------------------------------------------------------------
+def http_request(url, method='GET', data=None, headers=None):
+    # Returns the response; HTTP error statuses are returned as responses too
+    # (urllib raises them), their headers are still meaningful
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
+    try:
+        return urlopen(Request(url, data = data, headers = headers or {}, method = method), timeout = HTTP_TIMEOUT)
+    except HTTPError as error:
+        return error
+
+def bucket_region(bucket_name, key):
+    # S3 reports the region of the bucket in every response, errors and
+    # redirects included
+    if bucket_name not in _bucket_regions:
+        with http_request('https://s3.amazonaws.com/%s/%s'%(bucket_name, key), method = 'HEAD') as response:
+            _bucket_regions[bucket_name] = response.headers.get('x-amz-bucket-region') or 'us-east-1'
+    return _bucket_regions[bucket_name]
+
+def object_url(bucket_name, key):
+    return 'https://s3.%s.amazonaws.com/%s/%s'%(bucket_region(bucket_name, key), bucket_name, key)
+
+@metrics.timed
+def copy_origin_object(source_bucket, source_key, bucket_name, key):
+    # Server-side copy (CopyObject, or UploadPartCopy in concurrent parts for
+    # large objects): the object never goes through the function. When the
+    # account may not read the origin through the API, the object is read
+    # over HTTP instead and streamed to the bucket in multipart chunks, never
+    # held whole in memory or on /tmp. Returns the method used.
+    from boto3.s3.transfer import TransferConfig
+    config = TransferConfig(multipart_threshold = MULTIPART_THRESHOLD, multipart_chunksize = MULTIPART_CHUNKSIZE)
+    s3_client = get_client('s3')
+    try:
+        s3_client.copy({'Bucket': source_bucket, 'Key': source_key}, bucket_name, key, Config = config)
+        return 'copy'
+
+    except Exception as error:
+        if error_code(error) not in COPY_FALLBACK_ERRORS:
+            raise
+        logging.getLogger().warning("copy_origin_object - server-side copy of s3://%s/%s denied, streaming it: %s"%(source_bucket, source_key, str(error)))
+
+    url = object_url(source_bucket, source_key)
+    with http_request(url) as response:
+        if response.getcode() != 200:
+            raise Exception('GET %s failed: %d %s'%(url, response.getcode(), response.reason))
+        s3_client.upload_fileobj(response, bucket_name, key, Config = config)
+    return 'stream'
 
 def send_response(event, context, responseStatus, responseData, resourceId, reason=None):
     logging.getLogger().debug("send_response - Start")
@@ -50,20 +120,19 @@ def send_response(event, context, responseStatus, responseData, resourceId, reas
     }
 
     try:
-        response = requests.put(responseUrl,
-                                data=json_responseBody,
-                                headers=headers)
-        logging.getLogger().debug("Status code: " + response.reason)
+        with http_request(responseUrl, method = 'PUT', data = json_responseBody.encode('utf-8'), headers = headers) as response:
+            logging.getLogger().debug("Status code: " + response.reason)
 
     except Exception as error:
-        logging.getLogger().error("send(..) failed executing requests.put(..): " + str(error))
+        logging.getLogger().error("send(..) failed executing the response PUT: " + str(error))
 
     logging.getLogger().debug("send_response - End")
 
+@metrics.timed
 def clean_ip_set(ip_set_id):
     logging.getLogger().debug("clean_ip_set - Start")
 
-    waf_client = boto3.client(environ['API_TYPE'])
+    waf_client = get_client(environ['API_TYPE'])
     updates = []
     response = waf_client.get_ip_set(IPSetId = ip_set_id)
     for e in response['IPSet']['IPSetDescriptors']:
@@ -75,31 +144,27 @@ def clean_ip_set(ip_set_id):
             }
         })
 
-    if len(updates) > 0:
-        response = waf_client.update_ip_set(
-            IPSetId = ip_set_id,
-            ChangeToken = waf_client.get_change_token()['ChangeToken'],
-            Updates = updates
-        )
+    report = apply_updates(waf_client, waf_client.update_ip_set, updates, IPSetId = ip_set_id)
+    metrics.count('IpsRemoved', report['updates'])
+    logging.getLogger().info("clean_ip_set - %d descriptors removed in %d chunks"%(report['updates'], report['applied']))
 
     logging.getLogger().debug("clean_ip_set - End")
 
+@metrics.timed
 def create_geo_match_set(parent_stack_name):
     logging.getLogger().debug("create_geo_match_set - Start")
 
-    waf_client = boto3.client(environ['API_TYPE'])
-    response = waf_client.create_geo_match_set(
-        Name=parent_stack_name,
-        ChangeToken=waf_client.get_change_token()['ChangeToken']
-    )
+    waf_client = get_client(environ['API_TYPE'])
+    response = call_with_change_token(waf_client, waf_client.create_geo_match_set, Name = parent_stack_name)
 
     logging.getLogger().debug("create_geo_match_set - End")
     return response['GeoMatchSet']['GeoMatchSetId']
 
+@metrics.timed
 def clean_geo_match_set(geo_match_set_id):
     logging.getLogger().debug("clean_geo_match_set - Start")
 
-    waf_client = boto3.client(environ['API_TYPE'])
+    waf_client = get_client(environ['API_TYPE'])
     updates = []
     response = waf_client.get_geo_match_set(GeoMatchSetId=geo_match_set_id)
     for c in response['GeoMatchSet']['GeoMatchConstraints']:
@@ -111,157 +176,386 @@ def clean_geo_match_set(geo_match_set_id):
             }
         })
 
-    if len(updates) > 0:
-        response = waf_client.update_geo_match_set(
-            GeoMatchSetId = geo_match_set_id,
-            ChangeToken = waf_client.get_change_token()['ChangeToken'],
-            Updates = updates
-        )
+    apply_updates(waf_client, waf_client.update_geo_match_set, updates, GeoMatchSetId = geo_match_set_id)
 
     logging.getLogger().debug("clean_geo_match_set - End")
 
-def delete_geo_match_set(geo_match_set_id):
+@metrics.timed
+def delete_geo_match_set(geo_match_set_id, clean=True):
     logging.getLogger().debug("delete_geo_match_set - Start")
 
-    clean_geo_match_set(geo_match_set_id)
+    # WAF only deletes empty sets; a teardown plan cleans it in its own step
+    if clean:
+        clean_geo_match_set(geo_match_set_id)
 
-    waf_client = boto3.client(environ['API_TYPE'])
-    response = waf_client.delete_geo_match_set(
-        GeoMatchSetId=geo_match_set_id,
-        ChangeToken=waf_client.get_change_token()['ChangeToken']
-    )
+    # through the client's token pipeline: the clean-ip-set step of a
+    # teardown plan may be writing with it concurrently
+    waf_client = get_client(environ['API_TYPE'])
+    call_with_change_token(waf_client, waf_client.delete_geo_match_set, GeoMatchSetId = geo_match_set_id)
 
     logging.getLogger().debug("delete_geo_match_set - End")
 
-def configure_embargoed_countries_bucket(oring_bucket, embargoed_countries_bucket, embargoed_countries_key, countries_parser_arn):
-    logging.getLogger().debug("configure_embargoed_countries_bucket - Start")
-    logging.getLogger().debug("oring_bucket: %s"%oring_bucket)
-    logging.getLogger().debug("embargoed_countries_bucket: %s"%embargoed_countries_bucket)
-    logging.getLogger().debug("embargoed_countries_key: %s"%embargoed_countries_key)
-    logging.getLogger().debug("countries_parser_arn: %s"%countries_parser_arn)
-
-    # Configure bucket event to call embargoed countries parser
+def configure_bucket_notifications(embargoed_countries_bucket, embargoed_countries_key, countries_parser_arn, ingest_queue_arn=None):
+    # Configure bucket event to call embargoed countries parser, or to feed
+    # the queue it polls when events are coalesced through SQS
     file_name =  embargoed_countries_key.split('/')[-1]
     file_name_parts = file_name.rsplit('.', 1)
-    notification_conf = {'LambdaFunctionConfigurations':[{
+    # (full-state file, its binary snapshots, the incremental patches
+    # uploaded under PATCH_PREFIX and the feeds under SOURCES_PREFIX)
+    configurations = [{
         'Id': 'Call embargoed countries parser',
-        'LambdaFunctionArn': countries_parser_arn,
         'Events': ['s3:ObjectCreated:*'],
         'Filter': {'Key': {'FilterRules': [
             {'Name': 'prefix','Value': file_name_parts[0]},
             {'Name': 'suffix','Value': file_name_parts[1]}
         ]}}
-    }]}
-    s3_client = boto3.client('s3')
-    response = s3_client.put_bucket_notification_configuration(Bucket=embargoed_countries_bucket, NotificationConfiguration=notification_conf)
+    }, {
+        'Id': 'Call embargoed countries parser with patches',
+        'Events': ['s3:ObjectCreated:*'],
+        'Filter': {'Key': {'FilterRules': [
+            {'Name': 'prefix','Value': PATCH_PREFIX + file_name_parts[0]},
+            {'Name': 'suffix','Value': file_name_parts[1]}
+        ]}}
+    }, {
+        'Id': 'Call embargoed countries parser with feeds',
+        'Events': ['s3:ObjectCreated:*', 's3:ObjectRemoved:*'],
+        'Filter': {'Key': {'FilterRules': [
+            {'Name': 'prefix','Value': SOURCES_PREFIX},
+            {'Name': 'suffix','Value': 'json'}
+        ]}}
+    }]
+    # binary snapshots of the embargo file (sync_state.SNAPSHOT_SUFFIX, the
+    # suffix the parser picks the format by)
+    if '.' + file_name_parts[1] != sync_state.SNAPSHOT_SUFFIX:
+        configurations.append({
+            'Id': 'Call embargoed countries parser with snapshots',
+            'Events': ['s3:ObjectCreated:*'],
+            'Filter': {'Key': {'FilterRules': [
+                {'Name': 'prefix','Value': file_name_parts[0]},
+                {'Name': 'suffix','Value': sync_state.SNAPSHOT_SUFFIX}
+            ]}}
+        })
+    if ingest_queue_arn:
+        for c in configurations:
+            c['QueueArn'] = ingest_queue_arn
+        notification_conf = {'QueueConfigurations': configurations}
+    else:
+        for c in configurations:
+            c['LambdaFunctionArn'] = countries_parser_arn
+        notification_conf = {'LambdaFunctionConfigurations': configurations}
+    s3_client = get_client('s3')
+    s3_client.put_bucket_notification_configuration(Bucket=embargoed_countries_bucket, NotificationConfiguration=notification_conf)
+
+@metrics.timed
+def configure_embargoed_countries_bucket(oring_bucket, embargoed_countries_bucket, embargoed_countries_key, countries_parser_arn, ingest_queue_arn=None):
+    logging.getLogger().debug("configure_embargoed_countries_bucket - Start")
+    logging.getLogger().debug("oring_bucket: %s"%oring_bucket)
+    logging.getLogger().debug("embargoed_countries_bucket: %s"%embargoed_countries_bucket)
+    logging.getLogger().debug("embargoed_countries_key: %s"%embargoed_countries_key)
+    logging.getLogger().debug("countries_parser_arn: %s"%countries_parser_arn)
+    logging.getLogger().debug("ingest_queue_arn: %s"%ingest_queue_arn)
 
-    # upload embargoed-countries.json
+    configure_bucket_notifications(embargoed_countries_bucket, embargoed_countries_key, countries_parser_arn, ingest_queue_arn)
+
+    # copy embargoed-countries.json
     file_name =  embargoed_countries_key.split('/')[-1]
-    local_file_path = '/tmp/%s'%file_name
+    method = copy_origin_object(oring_bucket, embargoed_countries_key, embargoed_countries_bucket, file_name)
+    logging.getLogger().info("configure_embargoed_countries_bucket - s3://%s/%s copied to s3://%s/%s (%s)"%(oring_bucket, embargoed_countries_key, embargoed_countries_bucket, file_name, method))
 
-    prefix = 'https://s3.amazonaws.com/' + oring_bucket + '/'
-    response = requests.head(prefix + embargoed_countries_key)
-    if 'x-amz-bucket-region' in response.headers and response.headers['x-amz-bucket-region'] != 'us-east-1':
-        prefix = prefix.replace('https://s3', 'https://s3-'+response.headers['x-amz-bucket-region'])
-    response = requests.get(prefix + embargoed_countries_key)
-    open(local_file_path, 'wb').write(response.content)
+    logging.getLogger().debug("configure_embargoed_countries_bucket - End")
 
-    s3_client = boto3.client('s3')
-    s3_client.upload_file(local_file_path, embargoed_countries_bucket, file_name)
+@metrics.timed
+def resync_countries_parser(countries_parser_arn, embargoed_countries_bucket, embargoed_countries_key):
+    # Asynchronous: the parser syncs every target again from its last synced
+    # source (or the embargo file) once its IP sets changed. The embargo file
+    # and the sync state are left as they are.
+    logging.getLogger().debug("resync_countries_parser - Start")
+
+    get_client('lambda').invoke(
+        FunctionName=countries_parser_arn,
+        InvocationType='Event',
+        Payload=json.dumps({'action': 'resync', 'bucket': embargoed_countries_bucket, 'key': embargoed_countries_key.split('/')[-1]}).encode('utf-8')
+    )
 
-    logging.getLogger().debug("configure_embargoed_countries_bucket - End")
+    logging.getLogger().debug("resync_countries_parser - End")
 
+@metrics.timed
 def rollback_embargoed_countries_bucket_configuration(embargoed_countries_bucket, embargoed_countries_key):
     logging.getLogger().debug("rollback_embargoed_countries_bucket_configuration - Start")
 
     # Clean bucket event configuration
-    s3_client = boto3.client('s3')
+    s3_client = get_client('s3')
     notification_conf = {}
-    response = s3_client.put_bucket_notification_configuration(Bucket=embargoed_countries_bucket, NotificationConfiguration=notification_conf)
+    s3_client.put_bucket_notification_configuration(Bucket=embargoed_countries_bucket, NotificationConfiguration=notification_conf)
 
     # delete embargoed-countries.json
     file_name = embargoed_countries_key.split('/')[-1]
-    s3_client = boto3.client('s3')
     s3_client.delete_object(Bucket=embargoed_countries_bucket, Key=file_name)
 
+    # delete the parser sync state kept next to it
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=embargoed_countries_bucket, Prefix=sync_state.STATE_PREFIX):
+        objects = [{'Key': o['Key']} for o in page.get('Contents', [])]
+        if len(objects) > 0:
+            s3_client.delete_objects(Bucket=embargoed_countries_bucket, Delete={'Objects': objects, 'Quiet': True})
+
     logging.getLogger().debug("rollback_embargoed_countries_bucket_configuration - End")
 
+@metrics.timed
 def associate_waf_resources(web_acl_id, rule_action, ip_set_id, rule_id_ip, rule_priority_ip, geo_match_set_id, rule_id_geo, rule_priority_geo):
     logging.getLogger().debug("associate_waf_resources - Start")
 
-    waf_client = boto3.client(environ['API_TYPE'])
-    waf_client.update_rule(
-        RuleId = rule_id_geo,
-        ChangeToken = waf_client.get_change_token()['ChangeToken'],
-        Updates = [{
-            'Action': 'INSERT',
-            'Predicate': {
-                'Negated': False,
-                'Type': 'GeoMatch',
-                'DataId': geo_match_set_id
-            }
-        }]
-    )
+    waf_client = get_client(environ['API_TYPE'])
+    apply_updates(waf_client, waf_client.update_rule, [{
+        'Action': 'INSERT',
+        'Predicate': {
+            'Negated': False,
+            'Type': 'GeoMatch',
+            'DataId': geo_match_set_id
+        }
+    }], RuleId = rule_id_geo)
 
     response = waf_client.get_web_acl(WebACLId = web_acl_id)
-    waf_client.update_web_acl(
-        WebACLId = web_acl_id,
-        ChangeToken = waf_client.get_change_token()['ChangeToken'],
-        Updates = [{
-            'Action': 'INSERT',
-            'ActivatedRule': {
-                'Priority': rule_priority_geo,
-                'RuleId': rule_id_geo,
-                'Action': {'Type': rule_action},
-                'Type': 'REGULAR'
-            }
-        }],
-        DefaultAction = response['WebACL']['DefaultAction']
-    )
+    apply_updates(waf_client, waf_client.update_web_acl, [{
+        'Action': 'INSERT',
+        'ActivatedRule': {
+            'Priority': rule_priority_geo,
+            'RuleId': rule_id_geo,
+            'Action': {'Type': rule_action},
+            'Type': 'REGULAR'
+        }
+    }], WebACLId = web_acl_id, DefaultAction = response['WebACL']['DefaultAction'])
 
     logging.getLogger().debug("associate_waf_resources - End")
 
+@metrics.timed
 def disassociate_waf_resources(web_acl_id, rule_action, ip_set_id, rule_id_ip, rule_priority_ip, geo_match_set_id, rule_id_geo, rule_priority_geo):
     logging.getLogger().debug("disassociate_waf_resources - Start")
-    waf_client = boto3.client(environ['API_TYPE'])
+    waf_client = get_client(environ['API_TYPE'])
 
+    # apply_updates retries on stale change tokens: other plan steps may
+    # consume the account's current token concurrently
     try:
-        waf_client.update_rule(
-            RuleId = rule_id_geo,
-            ChangeToken = waf_client.get_change_token()['ChangeToken'],
-            Updates = [{
-                'Action': 'DELETE',
-                'Predicate': {
-                    'Negated': False,
-                    'Type': 'GeoMatch',
-                    'DataId': geo_match_set_id
-                }
-            }]
-        )
+        apply_updates(waf_client, waf_client.update_rule, [{
+            'Action': 'DELETE',
+            'Predicate': {
+                'Negated': False,
+                'Type': 'GeoMatch',
+                'DataId': geo_match_set_id
+            }
+        }], RuleId = rule_id_geo)
     except Exception as error:
         logging.getLogger().error(str(error))
 
     try:
         response = waf_client.get_web_acl(WebACLId = web_acl_id)
-        waf_client.update_web_acl(
-            WebACLId = web_acl_id,
-            ChangeToken = waf_client.get_change_token()['ChangeToken'],
-            Updates = [{
-                'Action': 'DELETE',
-                'ActivatedRule': {
-                    'Priority': rule_priority_geo,
-                    'RuleId': rule_id_geo,
-                    'Action': {'Type': rule_action},
-                    'Type': 'REGULAR'
-                }
-            }],
-            DefaultAction = response['WebACL']['DefaultAction']
-        )
+        apply_updates(waf_client, waf_client.update_web_acl, [{
+            'Action': 'DELETE',
+            'ActivatedRule': {
+                'Priority': rule_priority_geo,
+                'RuleId': rule_id_geo,
+                'Action': {'Type': rule_action},
+                'Type': 'REGULAR'
+            }
+        }], WebACLId = web_acl_id, DefaultAction = response['WebACL']['DefaultAction'])
     except Exception as error:
         logging.getLogger().error(str(error))
 
     logging.getLogger().debug("disassociate_waf_resources - End")
 
+def ip_shard_names(parent_stack_name, index):
+    # Extra IP sets are found again by name: custom resources keep no state
+    # between requests. Metric names must be alphanumeric.
+    name = '%s - Embargoed IPs shard %d'%(parent_stack_name, index)
+    metric_name = '%sIPShard%d'%(re.sub('[^0-9A-Za-z]', '', parent_stack_name), index)
+    return name, metric_name
+
+def find_waf_item(list_call, items_key, id_key, name):
+    marker = None
+    while True:
+        params = {'Limit': 100}
+        if marker:
+            params['NextMarker'] = marker
+        response = list_call(**params)
+        for item in response[items_key]:
+            if item['Name'] == name:
+                return item[id_key]
+
+        marker = response.get('NextMarker')
+        if not marker or len(response[items_key]) == 0:
+            return None
+
+def activated_rule(rule_id, rule_priority, rule_action):
+    return {'Priority': rule_priority, 'RuleId': rule_id, 'Action': {'Type': rule_action}, 'Type': 'REGULAR'}
+
+def deactivate_rule(web_acl_id, rule_id):
+    waf_client = get_client(environ['API_TYPE'])
+    response = waf_client.get_web_acl(WebACLId = web_acl_id)
+    updates = [{'Action': 'DELETE', 'ActivatedRule': activated_rule(r['RuleId'], r['Priority'], r['Action']['Type'])} for r in response['WebACL']['Rules'] if r['RuleId'] == rule_id]
+    apply_updates(waf_client, waf_client.update_web_acl, updates, WebACLId = web_acl_id, DefaultAction = response['WebACL']['DefaultAction'])
+
+@metrics.timed
+def create_ip_shard(parent_stack_name, index, web_acl_id, rule_action, rule_priority):
+    # WAF ANDs the predicates of a rule, so every extra IP set gets a rule of
+    # its own in the WebACL. Idempotent: existing pieces are reused.
+    logging.getLogger().debug("create_ip_shard - Start")
+
+    waf_client = get_client(environ['API_TYPE'])
+    name, metric_name = ip_shard_names(parent_stack_name, index)
+
+    ip_set_id = find_waf_item(waf_client.list_ip_sets, 'IPSets', 'IPSetId', name)
+    if ip_set_id is None:
+        ip_set_id = call_with_change_token(waf_client, waf_client.create_ip_set, Name = name)['IPSet']['IPSetId']
+
+    rule_id = find_waf_item(waf_client.list_rules, 'Rules', 'RuleId', name)
+    if rule_id is None:
+        rule_id = call_with_change_token(waf_client, waf_client.create_rule, Name = name, MetricName = metric_name)['Rule']['RuleId']
+
+    predicates = waf_client.get_rule(RuleId = rule_id)['Rule']['Predicates']
+    if not any(p['DataId'] == ip_set_id for p in predicates):
+        apply_updates(waf_client, waf_client.update_rule, [{
+            'Action': 'INSERT',
+            'Predicate': {'Negated': False, 'Type': 'IPMatch', 'DataId': ip_set_id}
+        }], RuleId = rule_id)
+
+    response = waf_client.get_web_acl(WebACLId = web_acl_id)
+    rules = [r for r in response['WebACL']['Rules'] if r['RuleId'] == rule_id]
+    if not any(r['Priority'] == rule_priority and r['Action']['Type'] == rule_action for r in rules):
+        updates = [{'Action': 'DELETE', 'ActivatedRule': activated_rule(rule_id, r['Priority'], r['Action']['Type'])} for r in rules]
+        updates.append({'Action': 'INSERT', 'ActivatedRule': activated_rule(rule_id, rule_priority, rule_action)})
+        apply_updates(waf_client, waf_client.update_web_acl, updates, WebACLId = web_acl_id, DefaultAction = response['WebACL']['DefaultAction'])
+
+    logging.getLogger().info("create_ip_shard - %s: IP set %s, rule %s"%(name, ip_set_id, rule_id))
+    logging.getLogger().debug("create_ip_shard - End")
+    return ip_set_id
+
+@metrics.timed
+def deactivate_ip_shard(parent_stack_name, index, web_acl_id):
+    waf_client = get_client(environ['API_TYPE'])
+    rule_id = find_waf_item(waf_client.list_rules, 'Rules', 'RuleId', ip_shard_names(parent_stack_name, index)[0])
+    if rule_id is not None:
+        deactivate_rule(web_acl_id, rule_id)
+
+@metrics.timed
+def move_ip_shards(parent_stack_name, indexes, ip_set_ids):
+    # Adds the descriptors of the extra sets in indexes to ip_set_ids, the
+    # sets that remain, in the set shard_index gives them: the parser's
+    # resync then finds them in place, and they stay blocked while the
+    # extra sets are deleted. One set at a time, so that no descriptor is
+    # inserted twice.
+    logging.getLogger().debug("move_ip_shards - Start")
+    import ipaddress
+
+    waf_client = get_client(environ['API_TYPE'])
+    held = {}
+    for shard, ip_set_id in enumerate(ip_set_ids):
+        for e in waf_client.get_ip_set(IPSetId = ip_set_id)['IPSet']['IPSetDescriptors']:
+            held[str(ipaddress.ip_network(e['Value'], strict = False))] = shard
+
+    for index in indexes:
+        ip_set_id = find_waf_item(waf_client.list_ip_sets, 'IPSets', 'IPSetId', ip_shard_names(parent_stack_name, index)[0])
+        if ip_set_id is None:
+            continue
+
+        updates = {}
+        for e in waf_client.get_ip_set(IPSetId = ip_set_id)['IPSet']['IPSetDescriptors']:
+            c = str(ipaddress.ip_network(e['Value'], strict = False))
+            if c not in held:
+                held[c] = shard_index(c, len(ip_set_ids))
+                updates.setdefault(held[c], []).append({'Action': 'INSERT', 'IPSetDescriptor': {'Type': e['Type'], 'Value': c}})
+
+        for shard in sorted(updates):
+            report = apply_updates(waf_client, waf_client.update_ip_set, updates[shard], IPSetId = ip_set_ids[shard])
+            metrics.count('IpsMoved', report['updates'])
+        logging.getLogger().info("move_ip_shards - %s: %d descriptors moved"%(ip_set_id, sum(len(u) for u in updates.values())))
+
+    logging.getLogger().debug("move_ip_shards - End")
+
+@metrics.timed
+def delete_ip_shard(parent_stack_name, index, web_acl_id):
+    logging.getLogger().debug("delete_ip_shard - Start")
+
+    waf_client = get_client(environ['API_TYPE'])
+    name, metric_name = ip_shard_names(parent_stack_name, index)
+
+    rule_id = find_waf_item(waf_client.list_rules, 'Rules', 'RuleId', name)
+    if rule_id is not None:
+        deactivate_rule(web_acl_id, rule_id)
+        predicates = waf_client.get_rule(RuleId = rule_id)['Rule']['Predicates']
+        apply_updates(waf_client, waf_client.update_rule, [{'Action': 'DELETE', 'Predicate': p} for p in predicates], RuleId = rule_id)
+        ignore_missing(call_with_change_token, waf_client, waf_client.delete_rule, RuleId = rule_id)()
+
+    ip_set_id = find_waf_item(waf_client.list_ip_sets, 'IPSets', 'IPSetId', name)
+    if ip_set_id is not None:
+        clean_ip_set(ip_set_id)
+        ignore_missing(call_with_change_token, waf_client, waf_client.delete_ip_set, IPSetId = ip_set_id)()
+
+    logging.getLogger().debug("delete_ip_shard - End")
+
+def ignore_missing(function, *args, **kwargs):
+    # Teardown steps are idempotent: an item deleted by an earlier attempt
+    # counts as done.
+    def run():
+        try:
+            function(*args, **kwargs)
+        except Exception as error:
+            if error_code(error) != 'WAFNonexistentItemException':
+                raise
+            logging.getLogger().warning("%s - already gone: %s"%(function.__name__, str(error)))
+    return run
+
+def run_plan(steps, state_bucket, request_id):
+    # steps: [(name, [names it depends on], function)]. Steps whose
+    # dependencies are done run concurrently. With a state_bucket, finished
+    # steps are recorded in a progress marker after each one, so a retried
+    # request (same RequestId) resumes instead of starting over.
+    logging.getLogger().debug("run_plan - Start")
+
+    s3_client = get_client('s3') if state_bucket else None
+    marker_key = sync_state.teardown_key(request_id)
+    progress = sync_state.load_state(s3_client, state_bucket, marker_key) if state_bucket else {}
+    done = progress.setdefault('done', [])
+    if len(done) > 0:
+        logging.getLogger().info("run_plan - resuming %s, done: %s"%(request_id, ', '.join(done)))
+
+    remaining = [step for step in steps if step[0] not in done]
+    failure = None
+    with ThreadPoolExecutor(max_workers = max(1, len(remaining))) as pool:
+        running = {}
+        while True:
+            if failure is None:
+                for step in [step for step in remaining if all(d in done for d in step[1])]:
+                    running[pool.submit(step[2])] = step[0]
+                    remaining.remove(step)
+
+            if len(running) == 0:
+                break
+
+            finished, _ = wait(running, return_when = FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    future.result()
+                except Exception as error:
+                    # let the steps in flight finish, start nothing new
+                    logging.getLogger().error("run_plan - step %s failed: %s"%(name, str(error)))
+                    failure = failure or error
+                    continue
+
+                logging.getLogger().info("run_plan - step %s done"%name)
+                done.append(name)
+                if state_bucket:
+                    sync_state.save_state(s3_client, state_bucket, marker_key, progress)
+
+    if failure is not None:
+        raise failure
+
+    # the marker must not keep the bucket from being deleted
+    if state_bucket:
+        sync_state.delete_state(s3_client, state_bucket, marker_key)
+
+    logging.getLogger().debug("run_plan - End")
+
 def lambda_handler(event, context):
     responseStatus = 'SUCCESS'
     reason = None
@@ -271,6 +565,7 @@ def lambda_handler(event, context):
         'Body':  {'message': 'success'}
     }
 
+    metrics.start('embargoed-countries-custom-resource')
     try:
         #------------------------------------------------------------------
         # Set Log Level
@@ -300,13 +595,22 @@ def lambda_handler(event, context):
             oring_bucket = event['ResourceProperties']['OringBucket']
             embargoed_countries_bucket = event['ResourceProperties']['EmbargoedCountriesBucket']
             embargoed_countries_key = event['ResourceProperties']['EmbargoedCountriesKey']
+            ingest_queue_arn = event['ResourceProperties'].get('IngestQueueArn')
 
             if 'CREATE' in request_type:
-                configure_embargoed_countries_bucket(oring_bucket, embargoed_countries_bucket, embargoed_countries_key, countries_parser_arn)
+                configure_embargoed_countries_bucket(oring_bucket, embargoed_countries_bucket, embargoed_countries_key, countries_parser_arn, ingest_queue_arn)
 
             elif 'UPDATE' in request_type:
-                rollback_embargoed_countries_bucket_configuration(embargoed_countries_bucket, embargoed_countries_key)
-                configure_embargoed_countries_bucket(oring_bucket, embargoed_countries_bucket, embargoed_countries_key, countries_parser_arn)
+                old_properties = event['OldResourceProperties']
+                if [old_properties.get(k) for k in ['OringBucket', 'EmbargoedCountriesBucket', 'EmbargoedCountriesKey']] == [oring_bucket, embargoed_countries_bucket, embargoed_countries_key]:
+                    # same embargo file: keep the customer's copy and the
+                    # sync state, only the notifications may have changed
+                    configure_bucket_notifications(embargoed_countries_bucket, embargoed_countries_key, countries_parser_arn, ingest_queue_arn)
+                    if old_properties.get('IpSetIds') != event['ResourceProperties'].get('IpSetIds'):
+                        resync_countries_parser(countries_parser_arn, embargoed_countries_bucket, embargoed_countries_key)
+                else:
+                    rollback_embargoed_countries_bucket_configuration(old_properties['EmbargoedCountriesBucket'], old_properties['EmbargoedCountriesKey'])
+                    configure_embargoed_countries_bucket(oring_bucket, embargoed_countries_bucket, embargoed_countries_key, countries_parser_arn, ingest_queue_arn)
 
             elif 'DELETE' in request_type:
                 rollback_embargoed_countries_bucket_configuration(embargoed_countries_bucket, embargoed_countries_key)
@@ -320,6 +624,8 @@ def lambda_handler(event, context):
             geo_match_set_id = event['ResourceProperties']['GeoMatchSetId']
             rule_id_geo = event['ResourceProperties']['RuleIdGeo']
             rule_priority_geo = int(event['ResourceProperties']['RulePriorityGeo'])
+            # optional: bucket for the progress marker of resumable plans
+            state_bucket = event['ResourceProperties'].get('StateBucket')
 
             if 'CREATE' in request_type:
                 associate_waf_resources(web_acl_id, rule_action, ip_set_id, rule_id_ip, rule_priority_ip, geo_match_set_id, rule_id_geo, rule_priority_geo)
@@ -333,7 +639,7 @@ def lambda_handler(event, context):
                 geo_match_set_id = event['OldResourceProperties']['GeoMatchSetId']
                 rule_id_geo = event['OldResourceProperties']['RuleIdGeo']
                 rule_priority_geo = int(event['OldResourceProperties']['RulePriorityGeo'])
-                disassociate_waf_resources(web_acl_id, rule_action, ip_set_id, rule_id_ip, rule_priority_ip, geo_match_set_id, rule_id_geo, rule_priority_geo)
+                old_association = [web_acl_id, rule_action, ip_set_id, rule_id_ip, rule_priority_ip, geo_match_set_id, rule_id_geo, rule_priority_geo]
 
                 web_acl_id = event['ResourceProperties']['WebAclId'].strip()
                 rule_action = event['ResourceProperties']['RuleAction']
@@ -343,20 +649,76 @@ def lambda_handler(event, context):
                 geo_match_set_id = event['ResourceProperties']['GeoMatchSetId']
                 rule_id_geo = event['ResourceProperties']['RuleIdGeo']
                 rule_priority_geo = int(event['ResourceProperties']['RulePriorityGeo'])
-                associate_waf_resources(web_acl_id, rule_action, ip_set_id, rule_id_ip, rule_priority_ip, geo_match_set_id, rule_id_geo, rule_priority_geo)
+                run_plan([
+                    ('disassociate', [], lambda: disassociate_waf_resources(*old_association)),
+                    ('associate', ['disassociate'], lambda: associate_waf_resources(web_acl_id, rule_action, ip_set_id, rule_id_ip, rule_priority_ip, geo_match_set_id, rule_id_geo, rule_priority_geo))
+                ], state_bucket, event['RequestId'])
+
+            elif 'DELETE' in request_type:
+                # only the geo match set delete has to wait: WAF refuses to
+                # delete a set that is still referenced or not empty
+                run_plan([
+                    ('disassociate', [], lambda: disassociate_waf_resources(web_acl_id, rule_action, ip_set_id, rule_id_ip, rule_priority_ip, geo_match_set_id, rule_id_geo, rule_priority_geo)),
+                    ('clean-ip-set', [], ignore_missing(clean_ip_set, ip_set_id)),
+                    ('clean-geo-match-set', [], ignore_missing(clean_geo_match_set, geo_match_set_id)),
+                    ('delete-geo-match-set', ['disassociate', 'clean-geo-match-set'], ignore_missing(delete_geo_match_set, geo_match_set_id, False))
+                ], state_bucket, event['RequestId'])
+
+        elif event['ResourceType'] == "Custom::IPSetShards":
+            # ShardCount IP sets in total: the stack's own IP set plus
+            # ShardCount - 1 extra sets, each with its own rule at priority
+            # RulePriorityBase + index - 1
+            parent_stack_name = event['ResourceProperties']['ParentStackName']
+            web_acl_id = event['ResourceProperties']['WebAclId'].strip()
+            rule_action = event['ResourceProperties']['RuleAction']
+            ip_set_id = event['ResourceProperties']['IpSetId']
+            shard_count = int(event['ResourceProperties']['ShardCount'])
+            rule_priority_base = int(event['ResourceProperties']['RulePriorityBase'])
+            state_bucket = event['ResourceProperties'].get('StateBucket')
+
+            steps = []
+            if 'CREATE' in request_type or 'UPDATE' in request_type:
+                shard_ids = {0: ip_set_id}
+                def create_step(index):
+                    def run():
+                        shard_ids[index] = create_ip_shard(parent_stack_name, index, web_acl_id, rule_action, rule_priority_base + index - 1)
+                    return run
+                for index in range(1, shard_count):
+                    steps.append(('create-shard-%d'%index, [], create_step(index)))
+
+            if 'UPDATE' in request_type:
+                old_web_acl_id = event['OldResourceProperties']['WebAclId'].strip()
+                old_shard_count = int(event['OldResourceProperties']['ShardCount'])
+                if old_shard_count > shard_count:
+                    # the parser only gets the remaining sets once this
+                    # request is done: their descriptors are moved first
+                    removed = list(range(shard_count, old_shard_count))
+                    created = ['create-shard-%d'%index for index in range(1, shard_count)]
+                    steps.append(('move-shards', created, lambda: move_ip_shards(parent_stack_name, removed, [shard_ids[index] for index in range(shard_count)])))
+                    for index in removed:
+                        steps.append(('delete-shard-%d'%index, ['move-shards'], ignore_missing(delete_ip_shard, parent_stack_name, index, old_web_acl_id)))
+                if old_web_acl_id != web_acl_id:
+                    for index in range(1, min(shard_count, old_shard_count)):
+                        steps.append(('deactivate-shard-%d'%index, [], ignore_missing(deactivate_ip_shard, parent_stack_name, index, old_web_acl_id)))
+
+            if 'CREATE' in request_type or 'UPDATE' in request_type:
+
+                # not resumable: the shard ids are only known to this run
+                run_plan(steps, None, event['RequestId'])
+                responseData['IpSetIds'] = ','.join(shard_ids[index] for index in range(shard_count))
 
             elif 'DELETE' in request_type:
-                disassociate_waf_resources(web_acl_id, rule_action, ip_set_id, rule_id_ip, rule_priority_ip, geo_match_set_id, rule_id_geo, rule_priority_geo)
-                clean_ip_set(ip_set_id)
-                delete_geo_match_set(geo_match_set_id)
+                for index in range(1, shard_count):
+                    steps.append(('delete-shard-%d'%index, [], ignore_missing(delete_ip_shard, parent_stack_name, index, web_acl_id)))
+                run_plan(steps, state_bucket, event['RequestId'])
 
     except Exception as error:
         logging.getLogger().error(str(error))
         responseStatus = 'FAILED'
-        reason = error.message
+        reason = str(error)
         result = {
             'statusCode': '500',
-            'body':  {'message': error.message}
+            'body':  {'message': str(error)}
         }
 
     finally:
@@ -366,4 +728,5 @@ def lambda_handler(event, context):
         if 'ResponseURL' in event:
             send_response(event, context, responseStatus, responseData, event['LogicalResourceId'], reason)
 
+        metrics.flush()
         return json.dumps(result)
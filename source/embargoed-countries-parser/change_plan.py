@@ -0,0 +1,154 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.   #
+#                                                                            #
+#  Licensed under the Amazon Software License (the "License"). You may not   #
+#  use this file except in compliance with the License. A copy of the        #
+#  License is located at                                                     #
+#                                                                            #
+#      http://aws.amazon.com/asl/                                            #
+#                                                                            #
+#  or in the "license" file accompanying this file. This file is distributed #
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,        #
+#  express or implied. See the License for the specific language governing   #
+#  permissions and limitations under the License.                            #
+##############################################################################
+
+#------------------------------------------------------------------------------
+# Change plan of a candidate embargo file: the inserts and deletes a sync
+# would send, how many Update* chunks and API calls that takes and roughly how
+# long. Nothing is written, neither to WAF nor to the sync state. Used by the
+# parser's {"action": "plan"} event and as a release pipeline gate:
+#
+#   python change_plan.py candidate.json --state embargo-state.json
+#   python change_plan.py candidate.embs --state-bucket my-bucket --max-updates 5000
+#
+# --state reads a sync state file (see sync_state.py) saved locally. With
+# --state-bucket the targets come from the same environment variables as the
+# parser (TARGETS, or API_TYPE, GEO_MATCH_SET_ID, IP_SET_ID, IP_SET_IDS); their
+# cached state is read from the bucket, or WAF is read when the cache is not
+# fresh (or with --live).
+#------------------------------------------------------------------------------
+
+import json
+import os
+import sys
+
+if __name__ == '__main__':
+    # run from the source tree: lib/ is only merged in when packaging
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from waf_batch import MAX_UPDATES_PER_CALL
+
+# Rough per call latencies of WAF Classic, in seconds
+DEFAULT_TIMINGS = {'update': 0.5, 'change_token': 0.1, 'read': 0.2}
+
+def chunk_count(updates):
+    return (len(updates) + MAX_UPDATES_PER_CALL - 1) // MAX_UPDATES_PER_CALL
+
+def plan_updates(updates, state_source, ip_set_ids, details=True, timings=None):
+    # updates as from compute_updates / compute_snapshot_updates. Calls and
+    # time follow read_waf_state and apply_waf_updates: the sets are read
+    # concurrently; their chunks are written one at a time, each with its own
+    # change token, the next token fetched while a chunk is in flight. A token
+    # fetched in flight can come back unconsumed and be fetched again, so
+    # GetChangeToken may need up to one extra call per chunk.
+    timings = dict(DEFAULT_TIMINGS, **(timings or {}))
+    calls = {'GetChangeToken': 0, 'UpdateGeoMatchSet': 0, 'UpdateIPSet': 0}
+    extra_tokens = 0
+    seconds = 0.0
+
+    if state_source == 'waf':
+        calls.update({'GetGeoMatchSet': 1, 'GetIPSet': len(ip_set_ids)})
+        seconds += timings['read']
+
+    sets = [('UpdateGeoMatchSet', updates['countries'])] + [('UpdateIPSet', updates['ips'][shard]) for shard in sorted(updates['ips'])]
+    for call, set_updates in sets:
+        chunks = chunk_count(set_updates)
+        if chunks == 0:
+            continue
+        calls[call] += chunks
+        calls['GetChangeToken'] += chunks
+        seconds += chunks * timings['update']
+
+    if calls['GetChangeToken'] > 0:
+        # only the first token is waited for
+        extra_tokens = calls['GetChangeToken'] - 1
+        seconds += timings['change_token']
+
+    ip_updates = [u for shard in updates['ips'] for u in updates['ips'][shard]]
+    plan = {
+        'state': state_source,
+        'countries': {
+            'insert': len([u for u in updates['countries'] if u['Action'] == 'INSERT']),
+            'delete': len([u for u in updates['countries'] if u['Action'] == 'DELETE'])
+        },
+        'ips': {
+            'insert': len([u for u in ip_updates if u['Action'] == 'INSERT']),
+            'delete': len([u for u in ip_updates if u['Action'] == 'DELETE'])
+        },
+        'shards': dict((str(shard), {'ip_set_id': ip_set_ids[shard], 'updates': len(updates['ips'][shard]), 'chunks': chunk_count(updates['ips'][shard])}) for shard in sorted(updates['ips'])),
+        'updates': len(updates['countries']) + len(ip_updates),
+        'chunks': sum(chunk_count(u) for call, u in sets),
+        'calls': calls,
+        'estimated_calls': sum(calls.values()),
+        'max_calls': sum(calls.values()) + extra_tokens,
+        'estimated_seconds': round(seconds, 3)
+    }
+
+    if details:
+        plan['countries'].update({
+            'inserted': sorted(u['GeoMatchConstraint']['Value'] for u in updates['countries'] if u['Action'] == 'INSERT'),
+            'deleted': sorted(u['GeoMatchConstraint']['Value'] for u in updates['countries'] if u['Action'] == 'DELETE')
+        })
+        plan['ips'].update({
+            'inserted': [u['IPSetDescriptor']['Value'] for u in ip_updates if u['Action'] == 'INSERT'],
+            'deleted': [u['IPSetDescriptor']['Value'] for u in ip_updates if u['Action'] == 'DELETE']
+        })
+    return plan
+
+def main():
+    import argparse
+    import logging
+    import lambda_function
+
+    parser = argparse.ArgumentParser(description = 'Change plan of a candidate embargo file (JSON or .embs); nothing is written')
+    parser.add_argument('candidate', help = 'embargo file to plan')
+    parser.add_argument('--state', help = 'local sync state file to diff against')
+    parser.add_argument('--state-bucket', help = 'bucket holding the sync state of the targets')
+    parser.add_argument('--live', action = 'store_true', help = 'read the sets from WAF, ignoring the state cache')
+    parser.add_argument('--summary', action = 'store_true', help = 'counts only, without the inserted and deleted values')
+    parser.add_argument('--max-updates', type = int, help = 'exit with status 1 when a target needs more updates than this')
+    for name, seconds in sorted(DEFAULT_TIMINGS.items()):
+        parser.add_argument('--%s-seconds'%name.replace('_', '-'), type = float, default = seconds, help = 'latency of one %s call (default %s)'%(name.replace('_', ' '), seconds))
+    options = parser.parse_args()
+    if (options.state is None) == (options.state_bucket is None):
+        parser.error('one of --state and --state-bucket is required')
+
+    logging.basicConfig(level = logging.WARNING)
+    timings = dict((name, getattr(options, '%s_seconds'%name)) for name in DEFAULT_TIMINGS)
+    with open(options.candidate, 'rb') as body:
+        countries, ips, version, digest = lambda_function.parse_full_state(body, options.candidate, None)
+
+    if options.state is not None:
+        with open(options.state) as f:
+            state = json.load(f)
+        if state.get('waf') is None:
+            parser.error('%s holds no WAF state'%options.state)
+        plan = lambda_function.plan_waf_state(countries, ips, digest, state, state['waf'], 'cache', not options.summary, timings)
+        report = {'targets': [dict(plan, target = options.state, status = 'success')]}
+    else:
+        os.environ['STATE_BUCKET'] = options.state_bucket
+        report = lambda_function.plan_sync(lambda_function.load_targets(), countries, ips, digest, options.live, not options.summary, timings)
+
+    report['candidate'] = {'file': options.candidate, 'version': version, 'digest': digest}
+    json.dump(report, sys.stdout, indent = 2, sort_keys = True)
+    sys.stdout.write('\n')
+
+    failed = [t for t in report['targets'] if t['status'] != 'success']
+    too_large = [t for t in report['targets'] if options.max_updates is not None and t.get('updates', 0) > options.max_updates]
+    sys.exit(1 if failed or too_large else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.   #
+#                                                                            #
+#  Licensed under the Amazon Software License (the "License"). You may not   #
+#  use this file except in compliance with the License. A copy of the        #
+#  License is located at                                                     #
+#                                                                            #
+#      http://aws.amazon.com/asl/                                            #
+#                                                                            #
+#  or in the "license" file accompanying this file. This file is distributed #
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,        #
+#  express or implied. See the License for the specific language governing   #
+#  permissions and limitations under the License.                            #
+##############################################################################
+
+import itertools
+import logging
+
+IPV4 = 'IPV4'
+IPV6 = 'IPV6'
+BITS = {IPV4: 32, IPV6: 128}
+
+# Prefix lengths accepted by AWS WAF Classic IP set descriptors
+SUPPORTED_PREFIXES = {
+    IPV4: [8] + list(range(16, 33)),
+    IPV6: [24, 32, 48, 56, 64, 128]
+}
+
+# An unsupported prefix is split into supported ones while that stays below
+# this many descriptors (e.g. an IPv6 /100 would need 2^28 /128s). Beyond it
+# the prefix is rejected, or widened to the closest supported covering prefix
+# when widening is enabled: a wider prefix blocks addresses outside the
+# embargo, so it is opt-in.
+MAX_SPLIT_DESCRIPTORS = 256
+# Ranges left by merged feeds (e.g. a /8 less one address) can take a few
+# hundred IPv4 blocks; IPv6 ones can take millions and are rejected (or
+# widened, when enabled) beyond this.
+MAX_COVER_DESCRIPTORS = 1024
+
+def parse(value):
+    # '10.0.0.1/24' -> ('IPV4', 167772160, 24); host bits are dropped.
+    # ipaddress is slow to import: first use only, here and in format_network
+    import ipaddress
+    network = ipaddress.ip_network(value.strip(), strict=False)
+    ip_type = IPV4 if network.version == 4 else IPV6
+    return ip_type, int(network.network_address), network.prefixlen
+
+def format_network(ip_type, network, prefix):
+    import ipaddress
+    address = ipaddress.IPv4Address(network) if ip_type == IPV4 else ipaddress.IPv6Address(network)
+    return '%s/%d'%(address, prefix)
+
+def canonical(value):
+    return format_network(*parse(value))
+
+def _fit_prefix(ip_type, network, prefix, widen=False):
+    supported = SUPPORTED_PREFIXES[ip_type]
+    if prefix in supported:
+        return network, prefix
+
+    longer = min(p for p in supported if p > prefix)
+    if 2 ** (longer - prefix) <= MAX_SPLIT_DESCRIPTORS:
+        # exact: the merge/split stage below emits the supported sub-prefixes
+        return network, prefix
+
+    # nothing to widen an IPv6 prefix shorter than /24 to: ::/0 would be split again
+    shorter = [p for p in supported if p < prefix]
+    if not widen or not shorter:
+        raise ValueError("%s would take %d /%d descriptors (AWS WAF does not support /%d)"%(format_network(ip_type, network, prefix), 2 ** (longer - prefix), longer, prefix))
+
+    wider = max(shorter)
+    mask = ((1 << wider) - 1) << (BITS[ip_type] - wider)
+    logging.getLogger().warning("cidr - %s widened to /%d (not supported by AWS WAF)"%(format_network(ip_type, network, prefix), wider))
+    return network & mask, wider
+
+def merge_intervals(intervals):
+    # intervals: sorted (first, last) pairs; overlapping and adjacent ones are joined
+    merged = []
+    for first, last in intervals:
+        if merged and first <= merged[-1][1] + 1:
+            if last > merged[-1][1]:
+                merged[-1][1] = last
+        else:
+            merged.append([first, last])
+    return merged
+
+def split_interval(ip_type, first, last):
+    # Greedy decomposition of [first, last] into the fewest aligned blocks
+    # whose prefix lengths AWS WAF supports.
+    bits = BITS[ip_type]
+    supported = SUPPORTED_PREFIXES[ip_type]
+    while first <= last:
+        for prefix in supported:
+            size = 1 << (bits - prefix)
+            if first % size == 0 and first + size - 1 <= last:
+                yield first, prefix
+                first += size
+                break
+
+def cover_interval(ip_type, first, last, widen=False):
+    # Supported blocks covering [first, last], for ranges that are not a CIDR
+    # list to begin with (merged feeds): the exact split while it takes at
+    # most MAX_COVER_DESCRIPTORS. Beyond it, the split widened to the
+    # narrowest supported prefix that brings it under the limit when widen is
+    # set, else a ValueError.
+    bits = BITS[ip_type]
+    supported = SUPPORTED_PREFIXES[ip_type]
+    for prefix in reversed(supported):
+        if prefix < bits and not widen:
+            raise ValueError("%s-%s would take more than %d descriptors"%(format_network(ip_type, first, bits), format_network(ip_type, last, bits), MAX_COVER_DESCRIPTORS))
+        size = 1 << (bits - prefix)
+        network, end = first - first % size, last - last % size + size - 1
+        if prefix == supported[0]:
+            blocks = list(split_interval(ip_type, network, end))
+        else:
+            blocks = list(itertools.islice(split_interval(ip_type, network, end), MAX_COVER_DESCRIPTORS + 1))
+        if len(blocks) <= MAX_COVER_DESCRIPTORS or prefix == supported[0]:
+            break
+
+    if (network, end) != (first, last):
+        logging.getLogger().warning("cidr - %s-%s widened to /%d blocks (not supported by AWS WAF)"%(format_network(ip_type, first, bits), format_network(ip_type, last, bits), prefix))
+    return blocks
+
+def subtract_interval(ip_type, network, prefix, first, last):
+    # Supported blocks covering what is left of the block network/prefix once
+    # [first, last] is taken out of it. Never widened: that would put back
+    # what was taken out, so a remainder beyond MAX_COVER_DESCRIPTORS raises.
+    end = network + (1 << (BITS[ip_type] - prefix)) - 1
+    blocks = []
+    if network < first:
+        blocks += cover_interval(ip_type, network, min(first - 1, end))
+    if last < end:
+        blocks += cover_interval(ip_type, max(last + 1, network), end)
+    return blocks
+
+def aggregate(values, widen=False):
+    # Canonicalises, de-duplicates and collapses covered/adjacent prefixes.
+    # Returns {canonical value: type} ordered by address. Prefixes AWS WAF
+    # cannot express in a few descriptors raise a ValueError, or are widened
+    # when widen is set.
+    intervals = {IPV4: [], IPV6: []}
+    for value in values:
+        ip_type, network, prefix = parse(value)
+        network, prefix = _fit_prefix(ip_type, network, prefix, widen)
+        intervals[ip_type].append((network, network + (1 << (BITS[ip_type] - prefix)) - 1))
+
+    descriptors = {}
+    for ip_type in [IPV4, IPV6]:
+        intervals[ip_type].sort()
+        for first, last in merge_intervals(intervals[ip_type]):
+            for network, prefix in split_interval(ip_type, first, last):
+                descriptors[format_network(ip_type, network, prefix)] = ip_type
+
+    return descriptors
@@ -0,0 +1,201 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.   #
+#                                                                            #
+#  Licensed under the Amazon Software License (the "License"). You may not   #
+#  use this file except in compliance with the License. A copy of the        #
+#  License is located at                                                     #
+#                                                                            #
+#      http://aws.amazon.com/asl/                                            #
+#                                                                            #
+#  or in the "license" file accompanying this file. This file is distributed #
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,        #
+#  express or implied. See the License for the specific language governing   #
+#  permissions and limitations under the License.                            #
+##############################################################################
+
+import codecs
+import json
+import re
+
+CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_NUMBER_TAIL = re.compile(r'[0-9.eE+-]*$')
+# top-level values yielded as (key, value, None); priority and effect are set
+# by the feeds merged from sources/ (see merge.py)
+METADATA_KEYS = ['version', 'priority', 'effect']
+
+class JsonStreamReader(object):
+    # Pull parser over a binary file-like object (an S3 StreamingBody or an
+    # open file). Containers are walked with iter_object/iter_array and only
+    # the leaf values read with read_value are materialised, so memory stays
+    # bounded by the chunk size plus the largest leaf, not the document size.
+
+    def __init__(self, stream, chunk_size=CHUNK_SIZE):
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._json = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        if self._eof:
+            return False
+
+        data = self._stream.read(self._chunk_size)
+        if data:
+            text = self._text.decode(data)
+        else:
+            self._eof = True
+            text = self._text.decode(b'', final=True)
+
+        self._buf = self._buf[self._pos:] + text
+        self._pos = 0
+        return True
+
+    def _peek(self):
+        while True:
+            self._pos = _WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON input")
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError("Expecting '%s' at offset %d"%(char, self._pos))
+        self._pos += 1
+
+    def read_value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._json.raw_decode(self._buf, self._pos)
+            except ValueError:
+                # value is split across chunks: read more and decode again
+                if self._fill():
+                    continue
+                raise
+
+            if isinstance(value, (int, float)) and _NUMBER_TAIL.match(self._buf, end) and self._fill():
+                # a number reaching the end of the buffer (possibly mid "2." or
+                # "1e") may continue in the next chunk
+                continue
+
+            self._pos = end
+            return value
+
+    def skip_value(self):
+        char = self._peek()
+        if char == '{':
+            for _ in self.iter_object():
+                self.skip_value()
+        elif char == '[':
+            for _ in self.iter_array():
+                self.skip_value()
+        else:
+            self.read_value()
+
+    def iter_object(self):
+        # Yields each key; the caller must consume the value before resuming.
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+
+        while True:
+            if self._peek() != '"':
+                raise ValueError("Expecting property name at offset %d"%self._pos)
+            key = self.read_value()
+            self._expect(':')
+            yield key
+
+            char = self._peek()
+            self._pos += 1
+            if char == '}':
+                return
+            if char != ',':
+                raise ValueError("Expecting ',' or '}' at offset %d"%(self._pos - 1))
+
+    def iter_array(self):
+        # Yields once per element; the caller must consume it before resuming.
+        self._expect('[')
+        if self._peek() == ']':
+            self._pos += 1
+            return
+
+        while True:
+            yield
+
+            char = self._peek()
+            self._pos += 1
+            if char == ']':
+                return
+            if char != ',':
+                raise ValueError("Expecting ',' or ']' at offset %d"%(self._pos - 1))
+
+def iter_embargo_file(stream, chunk_size=CHUNK_SIZE):
+    # Yields ('country', code, None) and ('ip', value, type) tuples from an
+    # embargoed-countries.json document without loading it as a whole, plus
+    # (key, value, None) for the METADATA_KEYS the document carries.
+    reader = JsonStreamReader(stream, chunk_size)
+    for key in reader.iter_object():
+        if key in METADATA_KEYS:
+            yield key, reader.read_value(), None
+
+        elif key == 'embargoed-countries':
+            for _ in reader.iter_array():
+                yield 'country', reader.read_value()['code'], None
+
+        elif key == 'embargoed-ips':
+            for _ in reader.iter_array():
+                for group_key in reader.iter_object():
+                    if group_key == 'ips':
+                        for _ in reader.iter_array():
+                            ip = reader.read_value()
+                            yield 'ip', ip['Value'], ip['Type']
+                    else:
+                        reader.skip_value()
+
+        else:
+            reader.skip_value()
+
+def read_embargo_file(stream, chunk_size=CHUNK_SIZE, metadata=None):
+    # metadata, when given, receives the METADATA_KEYS the document carries
+    embargoed_countries = []
+    embargoed_ips = {}
+    for kind, value, ip_type in iter_embargo_file(stream, chunk_size):
+        if kind == 'country':
+            embargoed_countries.append(value)
+        elif kind == 'ip':
+            embargoed_ips[value] = ip_type
+        elif metadata is not None:
+            metadata[kind] = value
+
+    return embargoed_countries, embargoed_ips
+
+def read_embargo_patch(stream):
+    # Incremental patch against a full-state file:
+    # {
+    #   "base-version": "<version of the full-state file the patch chain starts from>",
+    #   "sequence": 1,
+    #   "add":    {"embargoed-countries": ["KP"], "embargoed-ips": [{"Type": "IPV4", "Value": "1.2.3.0/24"}]},
+    #   "remove": {"embargoed-countries": [], "embargoed-ips": []}
+    # }
+    # Patches are small, so they are loaded in one go.
+    document = json.loads(stream.read().decode('utf-8'))
+    if 'base-version' not in document or not isinstance(document.get('sequence'), int):
+        raise ValueError("Embargo patch needs 'base-version' and an integer 'sequence'")
+
+    patch = {'base-version': document['base-version'], 'sequence': document['sequence']}
+    for action in ['add', 'remove']:
+        changes = document.get(action, {})
+        patch[action] = {
+            'countries': [c['code'] if isinstance(c, dict) else c for c in changes.get('embargoed-countries', [])],
+            'ips': dict((ip['Value'], ip['Type']) for ip in changes.get('embargoed-ips', []))
+        }
+    return patch
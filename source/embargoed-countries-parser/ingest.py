@@ -0,0 +1,109 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.   #
+#                                                                            #
+#  Licensed under the Amazon Software License (the "License"). You may not   #
+#  use this file except in compliance with the License. A copy of the        #
+#  License is located at                                                     #
+#                                                                            #
+#      http://aws.amazon.com/asl/                                            #
+#                                                                            #
+#  or in the "license" file accompanying this file. This file is distributed #
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,        #
+#  express or implied. See the License for the specific language governing   #
+#  permissions and limitations under the License.                            #
+##############################################################################
+
+#------------------------------------------------------------------------------
+# Coalescing of bursty S3 notifications. An invocation may carry many
+# records, directly from S3 or as an SQS batch of S3 notifications; they
+# collapse into one sync of the latest full-state file per bucket, one merge
+# of the feeds that changed and the patches uploaded after the full-state
+# file. The parser function has a reserved concurrency of 1, so a single sync
+# runs per deployment: Lambda retries the S3 invocations throttled meanwhile,
+# and SQS delivers the throttled batches again.
+#------------------------------------------------------------------------------
+
+import json
+import time
+
+def collect_records(event):
+    # [{'bucket', 'key', 'time', 'sequencer'}] of every object created or
+    # removed in the event. SQS bodies hold whole S3 notifications; the
+    # s3:TestEvent sent when the queue is configured has no records.
+    # urllib.parse pulls in a chain of modules: first use only
+    from urllib.parse import unquote_plus
+    records = []
+    for record in event.get('Records', []):
+        if record.get('eventSource') == 'aws:sqs':
+            s3_records = json.loads(record['body']).get('Records', [])
+        else:
+            s3_records = [record]
+
+        for r in s3_records:
+            if 's3' not in r:
+                continue
+            records.append({
+                'bucket': r['s3']['bucket']['name'],
+                # keys are URL encoded in notifications
+                'key': unquote_plus(r['s3']['object']['key']),
+                'time': r.get('eventTime', ''),
+                'sequencer': r['s3']['object'].get('sequencer', '')
+            })
+    return records
+
+def coalesce(records, patch_prefix, source_prefix=None):
+    # [(bucket, key)] to process in order. Per bucket only the last uploaded
+    # full-state file is synced (a sync always reads the current object), then
+    # every feed under source_prefix that changed, once each and in key order,
+    # then the patches uploaded after the full-state file, in key (sequence)
+    # order.
+    def is_source(key):
+        return source_prefix is not None and key.startswith(source_prefix)
+
+    jobs = []
+    for bucket_name in sorted(set(r['bucket'] for r in records)):
+        bucket_records = sorted([r for r in records if r['bucket'] == bucket_name], key = lambda r: (r['time'], r['sequencer']))
+        full = [r for r in bucket_records if not r['key'].startswith(patch_prefix) and not is_source(r['key'])]
+        since = ''
+        if len(full) > 0:
+            jobs.append((bucket_name, full[-1]['key']))
+            since = full[-1]['time']
+
+        jobs.extend((bucket_name, key) for key in sorted(set(r['key'] for r in bucket_records if is_source(r['key']))))
+
+        patches = set(r['key'] for r in bucket_records if r['key'].startswith(patch_prefix) and r['time'] >= since)
+        jobs.extend((bucket_name, key) for key in sorted(patches))
+    return jobs
+
+class MemoryQueue(object):
+    # In-memory stand-in for the SQS ingest queue, for local runs: messages
+    # are S3 notifications, receive() returns them as a Lambda SQS event.
+    def __init__(self):
+        self.messages = []
+
+    def send(self, notification):
+        import uuid
+        self.messages.append({
+            'messageId': str(uuid.uuid4()),
+            'eventSource': 'aws:sqs',
+            'body': json.dumps(notification)
+        })
+
+    def send_object_created(self, bucket_name, key):
+        self.send({'Records': [{
+            'eventSource': 'aws:s3',
+            'eventName': 'ObjectCreated:Put',
+            'eventTime': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime()) + '.%06dZ'%(time.time() % 1 * 1000000),
+            's3': {'bucket': {'name': bucket_name}, 'object': {'key': key, 'sequencer': '%016X'%len(self.messages)}}
+        }]})
+
+    def receive(self, batch_size=10):
+        batch, self.messages = self.messages[:batch_size], self.messages[batch_size:]
+        return {'Records': batch}
+
+    def complete(self, event, response):
+        # puts back the messages a handler response reports as failed
+        failed = set(f['itemIdentifier'] for f in response.get('batchItemFailures', []))
+        self.messages[:0] = [m for m in event['Records'] if m['messageId'] in failed]
@@ -15,79 +15,1030 @@
 #  permissions and limitations under the License.                            #
 ##############################################################################
 
-import boto3
+import bisect
+import cidr
+import ingest
 import logging
 import json
+import metrics
+import sync_state
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
 from os import environ
+from clients import get_client
+from embargo_file import read_embargo_file, read_embargo_patch
+from ip_shards import shard_index
+from waf_batch import apply_updates, error_code
 
-def update_conditions(geo_match_set_id, ip_set_id, bucket_name, object_key):
-    logging.getLogger().debug("update_conditions - Start")
+# Errors meaning the cached WAF state no longer matches the live set
+STALE_STATE_ERRORS = ['WAFNonexistentItemException', 'WAFInvalidOperationException']
+DEFAULT_STATE_VERIFY_INTERVAL = 86400
+DEFAULT_MAX_CONCURRENCY = 8
+# Incremental patches are uploaded under this prefix, next to the full-state file
+PATCH_PREFIX = 'patches/'
+# Feeds merged into the effective embargo set are uploaded under this prefix
+SOURCES_PREFIX = 'sources/'
+# GetObject with IfNoneMatch on an unchanged object
+NOT_MODIFIED_ERRORS = ['304', 'NotModified']
 
-    s3_client = boto3.client('s3')
-    waf_client = boto3.client(environ['API_TYPE'])
+# contributions of the merged feeds, kept by warm invocations
+_contributions = {}
 
-    #--------------------------------------------------------------------------
-    # Get updated embargoed countries and IPs from S3 file
-    #--------------------------------------------------------------------------
-    file_name =  object_key.split('/')[-1]
-    local_file_path = '/tmp/%s'%file_name
-    s3_client.download_file(bucket_name, object_key, local_file_path)
+def ip_shard(entry):
+    # cached entries written before sharding have no shard index
+    return entry[2] if len(entry) > 2 else 0
 
-    # create country list
-    json_data = json.loads(open(local_file_path).read())
+@metrics.timed
+def read_waf_state(waf_client, geo_match_set_id, ip_set_ids):
+    logging.getLogger().debug("read_waf_state - Start")
 
-    json_embargoed_countries = [e['code'] for e in json_data['embargoed-countries']]
-    json_embargoed_ips = {}
-    for e in json_data['embargoed-ips']:
-        for ip in e['ips']:
-            json_embargoed_ips[ip['Value']] = ip['Type']
+    # the geo match set and every IP set are read concurrently
+    with ThreadPoolExecutor(max_workers = 1 + len(ip_set_ids)) as pool:
+        geo_response = pool.submit(waf_client.get_geo_match_set, GeoMatchSetId = geo_match_set_id)
+        ip_responses = [pool.submit(waf_client.get_ip_set, IPSetId = ip_set_id) for ip_set_id in ip_set_ids]
 
-    #--------------------------------------------------------------------------
-    # Get curently blocked countries and IPs on AWS WAF
-    #--------------------------------------------------------------------------
-    response = waf_client.get_geo_match_set(GeoMatchSetId = geo_match_set_id)
+    response = geo_response.result()
     waf_embargoed_countries = [e['Value'] for e in response['GeoMatchSet']['GeoMatchConstraints'] if e['Type'] == 'Country']
 
+    # canonical value -> [type, value as stored by WAF, index of its IP set]
     waf_embargoed_ips = {}
-    response = waf_client.get_ip_set(IPSetId = ip_set_id)
-    for e in response['IPSet']['IPSetDescriptors']:
-        waf_embargoed_ips[e['Value']] = e['Type']
+    duplicates = []
+    for shard, ip_response in enumerate(ip_responses):
+        response = ip_response.result()
+        for e in response['IPSet']['IPSetDescriptors']:
+            c = cidr.canonical(e['Value'])
+            if c in waf_embargoed_ips:
+                # left behind by an interrupted move between shards
+                duplicates.append([e['Type'], e['Value'], shard])
+            else:
+                waf_embargoed_ips[c] = [e['Type'], e['Value'], shard]
 
-    #--------------------------------------------------------------------------
-    # Update AWS WAF list to aligned with what is set on S3 file
-    #--------------------------------------------------------------------------
-    updates = {"countries":[], "ips":[]}
+    logging.getLogger().debug("read_waf_state - End")
+    return {'countries': waf_embargoed_countries, 'ips': waf_embargoed_ips, 'duplicates': duplicates, 'ip_set_ids': list(ip_set_ids), 'verified_at': time.time()}
+
+def ip_update(action, ip_type, value):
+    return {'Action': action, 'IPSetDescriptor': {'Type': ip_type, 'Value': value}}
+
+def compute_country_updates(json_embargoed_countries, waf_embargoed_countries):
+    updates = []
     embargoed_countries_removed = list(set(waf_embargoed_countries) - set(json_embargoed_countries))
     for c in embargoed_countries_removed:
-        updates["countries"].append({'Action': 'DELETE', 'GeoMatchConstraint': {'Type': 'Country', 'Value': c}})
+        updates.append({'Action': 'DELETE', 'GeoMatchConstraint': {'Type': 'Country', 'Value': c}})
 
     embargoed_countries_added = list(set(json_embargoed_countries) - set(waf_embargoed_countries))
     for c in embargoed_countries_added:
-        updates["countries"].append({'Action': 'INSERT', 'GeoMatchConstraint': {'Type': 'Country', 'Value': c}})
+        updates.append({'Action': 'INSERT', 'GeoMatchConstraint': {'Type': 'Country', 'Value': c}})
+
+    return updates
 
-    if len(updates["countries"]) > 0:
-        response = waf_client.update_geo_match_set(
-            GeoMatchSetId = geo_match_set_id,
-            ChangeToken = waf_client.get_change_token()['ChangeToken'],
-            Updates = updates["countries"]
-        )
+@metrics.timed
+def compute_updates(json_embargoed_countries, json_embargoed_ips, waf_state):
+    # updates["ips"] maps shard index -> updates; only changed shards appear
+    waf_embargoed_ips = waf_state['ips']
+    shard_count = len(waf_state['ip_set_ids'])
 
+    updates = {"countries": compute_country_updates(json_embargoed_countries, waf_state['countries']), "ips":{}}
+    for e in waf_state.get('duplicates', []):
+        updates["ips"].setdefault(e[2], []).append(ip_update('DELETE', e[0], e[1]))
+
+    # descriptors in another shard than their hash says (shard count
+    # changed) are moved: deleted from the old set, inserted in the new one.
+    # With a single IP set every descriptor is in shard 0.
     embargoed_ips_removed = list(set(waf_embargoed_ips) - set(json_embargoed_ips))
-    for c in embargoed_ips_removed:
-        updates["ips"].append({'Action': 'DELETE', 'IPSetDescriptor': {'Type': waf_embargoed_ips[c], 'Value': c}})
+    embargoed_ips_moved = []
+    if shard_count > 1:
+        embargoed_ips_moved = [c for c in set(waf_embargoed_ips) & set(json_embargoed_ips) if ip_shard(waf_embargoed_ips[c]) != shard_index(c, shard_count)]
+    for c in embargoed_ips_removed + embargoed_ips_moved:
+        updates["ips"].setdefault(ip_shard(waf_embargoed_ips[c]), []).append(ip_update('DELETE', waf_embargoed_ips[c][0], waf_embargoed_ips[c][1]))
 
     embargoed_ips_added = list(set(json_embargoed_ips) - set(waf_embargoed_ips))
-    for c in embargoed_ips_added:
-        updates["ips"].append({'Action': 'INSERT', 'IPSetDescriptor': {'Type': json_embargoed_ips[c], 'Value': c}})
+    for c in embargoed_ips_added + embargoed_ips_moved:
+        updates["ips"].setdefault(shard_index(c, shard_count), []).append(ip_update('INSERT', json_embargoed_ips[c], c))
+
+    return updates
+
+def applied_ips(json_embargoed_ips, waf_state):
+    # What the IP sets hold after a successful apply, keeping the stored form
+    # of descriptors that were already there so later DELETEs match exactly.
+    shard_count = len(waf_state['ip_set_ids'])
+    ips = {}
+    for c in json_embargoed_ips:
+        shard = shard_index(c, shard_count)
+        if c in waf_state['ips'] and ip_shard(waf_state['ips'][c]) == shard:
+            ips[c] = waf_state['ips'][c][:2] + [shard]
+        else:
+            ips[c] = [json_embargoed_ips[c], c, shard]
+    return ips
+
+@metrics.timed
+def compute_snapshot_updates(json_embargoed_countries, embargo, waf_state):
+    # Same as compute_updates + applied_ips for a binary snapshot, in one
+    # merge pass over its sorted arrays and the sorted cached descriptors.
+    # Only inserted descriptors are formatted as strings. The applied ips
+    # come out sorted, so the next pass sorts an already sorted list.
+    waf_embargoed_ips = waf_state['ips']
+    shard_count = len(waf_state['ip_set_ids'])
+
+    updates = {"countries": compute_country_updates(json_embargoed_countries, waf_state['countries']), "ips":{}}
+    for e in waf_state.get('duplicates', []):
+        updates["ips"].setdefault(e[2], []).append(ip_update('DELETE', e[0], e[1]))
+
+    import snapshot
+    ips = {}
+    current = sorted((snapshot.network_key(c), c) for c in waf_embargoed_ips)
+    for c, entry in snapshot.merge(current, embargo.entries()):
+        if entry is None:
+            updates["ips"].setdefault(ip_shard(waf_embargoed_ips[c]), []).append(ip_update('DELETE', waf_embargoed_ips[c][0], waf_embargoed_ips[c][1]))
+            continue
+
+        if c is None:
+            c = cidr.format_network(*entry)
+        shard = shard_index(c, shard_count) if shard_count > 1 else 0
+        if c in waf_embargoed_ips and ip_shard(waf_embargoed_ips[c]) == shard:
+            ips[c] = waf_embargoed_ips[c][:2] + [shard]
+            continue
+
+        # new, or in another shard than its hash says
+        if c in waf_embargoed_ips:
+            updates["ips"].setdefault(ip_shard(waf_embargoed_ips[c]), []).append(ip_update('DELETE', waf_embargoed_ips[c][0], waf_embargoed_ips[c][1]))
+        updates["ips"].setdefault(shard, []).append(ip_update('INSERT', entry[0], c))
+        ips[c] = [entry[0], c, shard]
+
+    return updates, ips
+
+def diff_embargo(json_embargoed_countries, json_embargoed_ips, waf_state):
+    # (updates, ips held once they are applied); json_embargoed_ips is a
+    # {canonical value: type} dict or a snapshot.Snapshot
+    if not isinstance(json_embargoed_ips, dict):
+        return compute_snapshot_updates(json_embargoed_countries, json_embargoed_ips, waf_state)
+    return compute_updates(json_embargoed_countries, json_embargoed_ips, waf_state), applied_ips(json_embargoed_ips, waf_state)
+
+def merge_reports(reports):
+    report = {'updates': 0, 'chunks': 0, 'applied': 0, 'retries': 0, 'change_token': None, 'shards': len(reports)}
+    for r in reports:
+        for k in ['updates', 'chunks', 'applied', 'retries']:
+            report[k] += r[k]
+        report['change_token'] = r['change_token'] or report['change_token']
+    return report
+
+@metrics.timed
+def apply_waf_updates(waf_client, geo_match_set_id, ip_set_ids, updates):
+    # The geo match set and the IP sets are updated concurrently. Their writes
+    # still go one at a time through the client's change token pipeline
+    # (waf_batch), but each set's next chunk gets its token while another is
+    # in flight. A set that fails does not stop the others: the first error is
+    # raised once all of them are done.
+    with ThreadPoolExecutor(max_workers = 1 + len(updates["ips"])) as pool:
+        countries = pool.submit(apply_updates, waf_client, waf_client.update_geo_match_set, updates["countries"], GeoMatchSetId = geo_match_set_id)
+        ips = [pool.submit(apply_updates, waf_client, waf_client.update_ip_set, updates["ips"][shard], IPSetId = ip_set_ids[shard]) for shard in sorted(updates["ips"])]
+
+    sets = [('geo match set', geo_match_set_id)] + [('IP set', ip_set_ids[shard]) for shard in sorted(updates["ips"])]
+    for (kind, set_id), future in zip(sets, [countries] + ips):
+        if future.exception() is not None:
+            logging.getLogger().error("apply_waf_updates - %s %s failed: %s"%(kind, set_id, str(future.exception())))
+    report = {}
+    report["countries"] = countries.result()
+    report["ips"] = merge_reports([future.result() for future in ips])
+
+    ip_updates = [u for shard in updates["ips"] for u in updates["ips"][shard]]
+    metrics.count('CountriesAdded', len([u for u in updates["countries"] if u['Action'] == 'INSERT']))
+    metrics.count('CountriesRemoved', len([u for u in updates["countries"] if u['Action'] == 'DELETE']))
+    metrics.count('IpsAdded', len([u for u in ip_updates if u['Action'] == 'INSERT']))
+    metrics.count('IpsRemoved', len([u for u in ip_updates if u['Action'] == 'DELETE']))
+    return report
+
+def applied_waf_state(json_embargoed_countries, ips, waf_state, report):
+    # What WAF holds after a successful apply (ips from diff_embargo)
+    return {
+        'countries': sorted(set(json_embargoed_countries)),
+        'ips': ips,
+        'ip_set_ids': waf_state['ip_set_ids'],
+        'change_token': report["ips"].get('change_token') or report["countries"].get('change_token') or waf_state.get('change_token'),
+        'verified_at': waf_state['verified_at']
+    }
+
+def cached_waf_state(state, ip_set_ids):
+    waf_state = state.get('waf')
+    if waf_state is None:
+        return None
+
+    # caches written before sharding cover the first IP set only
+    if waf_state.get('ip_set_ids', ip_set_ids[:1]) != ip_set_ids:
+        logging.getLogger().info("cached_waf_state - IP sets changed")
+        return None
+
+    verify_interval = int(environ.get('STATE_VERIFY_INTERVAL', DEFAULT_STATE_VERIFY_INTERVAL))
+    if time.time() - waf_state.get('verified_at', 0) >= verify_interval:
+        logging.getLogger().info("cached_waf_state - verification due")
+        return None
+
+    # a copy: the loaded state is left as it was read
+    return dict(waf_state, ip_set_ids = ip_set_ids)
+
+def load_targets():
+    # TARGETS: JSON list of {"api_type", "region", "geo_match_set_id", "ip_set_id"}.
+    # Without it the function syncs the sets it was deployed with. A target
+    # can spread its descriptors over several IP sets with "ip_set_ids"
+    # (IP_SET_IDS, comma separated, for the default target); the first one
+    # identifies the target.
+    if environ.get('TARGETS'):
+        targets = json.loads(environ['TARGETS'])
+    else:
+        targets = [{'geo_match_set_id': environ['GEO_MATCH_SET_ID'], 'ip_set_id': environ['IP_SET_ID']}]
+        if environ.get('IP_SET_IDS'):
+            targets[0]['ip_set_ids'] = environ['IP_SET_IDS'].split(',')
+
+    for target in targets:
+        target.setdefault('api_type', environ['API_TYPE'])
+        target.setdefault('region', None)
+        target.setdefault('ip_set_id', target['ip_set_ids'][0] if target.get('ip_set_ids') else None)
+        target.setdefault('ip_set_ids', [target['ip_set_id']])
+    return targets
+
+def target_name(target):
+    return "%s:%s:%s/%s"%(target['api_type'], target['region'] or 'default', target['geo_match_set_id'], target['ip_set_id'])
+
+def fan_out(function, targets, *args):
+    # Runs function(target, *args) for every target on a bounded thread pool.
+    # Returns [(target, result, error)] in target order; a failing target
+    # never stops the others.
+    def run(target):
+        try:
+            return target, function(target, *args), None
+        except Exception as error:
+            logging.getLogger().error("%s - %s failed: %s"%(function.__name__, target_name(target), str(error)))
+            return target, None, error
+
+    max_workers = max(1, min(int(environ.get('MAX_CONCURRENCY', DEFAULT_MAX_CONCURRENCY)), len(targets)))
+    with ThreadPoolExecutor(max_workers = max_workers) as pool:
+        return list(pool.map(run, targets))
+
+def widen_prefixes():
+    # WIDEN_PREFIXES=true: prefixes AWS WAF cannot express in a few
+    # descriptors are widened (blocking addresses outside the embargo)
+    # instead of failing the sync
+    return environ.get('WIDEN_PREFIXES', 'false').lower() == 'true'
+
+def state_bucket():
+    # Every piece of sync state (target caches, merged feeds) lives in
+    # STATE_BUCKET, whichever bucket the synced object came from
+    return environ['STATE_BUCKET']
+
+@metrics.timed
+def load_target_state(target):
+    state_key = sync_state.state_key(target['geo_match_set_id'], target['ip_set_id'])
+    return sync_state.load_state(get_client('s3'), state_bucket(), state_key)
+
+def sync_target(target, state, object_key, etag, version, json_embargoed_countries, json_embargoed_ips, state_digest):
+    logging.getLogger().debug("sync_target - Start")
+
+    s3_client = get_client('s3')
+    waf_client = get_client(target['api_type'], target['region'])
+    geo_match_set_id = target['geo_match_set_id']
+    ip_set_ids = target['ip_set_ids']
+    state_key = sync_state.state_key(geo_match_set_id, target['ip_set_id'])
+    waf_state = cached_waf_state(state, ip_set_ids)
+
+    # same embargo content under a new ETag (e.g. a release re-upload)
+    if waf_state is not None and state.get('digest') == state_digest:
+        logging.getLogger().info("sync_target - %s: %s (%s) content unchanged"%(target_name(target), object_key, etag))
+        state.update({'source': object_key, 'etag': etag, 'version': version, 'sequence': 0})
+        sync_state.save_state(s3_client, state_bucket(), state_key, state)
+        return {'skipped': 'digest'}
+
+    #--------------------------------------------------------------------------
+    # Get curently blocked countries and IPs, from the state cache when fresh
+    #--------------------------------------------------------------------------
+    state_source = 'cache'
+    if waf_state is None:
+        waf_state = read_waf_state(waf_client, geo_match_set_id, ip_set_ids)
+        state_source = 'waf'
+
+    #--------------------------------------------------------------------------
+    # Update AWS WAF list to aligned with what is set on S3 file
+    #--------------------------------------------------------------------------
+    try:
+        try:
+            updates, ips = diff_embargo(json_embargoed_countries, json_embargoed_ips, waf_state)
+            report = apply_waf_updates(waf_client, geo_match_set_id, ip_set_ids, updates)
+
+        except Exception as error:
+            if state_source != 'cache' or error_code(error) not in STALE_STATE_ERRORS:
+                raise
+
+            logging.getLogger().warning("sync_target - %s: stale state cache (%s), reading WAF"%(target_name(target), str(error)))
+            waf_state = read_waf_state(waf_client, geo_match_set_id, ip_set_ids)
+            state_source = 'waf'
+            updates, ips = diff_embargo(json_embargoed_countries, json_embargoed_ips, waf_state)
+            report = apply_waf_updates(waf_client, geo_match_set_id, ip_set_ids, updates)
+
+    except Exception:
+        # WAF may hold a partially applied change set: drop the cache
+        state.pop('waf', None)
+        state.pop('digest', None)
+        sync_state.save_state(s3_client, state_bucket(), state_key, state)
+        raise
+
+    sync_state.save_state(s3_client, state_bucket(), state_key, {
+        'source': object_key,
+        'etag': etag,
+        'digest': state_digest,
+        'version': version,
+        'sequence': 0,
+        'waf': applied_waf_state(json_embargoed_countries, ips, waf_state, report)
+    })
 
-    if len(updates["ips"]) > 0:
-        response = waf_client.update_ip_set(
-            IPSetId = ip_set_id,
-            ChangeToken = waf_client.get_change_token()['ChangeToken'],
-            Updates = updates["ips"]
-       )
+    report['state'] = state_source
+    logging.getLogger().info("sync_target - %s: countries: %s, ips: %s (state from %s)"%(target_name(target), report["countries"], report["ips"], state_source))
+    logging.getLogger().debug("sync_target - End")
+    return report
+
+def parse_full_state(body, object_key, etag):
+    # (countries, ips, version, digest) of a full-state file; ips is a
+    # {canonical value: type} dict for JSON files and the snapshot itself
+    # for binary snapshots, whose descriptors are already aggregated
+    if object_key.endswith(sync_state.SNAPSHOT_SUFFIX):
+        # snapshot is only imported by the code paths that need it, to keep
+        # it out of every cold start
+        import snapshot
+        with metrics.phase('read_snapshot'):
+            embargo = snapshot.load(body.read())
+
+        metrics.count('Descriptors', len(embargo))
+        return embargo.countries(), embargo, embargo.version or etag, embargo.digest
+
+    # download and parse are one streamed phase
+    with metrics.phase('read_embargo_file'):
+        metadata = {}
+        json_embargoed_countries, json_embargoed_ips = read_embargo_file(body, metadata = metadata)
+
+    # patches name the full-state file they apply to by its version
+    version = metadata.get('version', etag)
+
+    # canonical, aggregated descriptors so equivalent CIDRs never show up as a diff
+    with metrics.phase('aggregate'):
+        json_embargoed_ips = cidr.aggregate(json_embargoed_ips, widen_prefixes())
+        state_digest = sync_state.digest(json_embargoed_countries, json_embargoed_ips)
+    metrics.count('Descriptors', len(json_embargoed_ips))
+    return json_embargoed_countries, json_embargoed_ips, version, state_digest
+
+def read_full_state(s3_client, bucket_name, object_key, etag):
+    response = s3_client.get_object(Bucket = bucket_name, Key = object_key, IfMatch = etag)
+    try:
+        return parse_full_state(response['Body'], object_key, etag)
+    finally:
+        response['Body'].close()
+
+def sync_full_state(targets, loaded, object_key, etag, read):
+    # Syncs every target in loaded (as from fan_out(load_target_state)) to a
+    # full-state source identified by object_key and etag, skipping the
+    # targets that already applied it. read() returns its (countries, ips,
+    # version, digest) and is only called when a target needs them.
+    logging.getLogger().debug("sync_full_state - Start")
+
+    #--------------------------------------------------------------------------
+    # Skip targets that already applied this exact object
+    #--------------------------------------------------------------------------
+    states = {}
+    pending = []
+    results = {}
+    for target, state, error in loaded:
+        state = state or {}
+        states[target_name(target)] = state
+        if cached_waf_state(state, target['ip_set_ids']) is not None and state.get('source') == object_key and state.get('etag') == etag and 'version' in state:
+            results[target_name(target)] = {'target': target_name(target), 'status': 'skipped', 'reason': 'etag'}
+        else:
+            pending.append(target)
 
+    if len(pending) > 0:
+        #----------------------------------------------------------------------
+        # Get updated embargoed countries and IPs, once for all
+        #----------------------------------------------------------------------
+        json_embargoed_countries, json_embargoed_ips, version, state_digest = read()
+
+        #----------------------------------------------------------------------
+        # Apply concurrently; each target has its own client and change tokens
+        #----------------------------------------------------------------------
+        def run(target):
+            return sync_target(target, states[target_name(target)], object_key, etag, version, json_embargoed_countries, json_embargoed_ips, state_digest)
+        run.__name__ = 'sync_target'
+
+        with metrics.phase('sync_targets'):
+            synced = fan_out(run, pending)
+        for target, report, error in synced:
+            if error is not None:
+                results[target_name(target)] = {'target': target_name(target), 'status': 'failed', 'error': str(error)}
+            elif 'skipped' in report:
+                results[target_name(target)] = {'target': target_name(target), 'status': 'skipped', 'reason': report['skipped']}
+            else:
+                results[target_name(target)] = {'target': target_name(target), 'status': 'success', 'updates': report}
+
+    report = {'etag': etag, 'targets': [results[target_name(t)] for t in targets]}
+    report['failed'] = len([r for r in report['targets'] if r['status'] == 'failed'])
+    logging.getLogger().debug("sync_full_state - End")
+    return report
+
+def update_conditions(targets, bucket_name, object_key):
+    logging.getLogger().debug("update_conditions - Start")
+
+    s3_client = get_client('s3')
+    def head_object():
+        with metrics.phase('head_object'):
+            return s3_client.head_object(Bucket = bucket_name, Key = object_key)['ETag']
+
+    # the object's ETag is read while the target states load
+    with ThreadPoolExecutor(max_workers = 1) as pool:
+        head = pool.submit(head_object)
+        loaded = fan_out(load_target_state, targets)
+    etag = head.result()
+
+    def read():
+        return read_full_state(s3_client, bucket_name, object_key, etag)
+
+    report = sync_full_state(targets, loaded, object_key, etag, read)
+    logging.getLogger().info("update_conditions - %d targets, %d failed"%(len(targets), report['failed']))
     logging.getLogger().debug("update_conditions - End")
+    return report
+
+#------------------------------------------------------------------------------
+# Feeds merged into the effective embargo set (see merge.py)
+#------------------------------------------------------------------------------
+def read_source(s3_client, bucket_name, object_key, etag=None):
+    # Contribution of the feed in object_key, None once the feed is deleted,
+    # or the string 'unchanged' when its ETag is still etag
+    condition = {'IfNoneMatch': etag} if etag is not None else {}
+    try:
+        response = s3_client.get_object(Bucket = bucket_name, Key = object_key, **condition)
+    except Exception as error:
+        if error_code(error) == 'NoSuchKey':
+            return None
+        if error_code(error) in NOT_MODIFIED_ERRORS:
+            return 'unchanged'
+        raise
+
+    try:
+        metadata = {}
+        countries, ips = read_embargo_file(response['Body'], metadata = metadata)
+    finally:
+        response['Body'].close()
+
+    import merge
+    return merge.contribution(object_key[len(SOURCES_PREFIX):], response['ETag'], countries, cidr.aggregate(ips, widen_prefixes()), metadata.get('priority', 0), metadata.get('effect', merge.DENY))
+
+def load_contribution(s3_client, name, etag):
+    # contribution of a merged feed as of etag, or None when it is missing
+    cached = _contributions.get(name)
+    if cached is not None and cached['etag'] == etag:
+        return cached
+
+    contribution = sync_state.load_state(s3_client, state_bucket(), sync_state.source_key(name))
+    if contribution.get('etag') != etag:
+        return None
+    _contributions[name] = contribution
+    return contribution
+
+@metrics.timed
+def merge_sources(bucket_name, object_keys):
+    # Merges the feeds in object_keys into the effective set kept under
+    # sync_state.merged_key(), one feed delta at a time. Without a usable
+    # merged state every feed under SOURCES_PREFIX is merged from scratch.
+    # Returns (merged, {feed name: delta or 'removed'}).
+    logging.getLogger().debug("merge_sources - Start")
+    import merge
+
+    s3_client = get_client('s3')
+    merged_key = sync_state.merged_key()
+    merged = sync_state.load_state(s3_client, state_bucket(), merged_key)
+    contributions = {}
+    if merged:
+        names = sorted(merged['sources'])
+        with ThreadPoolExecutor(max_workers = max(1, min(int(environ.get('MAX_CONCURRENCY', DEFAULT_MAX_CONCURRENCY)), len(names)))) as pool:
+            loaded = list(pool.map(lambda name: load_contribution(s3_client, name, merged['sources'][name]['etag']), names))
+        contributions = dict((name, c) for name, c in zip(names, loaded) if c is not None)
+
+    if not merged or len(contributions) < len(merged['sources']):
+        logging.getLogger().warning("merge_sources - no usable merged state in s3://%s/%s, merging every feed"%(state_bucket(), merged_key))
+        merged = merge.empty()
+        contributions = {}
+        object_keys = [o['Key'] for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket = bucket_name, Prefix = SOURCES_PREFIX) for o in page.get('Contents', [])]
+
+    changes = {}
+    for object_key in sorted(set(object_keys)):
+        name = object_key[len(SOURCES_PREFIX):]
+        old = contributions.get(name)
+        with metrics.phase('read_source'):
+            new = read_source(s3_client, bucket_name, object_key, old['etag'] if old is not None else None)
+        if new == 'unchanged' or (new is None and old is None):
+            continue
+
+        others = [c for n, c in sorted(contributions.items()) if n != name]
+        with metrics.phase('merge'):
+            delta = merge.apply_change(merged, old, new, others, widen_prefixes())
+
+        # the contribution is saved first: a merged state naming an ETag its
+        # contribution does not have is rebuilt from scratch
+        if new is None:
+            contributions.pop(name)
+            _contributions.pop(name, None)
+            sync_state.delete_state(s3_client, state_bucket(), sync_state.source_key(name))
+            changes[name] = 'removed'
+        else:
+            contributions[name] = new
+            _contributions[name] = new
+            sync_state.save_state(s3_client, state_bucket(), sync_state.source_key(name), new)
+            changes[name] = delta
+        logging.getLogger().info("merge_sources - %s: %s"%(object_key, changes[name]))
+
+    if changes:
+        sync_state.save_state(s3_client, state_bucket(), merged_key, merged)
+    logging.getLogger().debug("merge_sources - End")
+    return merged, changes
+
+def update_merged(targets, bucket_name, object_keys):
+    # Merges the changed feeds, then syncs the effective set like a
+    # full-state file named SOURCES_PREFIX whose ETag and version are the
+    # digest of the effective set
+    logging.getLogger().debug("update_merged - Start")
+
+    # the feeds merge while the target states load
+    with ThreadPoolExecutor(max_workers = 1) as pool:
+        merging = pool.submit(merge_sources, bucket_name, object_keys)
+        loaded = fan_out(load_target_state, targets)
+    merged, changes = merging.result()
+
+    json_embargoed_countries = sorted(merged['countries'])
+    json_embargoed_ips = merged['descriptors']
+    state_digest = sync_state.digest(json_embargoed_countries, json_embargoed_ips)
+    metrics.count('Descriptors', len(json_embargoed_ips))
+
+    def read():
+        return json_embargoed_countries, json_embargoed_ips, state_digest, state_digest
+
+    report = sync_full_state(targets, loaded, SOURCES_PREFIX, state_digest, read)
+    report['sources'] = changes
+    logging.getLogger().info("update_merged - %d feeds changed, %d targets, %d failed"%(len(changes), len(targets), report['failed']))
+    logging.getLogger().debug("update_merged - End")
+    return report
+
+@metrics.timed
+def compute_patch_updates(patch, waf_state):
+    # Updates for one patch, computed against the cached WAF state only.
+    # Returns (updates, countries, ips) with countries/ips being the state
+    # after the patch. The patch applies to the addresses the set blocks, not
+    # to its descriptors as listed: the last full sync may have aggregated a
+    # removed entry into a wider prefix, which is then replaced by the
+    # supported prefixes left around the entry. Blocks are looked up by
+    # their covering prefixes, O(patch size); only a removal or addition
+    # wider than the descriptors it overlaps sorts the set's descriptors.
+    shard_count = len(waf_state['ip_set_ids'])
+    updates = {"countries":[], "ips":{}}
+    countries = set(waf_state['countries'])
+    for c in set(patch['remove']['countries']):
+        if c in countries:
+            updates["countries"].append({'Action': 'DELETE', 'GeoMatchConstraint': {'Type': 'Country', 'Value': c}})
+            countries.remove(c)
+
+    for c in set(patch['add']['countries']):
+        if c not in countries:
+            updates["countries"].append({'Action': 'INSERT', 'GeoMatchConstraint': {'Type': 'Country', 'Value': c}})
+            countries.add(c)
+
+    # the set's descriptors are disjoint: a block is either within one of
+    # them or holds all those it overlaps
+    ips = dict(waf_state['ips'])
+    touched = set()
+    index = []
+
+    def covering(ip_type, network, prefix):
+        bits = cidr.BITS[ip_type]
+        for p in cidr.SUPPORTED_PREFIXES[ip_type]:
+            if p > prefix:
+                break
+            c = cidr.format_network(ip_type, network >> (bits - p) << (bits - p), p)
+            if c in ips:
+                return c
+        return None
+
+    def within(ip_type, network, prefix):
+        if len(index) == 0:
+            import snapshot
+            index.extend(sorted(snapshot.network_key(c) + (c,) for c in ips))
+        last = network + (1 << (cidr.BITS[ip_type] - prefix)) - 1
+        found = []
+        for entry in index[bisect.bisect_left(index, (ip_type, network)):]:
+            if entry[0] != ip_type or entry[1] > last:
+                break
+            if entry[3] in ips:
+                found.append(entry[3])
+        return found
+
+    def insert(ip_type, c, c_type):
+        ips[c] = [c_type, c, shard_index(c, shard_count)]
+        touched.add(c)
+        if len(index) > 0:
+            bisect.insort(index, (ip_type,) + cidr.parse(c)[1:] + (c,))
+
+    def remove(c):
+        del ips[c]
+        touched.add(c)
+
+    for value, ip_type in patch['remove']['ips'].items():
+        for c in cidr.aggregate({value: ip_type}, widen_prefixes()):
+            c_type, network, prefix = cidr.parse(c)
+            wider = covering(c_type, network, prefix)
+            if wider is None:
+                for contained in within(c_type, network, prefix):
+                    remove(contained)
+                continue
+
+            # keep what the wider descriptor blocks around the removed block
+            stored_type = ips[wider][0]
+            remove(wider)
+            w_type, w_network, w_prefix = cidr.parse(wider)
+            for n, p in cidr.subtract_interval(w_type, w_network, w_prefix, network, network + (1 << (cidr.BITS[c_type] - prefix)) - 1):
+                insert(w_type, cidr.format_network(w_type, n, p), stored_type)
+
+    for value, ip_type in patch['add']['ips'].items():
+        for c, c_type in cidr.aggregate({value: ip_type}, widen_prefixes()).items():
+            ip_type_c, network, prefix = cidr.parse(c)
+            if covering(ip_type_c, network, prefix) is not None:
+                continue
+            for contained in within(ip_type_c, network, prefix):
+                remove(contained)
+            insert(ip_type_c, c, c_type)
+
+    # net changes only: a descriptor removed and added again stays as it is
+    for c in sorted(touched):
+        before, after = waf_state['ips'].get(c), ips.get(c)
+        if before is not None and after is not None:
+            ips[c] = before
+        elif before is not None:
+            updates["ips"].setdefault(ip_shard(before), []).append(ip_update('DELETE', before[0], before[1]))
+        elif after is not None:
+            updates["ips"].setdefault(after[2], []).append(ip_update('INSERT', after[0], c))
+
+    return updates, sorted(countries), ips
+
+def patch_target(target, state, object_key, patch):
+    # Applies one patch on top of the cached state. Returns {'resync': reason}
+    # when the patch cannot be applied safely and the target needs a full
+    # sync from its full-state file first.
+    logging.getLogger().debug("patch_target - Start")
+
+    s3_client = get_client('s3')
+    waf_client = get_client(target['api_type'], target['region'])
+    geo_match_set_id = target['geo_match_set_id']
+    ip_set_ids = target['ip_set_ids']
+    state_key = sync_state.state_key(geo_match_set_id, target['ip_set_id'])
+    waf_state = cached_waf_state(state, ip_set_ids)
+
+    if waf_state is None:
+        return {'resync': 'no fresh state cache'}
+    if state.get('version') != patch['base-version']:
+        return {'resync': 'base version %s, synced version %s'%(patch['base-version'], state.get('version'))}
+
+    sequence = state.get('sequence', 0)
+    if patch['sequence'] <= sequence:
+        logging.getLogger().info("patch_target - %s: %s (sequence %d) already applied"%(target_name(target), object_key, patch['sequence']))
+        return {'skipped': 'sequence'}
+    if patch['sequence'] != sequence + 1:
+        return {'resync': 'sequence gap: %d after %d'%(patch['sequence'], sequence)}
+
+    updates, countries, ips = compute_patch_updates(patch, waf_state)
+
+    try:
+        report = apply_waf_updates(waf_client, geo_match_set_id, ip_set_ids, updates)
+
+    except Exception as error:
+        # WAF may hold a partially applied change set: drop the cache
+        state.pop('waf', None)
+        state.pop('digest', None)
+        sync_state.save_state(s3_client, state_bucket(), state_key, state)
+        if error_code(error) in STALE_STATE_ERRORS:
+            return {'resync': 'stale state cache (%s)'%str(error)}
+        raise
+
+    # the set no longer matches the full-state file: no ETag or digest skip
+    state.update({
+        'etag': None,
+        'digest': None,
+        'sequence': patch['sequence'],
+        'waf': {
+            'countries': countries,
+            'ips': ips,
+            'ip_set_ids': ip_set_ids,
+            'change_token': report["ips"].get('change_token') or report["countries"].get('change_token') or waf_state.get('change_token'),
+            'verified_at': waf_state['verified_at']
+        }
+    })
+    sync_state.save_state(s3_client, state_bucket(), state_key, state)
+
+    report['state'] = 'cache'
+    logging.getLogger().info("patch_target - %s: %s (sequence %d) countries: %s, ips: %s"%(target_name(target), object_key, patch['sequence'], report["countries"], report["ips"]))
+    logging.getLogger().debug("patch_target - End")
+    return report
+
+def read_patch(s3_client, bucket_name, object_key):
+    response = s3_client.get_object(Bucket = bucket_name, Key = object_key)
+    try:
+        return read_embargo_patch(response['Body'])
+    finally:
+        response['Body'].close()
+
+@metrics.timed
+def read_patch_chain(s3_client, bucket_name, patch):
+    # {sequence: (object_key, patch)} of the patches under PATCH_PREFIX that
+    # come before patch in its chain (same base version)
+    object_keys = [o['Key'] for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket = bucket_name, Prefix = PATCH_PREFIX) for o in page.get('Contents', [])]
+    max_workers = max(1, min(int(environ.get('MAX_CONCURRENCY', DEFAULT_MAX_CONCURRENCY)), len(object_keys)))
+    with ThreadPoolExecutor(max_workers = max_workers) as pool:
+        patches = list(pool.map(lambda object_key: read_patch(s3_client, bucket_name, object_key), object_keys))
+
+    chain = {}
+    for object_key, p in zip(object_keys, patches):
+        if p['base-version'] == patch['base-version'] and p['sequence'] < patch['sequence']:
+            chain[p['sequence']] = (object_key, p)
+    return chain
+
+def replay_patch(target, state, object_key, patch, chain):
+    # Applies the patches of chain the state has not applied yet, then
+    # patch. Any patch that cannot be applied as-is fails the target:
+    # skipping it would drop embargo entries from WAF.
+    for sequence in range(state.get('sequence', 0) + 1, patch['sequence']):
+        chain_key, chain_patch = chain[sequence]
+        report = patch_target(target, state, chain_key, chain_patch)
+        if 'resync' in report:
+            raise Exception('%s (sequence %d): %s'%(chain_key, sequence, report['resync']))
+
+    report = patch_target(target, state, object_key, patch)
+    if 'resync' in report:
+        raise Exception(report['resync'])
+    return report
+
+def apply_patch(targets, bucket_name, object_key):
+    logging.getLogger().debug("apply_patch - Start")
+
+    s3_client = get_client('s3')
+    with metrics.phase('read_embargo_patch'):
+        patch = read_patch(s3_client, bucket_name, object_key)
+
+    states = {}
+    for target, state, error in fan_out(load_target_state, targets):
+        states[target_name(target)] = state or {}
+
+    def run(target):
+        return patch_target(target, states[target_name(target)], object_key, patch)
+    run.__name__ = 'patch_target'
+
+    results = {}
+    resync = []
+    with metrics.phase('patch_targets'):
+        patched = fan_out(run, targets)
+    for target, report, error in patched:
+        if error is not None:
+            results[target_name(target)] = {'target': target_name(target), 'status': 'failed', 'error': str(error)}
+        elif 'resync' in report:
+            logging.getLogger().warning("apply_patch - %s: %s, full sync first"%(target_name(target), report['resync']))
+            resync.append(target)
+        elif 'skipped' in report:
+            results[target_name(target)] = {'target': target_name(target), 'status': 'skipped', 'reason': report['skipped']}
+        else:
+            results[target_name(target)] = {'target': target_name(target), 'status': 'success', 'updates': report}
+
+    #--------------------------------------------------------------------------
+    # Gaps, base mismatches and stale caches: full sync from the full-state
+    # file each target last synced from, replay the earlier patches of the
+    # chain, then apply the patch. A chain with missing patches leaves the
+    # target as it is and fails it.
+    #--------------------------------------------------------------------------
+    chain = {}
+    if len(resync) > 0 and patch['sequence'] > 1:
+        chain = read_patch_chain(s3_client, bucket_name, patch)
+    missing = [sequence for sequence in range(1, patch['sequence']) if sequence not in chain]
+
+    sources = {}
+    for target in resync:
+        source = states[target_name(target)].get('source')
+        version = states[target_name(target)].get('version')
+        if source is None:
+            results[target_name(target)] = {'target': target_name(target), 'status': 'failed', 'error': 'no full-state file to resync from'}
+        elif version == patch['base-version'] and len(missing) > 0:
+            results[target_name(target)] = {'target': target_name(target), 'status': 'failed', 'error': 'patch sequences %s missing'%', '.join(str(m) for m in missing)}
+        else:
+            sources.setdefault(source, []).append(target)
+
+    for source, source_targets in sources.items():
+        if source == SOURCES_PREFIX:
+            full = update_merged(source_targets, bucket_name, [])
+        else:
+            full = update_conditions(source_targets, bucket_name, source)
+        for target, full_result in zip(source_targets, full['targets']):
+            name = target_name(target)
+            if full_result['status'] == 'failed':
+                results[name] = full_result
+                continue
+
+            try:
+                state = load_target_state(target)
+                if state.get('version') != patch['base-version']:
+                    # the full-state file was replaced: this chain is obsolete
+                    results[name] = {'target': name, 'status': 'skipped', 'source': source, 'reason': 'base version %s, synced version %s'%(patch['base-version'], state.get('version'))}
+                    continue
+                if len(missing) > 0:
+                    raise Exception('patch sequences %s missing'%', '.join(str(m) for m in missing))
+                report = replay_patch(target, state, object_key, patch, chain)
+            except Exception as error:
+                logging.getLogger().error("patch_target - %s failed: %s"%(name, str(error)))
+                results[name] = {'target': name, 'status': 'failed', 'error': str(error)}
+                continue
+
+            if 'skipped' in report:
+                results[name] = {'target': name, 'status': 'skipped', 'source': source, 'reason': report['skipped']}
+            else:
+                results[name] = {'target': name, 'status': 'success', 'source': source, 'updates': report}
+
+    report = {'base-version': patch['base-version'], 'sequence': patch['sequence'], 'targets': [results[target_name(t)] for t in targets]}
+    report['failed'] = len([r for r in report['targets'] if r['status'] == 'failed'])
+    logging.getLogger().info("apply_patch - %d targets, %d resynced, %d failed"%(len(targets), len(resync), report['failed']))
+    logging.getLogger().debug("apply_patch - End")
+    return report
+
+def plan_waf_state(json_embargoed_countries, json_embargoed_ips, state_digest, state, waf_state, state_source, details=True, timings=None):
+    # change_plan.plan_updates of a sync from waf_state; an unchanged digest
+    # means the same empty plan sync_target would skip to
+    import change_plan
+    waf_state = dict(waf_state, ip_set_ids = waf_state.get('ip_set_ids', [None]))
+    if state_source == 'cache' and state.get('digest') == state_digest:
+        updates = {"countries": [], "ips": {}}
+    elif not isinstance(json_embargoed_ips, dict):
+        updates, ips = compute_snapshot_updates(json_embargoed_countries, json_embargoed_ips, waf_state)
+    else:
+        updates = compute_updates(json_embargoed_countries, json_embargoed_ips, waf_state)
+    return change_plan.plan_updates(updates, state_source, waf_state['ip_set_ids'], details, timings)
+
+@metrics.timed
+def plan_target(target, json_embargoed_countries, json_embargoed_ips, state_digest, live=False, details=True, timings=None):
+    # Read only: WAF is read when the cache is not fresh (or live is set),
+    # nothing is written to WAF or to the sync state.
+    state = load_target_state(target) or {}
+    waf_state = None if live else cached_waf_state(state, target['ip_set_ids'])
+    state_source = 'cache'
+    if waf_state is None:
+        waf_state = read_waf_state(get_client(target['api_type'], target['region']), target['geo_match_set_id'], target['ip_set_ids'])
+        state_source = 'waf'
+    return plan_waf_state(json_embargoed_countries, json_embargoed_ips, state_digest, state, waf_state, state_source, details, timings)
+
+def plan_sync(targets, json_embargoed_countries, json_embargoed_ips, state_digest, live=False, details=True, timings=None):
+    report = {'targets': []}
+    for target, target_plan, error in fan_out(plan_target, targets, json_embargoed_countries, json_embargoed_ips, state_digest, live, details, timings):
+        if error is not None:
+            report['targets'].append({'target': target_name(target), 'status': 'failed', 'error': str(error)})
+        else:
+            target_plan.update({'target': target_name(target), 'status': 'success'})
+            report['targets'].append(target_plan)
+
+    report['failed'] = len([r for r in report['targets'] if r['status'] == 'failed'])
+    return report
+
+def plan(targets, bucket_name, object_key, live=False, details=False, timings=None):
+    # Change plan of s3://bucket_name/object_key for every target
+    s3_client = get_client('s3')
+    etag = s3_client.head_object(Bucket = bucket_name, Key = object_key)['ETag']
+    json_embargoed_countries, json_embargoed_ips, version, state_digest = read_full_state(s3_client, bucket_name, object_key, etag)
+    report = plan_sync(targets, json_embargoed_countries, json_embargoed_ips, state_digest, live, details, timings)
+    report['candidate'] = {'object': 's3://%s/%s'%(bucket_name, object_key), 'etag': etag, 'version': version, 'digest': state_digest}
+    return report
+
+@metrics.timed
+def reconcile_target(target):
+    # Compares the state cache with live WAF, reports the drift and refreshes
+    # the cache from WAF. Nothing is written to WAF.
+    logging.getLogger().debug("reconcile_target - Start")
+
+    s3_client = get_client('s3')
+    waf_client = get_client(target['api_type'], target['region'])
+
+    state_key = sync_state.state_key(target['geo_match_set_id'], target['ip_set_id'])
+    state = sync_state.load_state(s3_client, state_bucket(), state_key)
+    live = read_waf_state(waf_client, target['geo_match_set_id'], target['ip_set_ids'])
+
+    report = {'cache': 'missing'}
+    cached = state.get('waf')
+    if cached is not None:
+        drift = {
+            'countries': {
+                'missing': sorted(set(cached['countries']) - set(live['countries'])),
+                'unexpected': sorted(set(live['countries']) - set(cached['countries']))
+            },
+            'ips': {
+                'missing': sorted(set(cached['ips']) - set(live['ips'])),
+                'unexpected': sorted(set(live['ips']) - set(cached['ips']))
+            }
+        }
+        in_sync = not any(drift[k][d] for k in drift for d in drift[k])
+        report = {'cache': 'in-sync' if in_sync else 'drifted', 'drift': drift}
+        if not in_sync:
+            logging.getLogger().warning("reconcile_target - %s: drift between state cache and WAF: %s"%(target_name(target), json.dumps(drift)))
+
+    live['change_token'] = cached.get('change_token') if cached else None
+    state['waf'] = live
+    sync_state.save_state(s3_client, state_bucket(), state_key, state)
+
+    logging.getLogger().debug("reconcile_target - End")
+    return report
+
+def reconcile(targets):
+    report = {'targets': []}
+    for target, result, error in fan_out(reconcile_target, targets):
+        if error is not None:
+            report['targets'].append({'target': target_name(target), 'status': 'failed', 'error': str(error)})
+        else:
+            result.update({'target': target_name(target), 'status': 'success'})
+            report['targets'].append(result)
+
+    report['failed'] = len([r for r in report['targets'] if r['status'] == 'failed'])
+    return report
+
+def resync_target_patches(target, bucket_name, state):
+    # Replays the patches a target had applied on top of its full-state
+    # file, once the full sync reset them
+    if state.get('sequence', 0) == 0:
+        return None
+
+    s3_client = get_client('s3')
+    chain = read_patch_chain(s3_client, bucket_name, {'base-version': state.get('version'), 'sequence': state['sequence'] + 1})
+    missing = [sequence for sequence in range(1, state['sequence'] + 1) if sequence not in chain]
+    if len(missing) > 0:
+        raise Exception('patch sequences %s missing'%', '.join(str(m) for m in missing))
+
+    object_key, patch = chain[state['sequence']]
+    return replay_patch(target, load_target_state(target), object_key, patch, chain)
+
+def resync(targets, bucket_name, object_key):
+    # Full sync of every target from the source it last synced from
+    # (object_key for targets that never synced), e.g. once its IP sets
+    # changed; the patches it had applied since are replayed
+    logging.getLogger().debug("resync - Start")
+
+    states = {}
+    sources = {}
+    for target, state, error in fan_out(load_target_state, targets):
+        states[target_name(target)] = state or {}
+        sources.setdefault(states[target_name(target)].get('source') or object_key, []).append(target)
+
+    reports = []
+    for source in sorted(sources):
+        if source == SOURCES_PREFIX:
+            report = update_merged(sources[source], bucket_name, [])
+        else:
+            report = update_conditions(sources[source], bucket_name, source)
+
+        for target, result in zip(sources[source], report['targets']):
+            if result['status'] == 'failed':
+                continue
+            try:
+                patched = resync_target_patches(target, bucket_name, states[target_name(target)])
+            except Exception as error:
+                logging.getLogger().error("resync - %s: unable to replay its patches: %s"%(target_name(target), str(error)))
+                result.update({'status': 'failed', 'error': str(error)})
+                continue
+            if patched is not None:
+                result['patches'] = patched
+
+        report['failed'] = len([r for r in report['targets'] if r['status'] == 'failed'])
+        report['object'] = 's3://%s/%s'%(bucket_name, source)
+        reports.append(report)
+
+    logging.getLogger().debug("resync - End")
+    return {'jobs': reports, 'failed': sum(r['failed'] for r in reports)}
+
+def sync_records(targets, records):
+    # One report per coalesced job: the latest full-state file, the changed
+    # feeds (merged in one job) and the later patches of every bucket in the
+    # records
+    jobs = ingest.coalesce(records, PATCH_PREFIX, SOURCES_PREFIX)
+    logging.getLogger().info("sync_records - %d records coalesced into %d jobs"%(len(records), len(jobs)))
+    metrics.count('Records', len(records))
+    metrics.count('Jobs', len(jobs))
+
+    reports = []
+    for (bucket_name, is_source), group in groupby(jobs, lambda job: (job[0], job[1].startswith(SOURCES_PREFIX))):
+        object_keys = [object_key for b, object_key in group]
+        if is_source:
+            report = update_merged(targets, bucket_name, object_keys)
+            report['object'] = 's3://%s/%s'%(bucket_name, SOURCES_PREFIX)
+            reports.append(report)
+            continue
+
+        for object_key in object_keys:
+            if object_key.startswith(PATCH_PREFIX):
+                report = apply_patch(targets, bucket_name, object_key)
+            else:
+                report = update_conditions(targets, bucket_name, object_key)
+            report['object'] = 's3://%s/%s'%(bucket_name, object_key)
+            reports.append(report)
+    return reports
 
 def lambda_handler(event, context):
     result = {
@@ -95,6 +1046,7 @@ def lambda_handler(event, context):
         'body':  {'message': 'success'}
     }
 
+    metrics.start('embargoed-countries-parser')
     try:
         #------------------------------------------------------------------
         # Set Log Level
@@ -109,22 +1061,61 @@ def lambda_handler(event, context):
         # Read inputs parameters
         #----------------------------------------------------------
         logging.getLogger().info(event)
-        geo_match_set_id = environ['GEO_MATCH_SET_ID']
-        ip_set_id = environ['IP_SET_ID']
-        bucket_name = event['Records'][0]['s3']['bucket']['name']
-        object_key =  event['Records'][0]['s3']['object']['key']
+        targets = load_targets()
+
+        #----------------------------------------------------------
+        # Drift report between the state cache and WAF
+        #----------------------------------------------------------
+        if event.get('action') == 'reconcile':
+            report = reconcile(targets)
+            result['body']['reconcile'] = report
+
+        #----------------------------------------------------------
+        # Change plan of a candidate file, nothing is written
+        #----------------------------------------------------------
+        elif event.get('action') == 'plan':
+            report = plan(targets, event.get('bucket', environ['STATE_BUCKET']), event['key'], event.get('live', False), event.get('details', False), event.get('timings'))
+            result['body']['plan'] = report
 
         #----------------------------------------------------------
-        # Process file
+        # Full sync from the last synced sources, e.g. once the IP
+        # sets of the targets changed
         #----------------------------------------------------------
-        update_conditions(geo_match_set_id, ip_set_id, bucket_name, object_key)
+        elif event.get('action') == 'resync':
+            report = resync(targets, event.get('bucket', environ['STATE_BUCKET']), event['key'])
+            result['body']['resync'] = report
+
+        else:
+            #----------------------------------------------------------
+            # Process files; the function's reserved concurrency of 1
+            # keeps a single sync running
+            #----------------------------------------------------------
+            records = ingest.collect_records(event)
+            reports = sync_records(targets, records)
+            report = {'jobs': reports, 'failed': sum(r['failed'] for r in reports)}
+            result['body']['updates'] = report
 
-        return json.dumps(result)
+        metrics.count('FailedTargets', report['failed'])
+        if report['failed'] > 0:
+            result['statusCode'] = '500'
+            result['body']['message'] = '%d of %d targets failed'%(report['failed'], len(targets))
 
     except Exception as error:
+        logging.getLogger().error(str(error))
         result = {
             'statusCode': '500',
-            'body':  {'message': error.message}
+            'body':  {'message': str(error)}
         }
 
+    finally:
+        metrics.flush()
+
+    #------------------------------------------------------------------
+    # SQS batches: on failure every message goes back to the queue
+    #------------------------------------------------------------------
+    if any(r.get('eventSource') == 'aws:sqs' for r in event.get('Records', [])):
+        logging.getLogger().info(result)
+        failed = result['statusCode'] != '200'
+        return {'batchItemFailures': [{'itemIdentifier': r['messageId']} for r in event['Records'] if failed]}
+
     return json.dumps(result)
@@ -0,0 +1,272 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.   #
+#                                                                            #
+#  Licensed under the Amazon Software License (the "License"). You may not   #
+#  use this file except in compliance with the License. A copy of the        #
+#  License is located at                                                     #
+#                                                                            #
+#      http://aws.amazon.com/asl/                                            #
+#                                                                            #
+#  or in the "license" file accompanying this file. This file is distributed #
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,        #
+#  express or implied. See the License for the specific language governing   #
+#  permissions and limitations under the License.                            #
+##############################################################################
+
+#------------------------------------------------------------------------------
+# Merge of several embargo feeds into the effective embargo set. Every feed
+# has a priority and an effect: 'deny' embargoes what it lists, 'allow'
+# exempts it. Each country and address is decided by the feed with the
+# highest priority that lists it; at equal priority deny wins.
+#
+# A feed's contribution is kept as sorted address intervals. The effective
+# set is kept as intervals labelled with the feed that decided them, plus the
+# WAF descriptors they convert to. When a feed changes, only its delta (what
+# it added or dropped) is decided again, against what the other feeds list
+# within the delta, and only the descriptors around the delta are rebuilt.
+#------------------------------------------------------------------------------
+
+import bisect
+import heapq
+import cidr
+
+DENY = 'deny'
+ALLOW = 'allow'
+# precedence at equal priority, lowest first
+EFFECTS = [ALLOW, DENY]
+FAMILIES = [cidr.IPV4, cidr.IPV6]
+
+def contribution(name, etag, countries, ips, priority=0, effect=DENY):
+    # ips: {canonical value: type}, as from cidr.aggregate
+    if effect not in EFFECTS:
+        raise ValueError("Embargo source %s: effect must be one of %s"%(name, ', '.join(EFFECTS)))
+    if not isinstance(priority, int) or isinstance(priority, bool):
+        raise ValueError("Embargo source %s: priority must be an integer"%name)
+
+    intervals = dict((family, []) for family in FAMILIES)
+    for value in ips:
+        ip_type, network, prefix = cidr.parse(value)
+        intervals[ip_type].append((network, network + (1 << (cidr.BITS[ip_type] - prefix)) - 1))
+
+    return {
+        'name': name,
+        'etag': etag,
+        'priority': priority,
+        'effect': effect,
+        'countries': sorted(set(countries)),
+        'ips': dict((family, cidr.merge_intervals(sorted(intervals[family]))) for family in FAMILIES)
+    }
+
+def empty():
+    # effective set of no feed
+    return {'sources': {}, 'countries': {}, 'ips': dict((family, []) for family in FAMILIES), 'descriptors': {}}
+
+def rank(source):
+    # the feed ranked last among those listing a value decides it
+    return (source['priority'], EFFECTS.index(source['effect']), source['name'])
+
+#------------------------------------------------------------------------------
+# Sorted, disjoint [first, last, ...] interval lists (extra items are labels)
+#------------------------------------------------------------------------------
+def window(intervals, first, last):
+    # the parts of intervals within [first, last]
+    index = bisect.bisect_left(intervals, [first])
+    if index > 0 and intervals[index - 1][1] >= first:
+        index -= 1
+
+    parts = []
+    while index < len(intervals) and intervals[index][0] <= last:
+        interval = intervals[index]
+        parts.append([max(interval[0], first), min(interval[1], last)] + interval[2:])
+        index += 1
+    return parts
+
+def difference(a, b):
+    # a without b, in one pass over both
+    result = []
+    j = 0
+    for interval in a:
+        first, last = interval[0], interval[1]
+        while j < len(b) and b[j][1] < first:
+            j += 1
+
+        k = j
+        while k < len(b) and b[k][0] <= last and first <= last:
+            if b[k][0] > first:
+                result.append([first, b[k][0] - 1] + interval[2:])
+            first = max(first, b[k][1] + 1)
+            k += 1
+
+        if first <= last:
+            result.append([first, last] + interval[2:])
+    return result
+
+def _append(intervals, interval):
+    # joined with the last interval when adjacent and equally labelled
+    if intervals and intervals[-1][1] + 1 == interval[0] and intervals[-1][2:] == interval[2:]:
+        intervals[-1] = [intervals[-1][0], interval[1]] + interval[2:]
+    else:
+        intervals.append(interval)
+
+def replace(intervals, region, pieces):
+    # intervals outside region, plus pieces (which lie within region). The
+    # runs between the region's intervals are copied as slices.
+    intervals = list(intervals)
+    result = []
+    index = 0
+    piece = 0
+    for first, last in region:
+        start = bisect.bisect_left(intervals, [first], index)
+        if start > index and intervals[start - 1][1] >= first:
+            start -= 1
+        if start > index:
+            _append(result, intervals[index])
+            result.extend(intervals[index + 1:start])
+        index = start
+
+        while index < len(intervals) and intervals[index][0] <= last:
+            interval = intervals[index]
+            if interval[0] < first:
+                _append(result, [interval[0], first - 1] + interval[2:])
+            if interval[1] > last:
+                # the tail is kept, and may reach into the next region
+                intervals[index] = [last + 1, interval[1]] + interval[2:]
+                break
+            index += 1
+
+        while piece < len(pieces) and pieces[piece][0] <= last:
+            _append(result, pieces[piece])
+            piece += 1
+
+    if index < len(intervals):
+        _append(result, intervals[index])
+        result.extend(intervals[index + 1:])
+    return result
+
+def runs(intervals, region):
+    # [first, last] of the runs of adjacent intervals (labels ignored) that
+    # overlap or touch region: the ranges whose descriptors depend on it
+    result = []
+    for first, last in region:
+        index = bisect.bisect_left(intervals, [first])
+        if index > 0 and intervals[index - 1][1] + 1 >= first:
+            index -= 1
+        end = index
+        while end < len(intervals) and intervals[end][0] <= last + 1:
+            end += 1
+        if end == index:
+            continue
+
+        while index > 0 and intervals[index - 1][1] + 1 == intervals[index][0]:
+            index -= 1
+        while end < len(intervals) and intervals[end - 1][1] + 1 == intervals[end][0]:
+            end += 1
+
+        for interval in intervals[index:end]:
+            if result and result[-1][1] + 1 >= interval[0]:
+                result[-1][1] = max(result[-1][1], interval[1])
+            else:
+                result.append([interval[0], interval[1]])
+    return result
+
+def descriptors(family, ranges, widen=False):
+    # {canonical value: type} of the supported blocks covering ranges
+    covered = {}
+    for first, last in ranges:
+        for network, prefix in cidr.cover_interval(family, first, last, widen):
+            covered[cidr.format_network(family, network, prefix)] = family
+    return covered
+
+#------------------------------------------------------------------------------
+# Decisions
+#------------------------------------------------------------------------------
+def decide(region, sources, family):
+    # Denied parts of region, labelled with the deciding feed. Sweep over
+    # the sources' parts within region, with a heap of the covering ones
+    # by rank: O(k log k) for k parts, whatever the size of the sources.
+    sources = sorted(sources, key = rank)
+    parts = []
+    for level, source in enumerate(sources):
+        for first, last in region:
+            for part in window(source['ips'][family], first, last):
+                parts.append((part[0], part[1], level))
+    parts.sort()
+
+    bounds = sorted(set([p[0] for p in parts] + [p[1] + 1 for p in parts]))
+    covering = []
+    decided = []
+    index = 0
+    for position, following in zip(bounds, bounds[1:]):
+        while index < len(parts) and parts[index][0] == position:
+            heapq.heappush(covering, (-parts[index][2], parts[index][1]))
+            index += 1
+        while covering and covering[0][1] < position:
+            heapq.heappop(covering)
+
+        if covering:
+            source = sources[-covering[0][0]]
+            if source['effect'] == DENY:
+                _append(decided, [position, following - 1, source['name']])
+    return decided
+
+def decide_country(code, sources):
+    # deciding feed of a country, or None when it is not embargoed
+    listing = [s for s in sources if code in s['countries']]
+    if not listing:
+        return None
+    source = max(listing, key = rank)
+    return source['name'] if source['effect'] == DENY else None
+
+def apply_change(merged, old, new, others, widen=False):
+    # Updates the effective set merged (see empty) in place for one feed
+    # changing from old to new, either being None when the feed is added or
+    # removed. others: contributions of the other merged feeds. Returns the
+    # size of the delta that was decided again. widen: see cidr.cover_interval.
+    none = {'countries': [], 'ips': dict((family, []) for family in FAMILIES)}
+    before, after = old or none, new or none
+    sources = list(others) + ([new] if new is not None else [])
+    # a feed whose priority or effect changed is decided again as a whole
+    reranked = old is None or new is None or rank(old) != rank(new)
+
+    if reranked:
+        countries = set(before['countries']) | set(after['countries'])
+    else:
+        countries = set(before['countries']) ^ set(after['countries'])
+    for code in countries:
+        name = decide_country(code, sources)
+        if name is None:
+            merged['countries'].pop(code, None)
+        else:
+            merged['countries'][code] = name
+
+    delta = {'countries': len(countries), 'intervals': 0}
+    for family in FAMILIES:
+        if reranked:
+            region = cidr.merge_intervals(sorted(before['ips'][family] + after['ips'][family]))
+        else:
+            region = cidr.merge_intervals(sorted(difference(before['ips'][family], after['ips'][family]) + difference(after['ips'][family], before['ips'][family])))
+        if not region:
+            continue
+
+        removed = descriptors(family, runs(merged['ips'][family], region), widen)
+        merged['ips'][family] = replace(merged['ips'][family], region, decide(region, sources, family))
+        added = descriptors(family, runs(merged['ips'][family], region), widen)
+        for value in removed:
+            merged['descriptors'].pop(value, None)
+        merged['descriptors'].update(added)
+        delta['intervals'] += len(region)
+
+    if new is None:
+        merged['sources'].pop(old['name'], None)
+    else:
+        merged['sources'][new['name']] = {'etag': new['etag'], 'priority': new['priority'], 'effect': new['effect']}
+    return delta
+
+def rebuild(contributions, widen=False):
+    # effective set of contributions, merged one at a time from scratch
+    merged = empty()
+    for index, source in enumerate(contributions):
+        apply_change(merged, None, source, contributions[:index], widen)
+    return merged
@@ -0,0 +1,223 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.   #
+#                                                                            #
+#  Licensed under the Amazon Software License (the "License"). You may not   #
+#  use this file except in compliance with the License. A copy of the        #
+#  License is located at                                                     #
+#                                                                            #
+#      http://aws.amazon.com/asl/                                            #
+#                                                                            #
+#  or in the "license" file accompanying this file. This file is distributed #
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,        #
+#  express or implied. See the License for the specific language governing   #
+#  permissions and limitations under the License.                            #
+##############################################################################
+
+#------------------------------------------------------------------------------
+# Compact binary form of an embargo file (.embs), for lists too large to parse
+# as JSON on every sync. Converted offline from the JSON form:
+#
+#   python snapshot.py embargoed-countries.json embargoed-countries.embs
+#
+# Layout (little endian, sections padded to 8 bytes):
+#   header      magic 'EMBS', format version (u16), reserved (u16),
+#               IPv4 count, IPv6 count, version length, crc32 of the rest (u32)
+#   countries   bitmap of the two letter codes AA..ZZ (676 bits)
+#   IPv4        networks (u32[]), then prefix lengths (u8[])
+#   IPv6        high and low 64 bits of the networks (u64[], u64[]), then
+#               prefix lengths (u8[])
+#   version     the document 'version' (utf-8), if any
+# Descriptors are aggregated (cidr.aggregate) and sorted by network, so a
+# reader walks the arrays in place and diffs them against a sorted list with
+# a single merge pass.
+#------------------------------------------------------------------------------
+
+import cidr
+import hashlib
+import mmap
+import os
+import struct
+import socket
+import sys
+import zlib
+from array import array
+
+if __name__ == '__main__':
+    # run from the source tree: lib/ is only merged in when packaging
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from sync_state import SNAPSHOT_SUFFIX as SUFFIX
+
+MAGIC = b'EMBS'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sHHIIII')
+COUNTRY_BITMAP_SIZE = 88
+
+def _padding(size):
+    return -size % 8
+
+def country_index(code):
+    if len(code) != 2 or not ('AA' <= code <= 'ZZ') or not code.isalpha():
+        raise ValueError("Country code '%s' is not two uppercase letters"%code)
+    return (ord(code[0]) - 65) * 26 + ord(code[1]) - 65
+
+def network_key(value):
+    # canonical value -> (type, network, prefix), the snapshot sort order;
+    # much faster than cidr.parse, but only valid for canonical values
+    address, prefix = value.split('/')
+    if ':' in address:
+        return cidr.IPV6, int.from_bytes(socket.inet_pton(socket.AF_INET6, address), 'big'), int(prefix)
+    return cidr.IPV4, int.from_bytes(socket.inet_aton(address), 'big'), int(prefix)
+
+def _array(view, offset, typecode, count):
+    # section of the buffer as an array of typecode items: a cast of the
+    # buffer itself on little endian hosts, a swapped copy elsewhere
+    size = array(typecode).itemsize * count
+    section = view[offset:offset + size]
+    if sys.byteorder == 'little':
+        return section.cast(typecode), offset + size
+    values = array(typecode)
+    values.frombytes(section)
+    values.byteswap()
+    return values, offset + size
+
+def _pack(typecode, values):
+    values = array(typecode, values)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    data = values.tobytes()
+    return data + b'\0' * _padding(len(data))
+
+class Snapshot(object):
+    # Read-only view over a snapshot held in any buffer (bytes from S3, an
+    # mmap of a local file). Nothing is copied on little endian hosts.
+    def __init__(self, buffer):
+        view = memoryview(buffer)
+        if len(view) < HEADER.size:
+            raise ValueError("Embargo snapshot too short")
+        magic, format_version, reserved, ipv4_count, ipv6_count, version_length, checksum = HEADER.unpack_from(view, 0)
+        if magic != MAGIC:
+            raise ValueError("Not an embargo snapshot")
+        if format_version != FORMAT_VERSION:
+            raise ValueError("Unsupported embargo snapshot format version %d"%format_version)
+        if zlib.crc32(view[HEADER.size:]) != checksum:
+            raise ValueError("Embargo snapshot checksum mismatch")
+        # the counts are outside the checksum: the sections must fill the buffer exactly
+        sections = [COUNTRY_BITMAP_SIZE, 4 * ipv4_count, ipv4_count, 16 * ipv6_count, ipv6_count]
+        if len(view) != HEADER.size + sum(size + _padding(size) for size in sections) + version_length:
+            raise ValueError("Embargo snapshot size does not match its header")
+
+        offset = HEADER.size
+        self._countries = view[offset:offset + COUNTRY_BITMAP_SIZE]
+        offset += COUNTRY_BITMAP_SIZE
+
+        self.ipv4_networks, offset = _array(view, offset, 'I', ipv4_count)
+        offset += _padding(offset)
+        self.ipv4_prefixes, offset = _array(view, offset, 'B', ipv4_count)
+        offset += _padding(offset)
+        self.ipv6_high, offset = _array(view, offset, 'Q', ipv6_count)
+        self.ipv6_low, offset = _array(view, offset, 'Q', ipv6_count)
+        self.ipv6_prefixes, offset = _array(view, offset, 'B', ipv6_count)
+        offset += _padding(offset)
+
+        # the version is left out of the digest: it names the content, it is not part of it
+        self.digest = hashlib.sha256(view[HEADER.size:offset]).hexdigest()
+        self.version = bytes(view[offset:offset + version_length]).decode('utf-8') if version_length > 0 else None
+
+    def __len__(self):
+        return len(self.ipv4_networks) + len(self.ipv6_high)
+
+    def countries(self):
+        codes = []
+        for i in range(26 * 26):
+            if self._countries[i >> 3] & (1 << (i & 7)):
+                codes.append(chr(65 + i // 26) + chr(65 + i % 26))
+        return codes
+
+    def entries(self):
+        # (type, network, prefix) in network_key order
+        for network, prefix in zip(self.ipv4_networks, self.ipv4_prefixes):
+            yield cidr.IPV4, network, prefix
+        for high, low, prefix in zip(self.ipv6_high, self.ipv6_low, self.ipv6_prefixes):
+            yield cidr.IPV6, high << 64 | low, prefix
+
+def load(buffer):
+    return Snapshot(buffer)
+
+def open_file(path):
+    # memory maps a local snapshot
+    with open(path, 'rb') as f:
+        return Snapshot(mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ))
+
+def build(countries, ips, version=None):
+    # countries: codes; ips: {canonical value: type} as from cidr.aggregate
+    bitmap = bytearray(COUNTRY_BITMAP_SIZE)
+    for code in set(countries):
+        i = country_index(code)
+        bitmap[i >> 3] |= 1 << (i & 7)
+
+    entries = sorted(network_key(value) for value in ips)
+    ipv4 = [e for e in entries if e[0] == cidr.IPV4]
+    ipv6 = [e for e in entries if e[0] == cidr.IPV6]
+    version_data = version.encode('utf-8') if version is not None else b''
+
+    body = b''.join([
+        bytes(bitmap),
+        _pack('I', [e[1] for e in ipv4]),
+        _pack('B', [e[2] for e in ipv4]),
+        _pack('Q', [e[1] >> 64 for e in ipv6]),
+        _pack('Q', [e[1] & 0xFFFFFFFFFFFFFFFF for e in ipv6]),
+        _pack('B', [e[2] for e in ipv6]),
+        version_data
+    ])
+    return HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(ipv4), len(ipv6), len(version_data), zlib.crc32(body)) + body
+
+def merge(current, entries):
+    # Merge pass over two ascending sequences: current holds (key, item)
+    # pairs, entries holds keys. Yields (item, None) for keys only in
+    # current, (None, key) for keys only in entries and (item, key) for
+    # keys in both.
+    current = iter(current)
+    head = next(current, None)
+    previous = None
+    for key in entries:
+        if previous is not None and key <= previous:
+            raise ValueError("Embargo snapshot entries are not sorted")
+        previous = key
+
+        while head is not None and head[0] < key:
+            yield head[1], None
+            head = next(current, None)
+        if head is not None and head[0] == key:
+            yield head[1], key
+            head = next(current, None)
+        else:
+            yield None, key
+
+    while head is not None:
+        yield head[1], None
+        head = next(current, None)
+
+def convert(json_path, snapshot_path, widen=False):
+    from embargo_file import read_embargo_file
+    metadata = {}
+    with open(json_path, 'rb') as f:
+        countries, ips = read_embargo_file(f, metadata = metadata)
+
+    data = build(countries, cidr.aggregate(ips, widen), metadata.get('version'))
+    with open(snapshot_path, 'wb') as f:
+        f.write(data)
+    return len(data)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description = 'Converts an embargoed countries JSON file into a binary snapshot (%s)'%SUFFIX)
+    parser.add_argument('json_path')
+    parser.add_argument('snapshot_path')
+    parser.add_argument('--widen', action = 'store_true', help = 'widen prefixes AWS WAF cannot express in a few descriptors instead of failing')
+    options = parser.parse_args()
+    size = convert(options.json_path, options.snapshot_path, options.widen)
+    snapshot = open_file(options.snapshot_path)
+    print('%s: %d countries, %d descriptors, %d bytes'%(options.snapshot_path, len(snapshot.countries()), len(snapshot), size))
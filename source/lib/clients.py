@@ -0,0 +1,64 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.   #
+#                                                                            #
+#  Licensed under the Amazon Software License (the "License"). You may not   #
+#  use this file except in compliance with the License. A copy of the        #
+#  License is located at                                                     #
+#                                                                            #
+#      http://aws.amazon.com/asl/                                            #
+#                                                                            #
+#  or in the "license" file accompanying this file. This file is distributed #
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,        #
+#  express or implied. See the License for the specific language governing   #
+#  permissions and limitations under the License.                            #
+##############################################################################
+
+import metrics
+import threading
+
+# Clients live at module level so warm Lambda invocations reuse them (and
+# their connection pools). boto3 is imported on first use only. Every client
+# reports its calls to metrics.
+MAX_POOL_CONNECTIONS = 32
+MAX_ATTEMPTS = 8
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 60
+
+_clients = {}
+_session = None
+_lock = threading.Lock()
+
+def _client_config():
+    from botocore.config import Config
+    return Config(
+        retries = {'mode': 'adaptive', 'max_attempts': MAX_ATTEMPTS},
+        max_pool_connections = MAX_POOL_CONNECTIONS,
+        connect_timeout = CONNECT_TIMEOUT,
+        read_timeout = READ_TIMEOUT
+    )
+
+def get_client(service_name, region_name=None):
+    # service_name: 's3', 'lambda', 'waf' or 'waf-regional'. Creating clients
+    # from one session is not thread safe, hence the lock around first use.
+    key = (service_name, region_name)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                global _session
+                if _session is None:
+                    import boto3.session
+                    _session = boto3.session.Session()
+                client = metrics.instrument(_session.client(service_name, region_name = region_name, config = _client_config()))
+                _clients[key] = client
+
+    return client
+
+def reset_clients():
+    global _session
+    with _lock:
+        _clients.clear()
+        _session = None
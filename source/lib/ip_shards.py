@@ -0,0 +1,39 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.   #
+#                                                                            #
+#  Licensed under the Amazon Software License (the "License"). You may not   #
+#  use this file except in compliance with the License. A copy of the        #
+#  License is located at                                                     #
+#                                                                            #
+#      http://aws.amazon.com/asl/                                            #
+#                                                                            #
+#  or in the "license" file accompanying this file. This file is distributed #
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,        #
+#  express or implied. See the License for the specific language governing   #
+#  permissions and limitations under the License.                            #
+##############################################################################
+
+#------------------------------------------------------------------------------
+# IP sets have a descriptor cap, so the descriptors of a target are spread
+# over several IP sets (shards). The parser places every descriptor with
+# shard_index; the custom resource uses it to move the descriptors of the
+# sets a lower shard count removes to where the next sync expects them.
+#------------------------------------------------------------------------------
+
+import zlib
+
+def shard_index(value, shard_count):
+    # Jump consistent hash of the crc32 of the canonical value (unlike
+    # hash(), stable across invocations): adding or removing the last shard
+    # only moves the descriptors that belong to it.
+    if shard_count <= 1:
+        return 0
+    key = zlib.crc32(value.encode('utf-8'))
+    shard, candidate = -1, 0
+    while candidate < shard_count:
+        shard = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((shard + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return shard
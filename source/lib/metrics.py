@@ -0,0 +1,241 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.   #
+#                                                                            #
+#  Licensed under the Amazon Software License (the "License"). You may not   #
+#  use this file except in compliance with the License. A copy of the        #
+#  License is located at                                                     #
+#                                                                            #
+#      http://aws.amazon.com/asl/                                            #
+#                                                                            #
+#  or in the "license" file accompanying this file. This file is distributed #
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,        #
+#  express or implied. See the License for the specific language governing   #
+#  permissions and limitations under the License.                            #
+##############################################################################
+
+#------------------------------------------------------------------------------
+# Per-invocation metrics written to stdout in CloudWatch Embedded Metric
+# Format: Lambda ships the lines to CloudWatch Logs, which extracts the
+# metrics, so no PutMetricData call is made. Collected:
+#   - phase durations (phase / timed)
+#   - count, latency, retries and payload bytes of every boto3 call, through
+#     botocore event hooks on the clients built by clients.get_client
+#   - throttled attempts, retried by botocore
+#   - counters set by the handlers (descriptors added / removed, ...)
+# Set PROFILE_SAMPLE_INTERVAL (seconds) to also sample the stacks of all
+# threads and log the hottest ones with the metrics.
+#------------------------------------------------------------------------------
+
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+from os import environ
+
+DEFAULT_NAMESPACE = 'EmbargoedCountries'
+# CloudWatch accepts at most 100 metrics per EMF document
+MAX_METRICS_PER_DOCUMENT = 100
+THROTTLE_ERRORS = ['Throttling', 'ThrottlingException', 'ThrottledException', 'RequestLimitExceeded', 'SlowDown', 'TooManyRequestsException']
+PROFILE_MAX_DEPTH = 40
+PROFILE_TOP_STACKS = 20
+
+class Sampler(threading.Thread):
+    # Records the collapsed stack ("file:function;file:function") of every
+    # other thread each interval seconds. Threads parked in a pool or lock
+    # wait are left out.
+    def __init__(self, interval):
+        threading.Thread.__init__(self, name = 'metrics-sampler')
+        self.daemon = True
+        self.interval = interval
+        self.samples = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.ident:
+                    continue
+                if os.path.basename(frame.f_code.co_filename) in ['threading.py', 'queue.py', 'thread.py']:
+                    continue
+
+                stack = []
+                while frame is not None and len(stack) < PROFILE_MAX_DEPTH:
+                    stack.append('%s:%s'%(os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+                    frame = frame.f_back
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.samples
+
+class Metrics(object):
+    def __init__(self, function_name):
+        self.function_name = function_name
+        self.started_at = time.time()
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.api_calls = {}
+        self.counters = {}
+        self.sampler = None
+
+    def add_phase(self, name, seconds):
+        with self.lock:
+            entry = self.phases.setdefault(name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    def add_count(self, name, value, unit):
+        with self.lock:
+            entry = self.counters.setdefault(name, [0, unit])
+            entry[0] += value
+
+    def add_api_call(self, operation, seconds, retries, error):
+        with self.lock:
+            entry = self.api_calls.setdefault(operation, {'Calls': 0, 'Time': 0.0, 'Retries': 0, 'Errors': 0})
+            entry['Calls'] += 1
+            entry['Time'] += seconds
+            entry['Retries'] += retries
+            entry['Errors'] += 1 if error else 0
+
+    def values(self):
+        # [(metric name, value, unit)]
+        with self.lock:
+            values = [('Duration', (time.time() - self.started_at) * 1000, 'Milliseconds')]
+            for name, (count, seconds) in sorted(self.phases.items()):
+                values.append(('Phase.%s'%name, seconds * 1000, 'Milliseconds'))
+            for operation, entry in sorted(self.api_calls.items()):
+                values.append(('%s.Calls'%operation, entry['Calls'], 'Count'))
+                values.append(('%s.Time'%operation, entry['Time'] * 1000, 'Milliseconds'))
+                if entry['Retries'] > 0:
+                    values.append(('%s.Retries'%operation, entry['Retries'], 'Count'))
+                if entry['Errors'] > 0:
+                    values.append(('%s.Errors'%operation, entry['Errors'], 'Count'))
+            for name, (value, unit) in sorted(self.counters.items()):
+                values.append((name, value, unit))
+            return values
+
+    def documents(self):
+        namespace = environ.get('METRICS_NAMESPACE', DEFAULT_NAMESPACE)
+        values = self.values()
+        documents = []
+        for i in range(0, len(values), MAX_METRICS_PER_DOCUMENT):
+            chunk = values[i:i + MAX_METRICS_PER_DOCUMENT]
+            document = {
+                '_aws': {
+                    'Timestamp': int(time.time() * 1000),
+                    'CloudWatchMetrics': [{
+                        'Namespace': namespace,
+                        'Dimensions': [['Function']],
+                        'Metrics': [{'Name': name, 'Unit': unit} for name, value, unit in chunk]
+                    }]
+                },
+                'Function': self.function_name
+            }
+            for name, value, unit in chunk:
+                document[name] = value
+            documents.append(document)
+        return documents
+
+_current = Metrics(None)
+
+def start(function_name):
+    # Starts a fresh collection for one invocation
+    global _current
+    stop_profiler()
+    _current = Metrics(environ.get('AWS_LAMBDA_FUNCTION_NAME', function_name))
+    interval = float(environ.get('PROFILE_SAMPLE_INTERVAL') or 0)
+    if interval > 0:
+        _current.sampler = Sampler(interval)
+        _current.sampler.start()
+    return _current
+
+def stop_profiler():
+    sampler, _current.sampler = _current.sampler, None
+    return sampler.stop() if sampler is not None else None
+
+def count(name, value=1, unit='Count'):
+    _current.add_count(name, value, unit)
+
+@contextmanager
+def phase(name):
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        _current.add_phase(name, time.time() - start_time)
+
+def timed(function):
+    # decorator: the whole call is a phase named after the function
+    @wraps(function)
+    def run(*args, **kwargs):
+        with phase(function.__name__):
+            return function(*args, **kwargs)
+    return run
+
+def flush(stream=None):
+    # Writes the EMF documents (and the profile, if sampling) as JSON lines
+    stream = stream or sys.stdout
+    samples = stop_profiler()
+    documents = _current.documents()
+    for document in documents:
+        stream.write(json.dumps(document) + '\n')
+
+    if samples is not None:
+        stream.write(json.dumps({'Profile': {
+            'Function': _current.function_name,
+            'Interval': float(environ.get('PROFILE_SAMPLE_INTERVAL') or 0),
+            'Samples': sum(samples.values()),
+            'Stacks': samples.most_common(PROFILE_TOP_STACKS)
+        }}) + '\n')
+
+    stream.flush()
+    return documents
+
+#------------------------------------------------------------------------------
+# botocore hooks
+#------------------------------------------------------------------------------
+def _operation(model):
+    return '%s.%s'%(model.service_model.service_name, model.name)
+
+def _before_call(model, context, **kwargs):
+    context['metrics_started_at'] = time.time()
+
+def _after_call(http_response, parsed, model, context, **kwargs):
+    started_at = context.get('metrics_started_at')
+    if started_at is None:
+        return
+
+    operation = _operation(model)
+    retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    error = parsed.get('Error', {}).get('Code')
+    _current.add_api_call(operation, time.time() - started_at, retries, error)
+
+    length = http_response.headers.get('content-length') if http_response is not None else None
+    if length is not None and length.isdigit():
+        _current.add_count('PayloadBytesIn', int(length), 'Bytes')
+
+def _before_send(request, **kwargs):
+    body = request.body
+    if isinstance(body, (bytes, str)):
+        _current.add_count('PayloadBytesOut', len(body), 'Bytes')
+
+def _needs_retry(response=None, **kwargs):
+    # registered first so that it sees every attempt; never decides anything
+    if response is not None and response[1].get('Error', {}).get('Code') in THROTTLE_ERRORS:
+        _current.add_count('Throttles', 1, 'Count')
+    return None
+
+def instrument(client):
+    events = client.meta.events
+    events.register('before-call', _before_call)
+    events.register('after-call', _after_call)
+    events.register('before-send', _before_send)
+    events.register_first('needs-retry', _needs_retry)
+    return client
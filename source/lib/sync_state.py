@@ -0,0 +1,82 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.   #
+#                                                                            #
+#  Licensed under the Amazon Software License (the "License"). You may not   #
+#  use this file except in compliance with the License. A copy of the        #
+#  License is located at                                                     #
+#                                                                            #
+#      http://aws.amazon.com/asl/                                            #
+#                                                                            #
+#  or in the "license" file accompanying this file. This file is distributed #
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,        #
+#  express or implied. See the License for the specific language governing   #
+#  permissions and limitations under the License.                            #
+##############################################################################
+
+import hashlib
+import json
+import logging
+
+# Sidecar objects live next to the embargo file. The prefix keeps them out of
+# the bucket notification filter (prefix = embargo file name).
+STATE_PREFIX = '.sync-state/'
+# Binary snapshots of the embargo file (the parser's snapshot.py) end with
+# this: the custom resource filters the bucket notifications on it and the
+# parser picks the format by it.
+SNAPSHOT_SUFFIX = '.embs'
+
+def state_key(geo_match_set_id, ip_set_id):
+    return '%s%s_%s.json'%(STATE_PREFIX, geo_match_set_id, ip_set_id)
+
+def teardown_key(request_id):
+    # progress marker of a custom resource request, see run_plan
+    return '%steardown/%s.json'%(STATE_PREFIX, request_id)
+
+def source_key(name):
+    # contribution of the feed sources/<name> to the merged embargo set
+    return '%ssources/%s'%(STATE_PREFIX, name)
+
+def merged_key():
+    # effective embargo set merged from every feed, see merge.py
+    return '%smerged.json'%STATE_PREFIX
+
+def digest(embargoed_countries, embargoed_ips):
+    # Digest of the normalised embargo state (sorted country codes and
+    # canonical descriptors), independent of file formatting and ordering.
+    h = hashlib.sha256()
+    h.update(json.dumps([sorted(set(embargoed_countries)), sorted(embargoed_ips.items())]).encode('utf-8'))
+    return h.hexdigest()
+
+def load_state(s3_client, bucket_name, key):
+    # The sidecar is only an optimisation: any failure reading it is a miss.
+    try:
+        response = s3_client.get_object(Bucket = bucket_name, Key = key)
+        try:
+            return json.loads(response['Body'].read().decode('utf-8'))
+        finally:
+            response['Body'].close()
+
+    except Exception as error:
+        logging.getLogger().info("load_state - no usable state in s3://%s/%s: %s"%(bucket_name, key, str(error)))
+        return {}
+
+def save_state(s3_client, bucket_name, key, state):
+    try:
+        s3_client.put_object(
+            Bucket = bucket_name,
+            Key = key,
+            Body = json.dumps(state).encode('utf-8'),
+            ContentType = 'application/json'
+        )
+
+    except Exception as error:
+        logging.getLogger().warning("save_state - unable to write s3://%s/%s: %s"%(bucket_name, key, str(error)))
+
+def delete_state(s3_client, bucket_name, key):
+    try:
+        s3_client.delete_object(Bucket = bucket_name, Key = key)
+
+    except Exception as error:
+        logging.getLogger().warning("delete_state - unable to delete s3://%s/%s: %s"%(bucket_name, key, str(error)))
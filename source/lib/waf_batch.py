@@ -0,0 +1,180 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.   #
+#                                                                            #
+#  Licensed under the Amazon Software License (the "License"). You may not   #
+#  use this file except in compliance with the License. A copy of the        #
+#  License is located at                                                     #
+#                                                                            #
+#      http://aws.amazon.com/asl/                                            #
+#                                                                            #
+#  or in the "license" file accompanying this file. This file is distributed #
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,        #
+#  express or implied. See the License for the specific language governing   #
+#  permissions and limitations under the License.                            #
+##############################################################################
+
+import logging
+import metrics
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# AWS WAF Classic accepts at most 1000 updates in a single Update* request
+MAX_UPDATES_PER_CALL = 1000
+# Only a stale change token is retried here: it takes a new token, which
+# botocore cannot get. Throttling and internal errors (HTTP 5xx) are retried
+# by the clients themselves (adaptive mode, clients.MAX_ATTEMPTS); retrying
+# them here again would multiply the calls a throttled chunk makes.
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 10.0
+RETRYABLE_ERRORS = ['WAFStaleDataException']
+# Share of a GetChangeToken round trip the next token is requested late by,
+# to make sure the write in flight consumed the current one
+PREFETCH_MARGIN = 0.1
+
+def error_code(error):
+    # botocore ClientError keeps the service error code in error.response
+    try:
+        return error.response['Error']['Code']
+    except (AttributeError, KeyError, TypeError):
+        return None
+
+def backoff_delay(attempt):
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+def get_change_token(waf_client):
+    return waf_client.get_change_token()['ChangeToken']
+
+def chunk_updates(updates, chunk_size=MAX_UPDATES_PER_CALL):
+    return [updates[i:i + chunk_size] for i in range(0, len(updates), chunk_size)]
+
+class ChangeTokenPipeline(object):
+    # Serialises the writes made through one WAF client, from any thread. WAF
+    # Classic hands out one change token at a time (the same one until a
+    # write consumes it), so concurrent writes would only collide on it. When
+    # another write follows, its token is requested while the current write is
+    # in flight, timed on the last round trips so that it arrives when the
+    # write returns; a token that comes back equal to the one just used is
+    # fetched again.
+    def __init__(self, waf_client):
+        self.waf_client = waf_client
+        self.lock = threading.Lock()
+        self.waiting_lock = threading.Lock()
+        self.waiting = 0
+        self.token_pool = ThreadPoolExecutor(max_workers=1)
+        self.next_token = None
+        self.used_token = None
+        self.write_seconds = 0.0
+        self.token_seconds = 0.0
+
+    def _fetch(self, delay=0.0):
+        time.sleep(delay)
+        started_at = time.time()
+        token = get_change_token(self.waf_client)
+        self.token_seconds = time.time() - started_at
+        return token
+
+    def _token(self):
+        # change_token_wait: time the writes stall on a token
+        with metrics.phase('change_token_wait'):
+            future, self.next_token = self.next_token, None
+            token = None
+            if future is not None:
+                try:
+                    token = future.result()
+                except Exception as error:
+                    logging.getLogger().warning("ChangeTokenPipeline - prefetch failed: %s"%str(error))
+            if token is None or token == self.used_token:
+                token = self._fetch()
+            return token
+
+    def write(self, call, prefetch=False, **params):
+        # call(ChangeToken = <token>, **params); returns (response, token).
+        # prefetch: the caller has another write to make right after this one
+        with self.waiting_lock:
+            self.waiting += 1
+        with self.lock:
+            with self.waiting_lock:
+                self.waiting -= 1
+                prefetch = prefetch or self.waiting > 0
+
+            token = self._token()
+            if prefetch:
+                # the write is consumed by the end of its round trip at the latest
+                delay = max(0.0, self.write_seconds - self.token_seconds * (1 - PREFETCH_MARGIN))
+                self.next_token = self.token_pool.submit(self._fetch, delay)
+            started_at = time.time()
+            try:
+                return call(ChangeToken = token, **params), token
+            finally:
+                # consumed, or stale already: never reused
+                self.used_token = token
+                self.write_seconds = time.time() - started_at
+
+_pipelines = {}
+_pipelines_lock = threading.Lock()
+
+def change_token_pipeline(waf_client):
+    # one pipeline per client; clients.get_client shares clients per endpoint
+    with _pipelines_lock:
+        pipeline = _pipelines.get(id(waf_client))
+        if pipeline is None or pipeline.waf_client is not waf_client:
+            pipeline = ChangeTokenPipeline(waf_client)
+            _pipelines[id(waf_client)] = pipeline
+        return pipeline
+
+def call_with_change_token(waf_client, call, **params):
+    # Single Create*/Delete* request through the client's token pipeline,
+    # retried like the chunks in apply_updates when the token went stale.
+    pipeline = change_token_pipeline(waf_client)
+    attempt = 0
+    while True:
+        try:
+            return pipeline.write(call, **params)[0]
+
+        except Exception as error:
+            attempt += 1
+            if error_code(error) not in RETRYABLE_ERRORS or attempt >= MAX_ATTEMPTS:
+                raise
+            metrics.count('UpdateRetries')
+            logging.getLogger().warning("call_with_change_token - retry %d: %s"%(attempt, str(error)))
+            time.sleep(backoff_delay(attempt))
+
+def apply_updates(waf_client, update_call, updates, chunk_size=MAX_UPDATES_PER_CALL, **params):
+    # Sends updates through update_call (e.g. waf_client.update_ip_set) in
+    # chunks of chunk_size, each one with its own change token from the
+    # client's pipeline. Safe to run for several sets at once: their chunks
+    # are interleaved on the shared pipeline.
+    chunks = chunk_updates(updates, chunk_size)
+    report = {'updates': len(updates), 'chunks': len(chunks), 'applied': 0, 'retries': 0, 'change_token': None}
+    if len(chunks) == 0:
+        return report
+
+    pipeline = change_token_pipeline(waf_client)
+    for index, chunk in enumerate(chunks):
+        attempt = 0
+        while True:
+            try:
+                response, token = pipeline.write(update_call, prefetch = index + 1 < len(chunks), Updates = chunk, **params)
+                break
+
+            except Exception as error:
+                attempt += 1
+                if error_code(error) not in RETRYABLE_ERRORS or attempt >= MAX_ATTEMPTS:
+                    logging.getLogger().error("apply_updates - chunk %d/%d failed: %s"%(index + 1, len(chunks), str(error)))
+                    raise
+
+                report['retries'] += 1
+                metrics.count('UpdateRetries')
+                logging.getLogger().warning("apply_updates - chunk %d/%d retry %d: %s"%(index + 1, len(chunks), attempt, str(error)))
+                time.sleep(backoff_delay(attempt))
+
+        report['applied'] += 1
+        report['change_token'] = token
+
+    logging.getLogger().debug("apply_updates - %d updates applied in %d chunks"%(report['updates'], report['applied']))
+    return report
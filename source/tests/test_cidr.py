@@ -0,0 +1,166 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.   #
+#                                                                            #
+#  Licensed under the Amazon Software License (the "License"). You may not   #
+#  use this file except in compliance with the License. A copy of the        #
+#  License is located at                                                     #
+#                                                                            #
+#      http://aws.amazon.com/asl/                                            #
+#                                                                            #
+#  or in the "license" file accompanying this file. This file is distributed #
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,        #
+#  express or implied. See the License for the specific language governing   #
+#  permissions and limitations under the License.                            #
+##############################################################################
+
+#------------------------------------------------------------------------------
+# CIDR aggregation (cidr.py) checked by brute force against ipaddress: random
+# overlapping lists must be covered exactly, by disjoint descriptors with
+# supported prefix lengths, and by no more of them than needed.
+#
+# python -m pytest source/tests      (or: python -m unittest discover source/tests)
+#------------------------------------------------------------------------------
+
+import ipaddress
+import os
+import random
+import sys
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(TESTS_DIR, '..', 'embargoed-countries-parser'), os.path.join(TESTS_DIR, '..', 'lib')]
+
+import cidr
+
+def collapse(values):
+    return list(ipaddress.collapse_addresses(ipaddress.ip_network(v, strict = False) for v in values))
+
+def fewest_descriptors(ip_type, values):
+    # Any aligned block lies within one network of the collapsed list, so
+    # the fewest descriptors are the sum over those networks: one when the
+    # prefix is supported, else the blocks of the next longer supported one.
+    supported = cidr.SUPPORTED_PREFIXES[ip_type]
+    count = 0
+    for network in collapse(values):
+        if network.prefixlen in supported:
+            count += 1
+        else:
+            count += 2 ** (min(p for p in supported if p > network.prefixlen) - network.prefixlen)
+    return count
+
+def random_ipv4(rng):
+    # hosts of 10.0.0.0/21 with any supported or splittable prefix: plenty of overlaps
+    prefix = rng.choice([8, 9, 12, 15] + list(range(16, 33)) * 3)
+    return '10.0.%d.%d/%d'%(rng.randrange(8), rng.randrange(256), prefix)
+
+def random_ipv6(rng):
+    prefix = rng.choice([24, 32, 40, 48, 52, 56, 60, 64, 120, 124, 127, 128])
+    return '2001:db8:0:%x::%x/%d'%(rng.randrange(4), rng.randrange(512), prefix)
+
+class AggregateTest(unittest.TestCase):
+    def check(self, values):
+        result = cidr.aggregate(values)
+        for ip_type in [cidr.IPV4, cidr.IPV6]:
+            inputs = [v for v in values if cidr.parse(v)[0] == ip_type]
+            outputs = [v for v, t in result.items() if t == ip_type]
+            networks = [ipaddress.ip_network(v) for v in outputs]
+
+            self.assertEqual(collapse(outputs), collapse(inputs), 'covers exactly %s'%inputs)
+            self.assertEqual(sum(n.num_addresses for n in networks), sum(n.num_addresses for n in collapse(outputs)), 'disjoint')
+            self.assertEqual(networks, sorted(networks), 'ordered by address')
+            self.assertEqual(outputs, [str(n) for n in networks], 'canonical')
+            for network in networks:
+                self.assertIn(network.prefixlen, cidr.SUPPORTED_PREFIXES[ip_type], str(network))
+            self.assertEqual(len(outputs), fewest_descriptors(ip_type, inputs), 'fewest descriptors for %s'%inputs)
+
+        self.assertEqual([t for t in result.values()], sorted(result.values()), 'IPv4 first')
+
+    def test_random_lists(self):
+        rng = random.Random(1)
+        for _ in range(300):
+            values = [random_ipv4(rng) for _ in range(rng.randrange(1, 12))]
+            values += [random_ipv6(rng) for _ in range(rng.randrange(0, 12))]
+            self.check(values)
+
+    def test_canonical_values(self):
+        self.assertEqual(cidr.aggregate(['10.0.0.1/24', ' 10.0.0.0/24 ', '2001:DB8:0:0::1/64', '192.0.2.7/32']), {
+            '10.0.0.0/24': cidr.IPV4,
+            '192.0.2.7/32': cidr.IPV4,
+            '2001:db8::/64': cidr.IPV6
+        })
+
+    def test_adjacent_and_covered(self):
+        self.assertEqual(list(cidr.aggregate(['10.0.0.0/25', '10.0.0.128/25', '10.0.0.7/32', '10.0.1.0/24'])), ['10.0.0.0/23'])
+        # a /15 is split in two /16s, a /9 in 128 of them
+        self.assertEqual(list(cidr.aggregate(['10.2.0.0/15'])), ['10.2.0.0/16', '10.3.0.0/16'])
+        self.assertEqual(len(cidr.aggregate(['10.128.0.0/9'])), 128)
+        self.assertEqual(list(cidr.aggregate(['10.128.0.0/9', '10.0.0.0/9'])), ['10.0.0.0/8'])
+
+    def test_empty(self):
+        self.assertEqual(cidr.aggregate([]), {})
+
+    def test_unsupported_prefixes(self):
+        # too many descriptors to split into: rejected unless widening is enabled
+        for value, widened in [('2001:db8::/100', '2001:db8::/64'), ('2001:db8::/65', '2001:db8::/64'), ('2001:db8:8000::/33', '2001:db8::/32')]:
+            with self.assertRaises(ValueError, msg = value):
+                cidr.aggregate([value])
+            self.assertEqual(list(cidr.aggregate([value], widen = True)), [widened])
+
+        # no supported prefix to widen to
+        with self.assertRaises(ValueError):
+            cidr.aggregate(['2000::/8'], widen = True)
+        self.assertEqual(len(cidr.aggregate(['2000::/16'])), 256)
+        self.assertEqual(len(cidr.aggregate(['0.0.0.0/0'])), 256)
+
+    def test_invalid_value(self):
+        for value in ['10.0.0.256/32', '10.0.0.0/33', 'embargo']:
+            with self.assertRaises(ValueError, msg = value):
+                cidr.aggregate([value])
+
+class CoverIntervalTest(unittest.TestCase):
+    def test_random_intervals(self):
+        rng = random.Random(2)
+        for _ in range(300):
+            first = rng.randrange(1 << 20)
+            last = first + rng.randrange(1 << rng.randrange(1, 18))
+            blocks = cidr.cover_interval(cidr.IPV4, first, last)
+            networks = [ipaddress.ip_network('%s/%d'%(ipaddress.IPv4Address(n), p)) for n, p in blocks]
+            expected = list(ipaddress.summarize_address_range(ipaddress.IPv4Address(first), ipaddress.IPv4Address(last)))
+            self.assertEqual(list(ipaddress.collapse_addresses(networks)), list(ipaddress.collapse_addresses(expected)))
+            self.assertEqual(len(networks), fewest_descriptors(cidr.IPV4, [str(n) for n in expected]))
+
+    def test_too_many_descriptors(self):
+        first = int(ipaddress.IPv6Address('2001:db8::1'))
+        with self.assertRaises(ValueError):
+            cidr.cover_interval(cidr.IPV6, first, first + 5000)
+        blocks = cidr.cover_interval(cidr.IPV6, first, first + 5000, widen = True)
+        self.assertEqual(blocks, [(first - 1, 64)])
+
+class SubtractIntervalTest(unittest.TestCase):
+    def test_random_intervals(self):
+        rng = random.Random(6)
+        for _ in range(200):
+            prefix = rng.choice(cidr.SUPPORTED_PREFIXES[cidr.IPV4][1:])
+            network = ipaddress.ip_network('%s/%d'%(ipaddress.IPv4Address(rng.randrange(1 << 32)), prefix), strict = False)
+            # overlapping the block, or wider than it on either side
+            first = max(0, int(network.network_address) + rng.randrange(-256, network.num_addresses))
+            last = first + rng.randrange(1 << rng.randrange(1, 12))
+            start, end = int(network.network_address), int(network.broadcast_address)
+            left = [(start, min(first - 1, end)), (max(last + 1, start), end)]
+            expected = [n for low, high in left if low <= high for n in ipaddress.summarize_address_range(ipaddress.IPv4Address(low), ipaddress.IPv4Address(high))]
+
+            blocks = cidr.subtract_interval(cidr.IPV4, start, prefix, first, last)
+            networks = [ipaddress.ip_network('%s/%d'%(ipaddress.IPv4Address(n), p)) for n, p in blocks]
+            self.assertEqual(list(ipaddress.collapse_addresses(networks)), list(ipaddress.collapse_addresses(expected)))
+            for n, p in blocks:
+                self.assertIn(p, cidr.SUPPORTED_PREFIXES[cidr.IPV4])
+
+    def test_too_many_descriptors(self):
+        network = int(ipaddress.IPv6Address('2001:db8::'))
+        with self.assertRaises(ValueError):
+            cidr.subtract_interval(cidr.IPV6, network, 32, network + 5, network + 5)
+
+if __name__ == '__main__':
+    unittest.main()
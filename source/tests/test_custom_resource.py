@@ -0,0 +1,228 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.   #
+#                                                                            #
+#  Licensed under the Amazon Software License (the "License"). You may not   #
+#  use this file except in compliance with the License. A copy of the        #
+#  License is located at                                                     #
+#                                                                            #
+#      http://aws.amazon.com/asl/                                            #
+#                                                                            #
+#  or in the "license" file accompanying this file. This file is distributed #
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,        #
+#  express or implied. See the License for the specific language governing   #
+#  permissions and limitations under the License.                            #
+##############################################################################
+
+#------------------------------------------------------------------------------
+# Custom resource plans (run_plan) and the WafAssociations requests against
+# the WAF Classic / S3 fakes of the benchmarks, with latency so that the
+# concurrent teardown steps overlap like they do against WAF, and the IP set
+# shards a lower shard count removes.
+#
+# python -m pytest source/tests      (or: python -m unittest discover source/tests)
+#------------------------------------------------------------------------------
+
+import importlib.util
+import json
+import os
+import sys
+import unittest
+from unittest import mock
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+CUSTOM_RESOURCE_DIR = os.path.join(TESTS_DIR, '..', 'custom-resource')
+sys.path[:0] = [os.path.join(TESTS_DIR, '..', 'lib'), os.path.join(TESTS_DIR, '..', 'benchmark')]
+
+import fakes
+import sync_state
+from ip_shards import shard_index
+
+BUCKET = 'embargoed-countries-bucket'
+
+def load_custom_resource():
+    # both functions ship a module called lambda_function
+    spec = importlib.util.spec_from_file_location('custom_resource_lambda_function', os.path.join(CUSTOM_RESOURCE_DIR, 'lambda_function.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+custom_resource = load_custom_resource()
+
+class CustomResourceTestCase(unittest.TestCase):
+    latency = 0.0
+
+    def setUp(self):
+        environ = mock.patch.dict(os.environ, {'LOG_LEVEL': 'ERROR', 'API_TYPE': 'waf'})
+        environ.start()
+        self.addCleanup(environ.stop)
+        self.waf = fakes.FakeWAF(latency = self.latency)
+        self.s3 = fakes.FakeS3()
+        self.addCleanup(fakes.install(self.waf, self.s3))
+
+    def stack(self, descriptors):
+        # a WebACL with the stack's IP and geo rules, as created by the template
+        waf = self.waf
+        self.geo_match_set_id = waf.add_geo_match_set(countries = ['CU', 'IR', 'KP', 'SY'])
+        self.ip_set_id = waf.add_ip_set(descriptors = dict(('10.%d.%d.%d/32'%(i >> 16 & 255, i >> 8 & 255, i & 255), 'IPV4') for i in range(descriptors)))
+        self.rule_id_ip = waf.add_rule(predicates = [{'Negated': False, 'Type': 'IPMatch', 'DataId': self.ip_set_id}])
+        # the geo rule gets its predicate and its place in the WebACL from the associations
+        self.rule_id_geo = waf.add_rule()
+        self.web_acl_id = waf.add_web_acl(rules = [{'Priority': 100, 'RuleId': self.rule_id_ip, 'Action': {'Type': 'BLOCK'}, 'Type': 'REGULAR'}])
+
+    def associations(self, request_type, **properties):
+        event = {
+            'RequestType': request_type,
+            'RequestId': 'request-%s'%request_type,
+            'ResourceType': 'Custom::WafAssociations',
+            'LogicalResourceId': 'WafAssociations',
+            'ResourceProperties': dict({
+                'WebAclId': self.web_acl_id, 'RuleAction': 'BLOCK',
+                'IpSetId': self.ip_set_id, 'RuleIdIp': self.rule_id_ip, 'RulePriorityIp': '100',
+                'GeoMatchSetId': self.geo_match_set_id, 'RuleIdGeo': self.rule_id_geo, 'RulePriorityGeo': '101',
+                'StateBucket': BUCKET
+            }, **properties)
+        }
+        return event
+
+    def handle(self, event):
+        result = json.loads(custom_resource.lambda_handler(event, None))
+        return result.get('StatusCode') or result.get('statusCode')
+
+class TeardownTest(CustomResourceTestCase):
+    latency = 0.02
+
+    def test_delete_large_ip_set(self):
+        self.stack(8000)
+        self.assertEqual(self.handle(self.associations('Create')), '200')
+        self.assertEqual(self.waf.rules[self.rule_id_geo], [{'Negated': False, 'Type': 'GeoMatch', 'DataId': self.geo_match_set_id}])
+        self.assertEqual([(r['RuleId'], r['Priority']) for r in self.waf.web_acls[self.web_acl_id]['Rules']], [(self.rule_id_ip, 100), (self.rule_id_geo, 101)])
+
+        self.assertEqual(self.handle(self.associations('Delete')), '200')
+        self.assertEqual(self.waf.ip_sets[self.ip_set_id], {})
+        self.assertNotIn(self.geo_match_set_id, self.waf.geo_match_sets)
+        self.assertEqual([r['RuleId'] for r in self.waf.web_acls[self.web_acl_id]['Rules']], [self.rule_id_ip])
+        self.assertEqual(self.waf.calls['UpdateIPSet'], 8)
+        # the progress marker is gone
+        self.assertEqual([k for b, k in self.s3.objects if k.startswith(sync_state.teardown_key(''))], [])
+
+    def test_update_associations(self):
+        self.stack(2500)
+        self.assertEqual(self.handle(self.associations('Create')), '200')
+        event = self.associations('Update', RulePriorityGeo = '102', RuleAction = 'COUNT')
+        event['OldResourceProperties'] = self.associations('Create')['ResourceProperties']
+
+        self.assertEqual(self.handle(event), '200')
+        self.assertEqual([(r['RuleId'], r['Priority'], r['Action']['Type']) for r in self.waf.web_acls[self.web_acl_id]['Rules']], [(self.rule_id_ip, 100, 'BLOCK'), (self.rule_id_geo, 102, 'COUNT')])
+        self.assertEqual(len(self.waf.rules[self.rule_id_geo]), 1)
+
+    def test_create_geo_match_set(self):
+        event = {'RequestType': 'Create', 'RequestId': 'request-geo', 'ResourceType': 'Custom::GeoMatchSet', 'LogicalResourceId': 'GeoMatchSet', 'ResourceProperties': {'ParentStackName': 'stack'}}
+        self.assertEqual(self.handle(event), '200')
+        self.assertEqual(len(self.waf.geo_match_sets), 1)
+
+class IPSetShardsTest(CustomResourceTestCase):
+    def shards(self, request_type, shard_count, old_shard_count=None):
+        event = {
+            'RequestType': request_type,
+            'RequestId': 'request-shards-%s'%request_type,
+            'ResourceType': 'Custom::IPSetShards',
+            'LogicalResourceId': 'IPSetShards',
+            'ResourceProperties': {
+                'ParentStackName': 'stack', 'WebAclId': self.web_acl_id, 'RuleAction': 'BLOCK',
+                'IpSetId': self.ip_set_id, 'ShardCount': str(shard_count), 'RulePriorityBase': '200'
+            }
+        }
+        if old_shard_count is not None:
+            event['OldResourceProperties'] = dict(event['ResourceProperties'], ShardCount = str(old_shard_count))
+        return event
+
+    def shard_ids(self, shard_count):
+        names = dict((name, i) for i, name in self.waf.names.items() if i in self.waf.ip_sets)
+        return [self.ip_set_id] + [names[custom_resource.ip_shard_names('stack', index)[0]] for index in range(1, shard_count)]
+
+    def test_lower_shard_count(self):
+        self.stack(0)
+        self.assertEqual(self.handle(self.shards('Create', 4)), '200')
+        ip_set_ids = self.shard_ids(4)
+        values = ['10.0.%d.%d/32'%(i >> 8, i & 255) for i in range(3000)]
+        for v in values:
+            self.waf.ip_sets[ip_set_ids[shard_index(v, 4)]][v] = 'IPV4'
+
+        # every descriptor deleted from an extra set is already in a remaining one
+        unblocked = []
+        update_ip_set = self.waf.update_ip_set
+        def checked_update_ip_set(IPSetId, ChangeToken, Updates):
+            if IPSetId in ip_set_ids[2:]:
+                unblocked.extend(u['IPSetDescriptor']['Value'] for u in Updates if not any(u['IPSetDescriptor']['Value'] in self.waf.ip_sets[i] for i in ip_set_ids[:2]))
+            return update_ip_set(IPSetId, ChangeToken, Updates)
+
+        with mock.patch.object(self.waf, 'update_ip_set', checked_update_ip_set):
+            self.assertEqual(self.handle(self.shards('Update', 2, 4)), '200')
+        self.assertEqual(unblocked, [])
+
+        self.assertEqual(self.shard_ids(2), ip_set_ids[:2])
+        for ip_set_id in ip_set_ids[2:]:
+            self.assertNotIn(ip_set_id, self.waf.ip_sets)
+        # where the parser's resync expects them: nothing left to move
+        for v in values:
+            self.assertIn(v, self.waf.ip_sets[ip_set_ids[shard_index(v, 2)]])
+        self.assertEqual(sum(len(self.waf.ip_sets[i]) for i in ip_set_ids[:2]), len(values))
+        self.assertEqual([r['Priority'] for r in self.waf.web_acls[self.web_acl_id]['Rules']], [100, 200])
+
+class BucketNotificationsTest(CustomResourceTestCase):
+    def filters(self, object_key):
+        custom_resource.configure_bucket_notifications(BUCKET, object_key, 'parser-arn')
+        configurations = self.s3.notifications[BUCKET]['LambdaFunctionConfigurations']
+        return dict((c['Id'], dict((r['Name'], r['Value']) for r in c['Filter']['Key']['FilterRules'])) for c in configurations)
+
+    def test_snapshots(self):
+        # the suffix the parser reads snapshots by
+        filters = self.filters('embargoed-countries.json')
+        self.assertEqual(filters['Call embargoed countries parser with snapshots'], {'prefix': 'embargoed-countries', 'suffix': sync_state.SNAPSHOT_SUFFIX})
+
+        # an embargo file that is a snapshot already gets no second rule
+        filters = self.filters('embargoed-countries' + sync_state.SNAPSHOT_SUFFIX)
+        self.assertNotIn('Call embargoed countries parser with snapshots', filters)
+
+class RunPlanTest(CustomResourceTestCase):
+    def test_dependencies(self):
+        finished = []
+        def step(name):
+            return lambda: finished.append(name)
+
+        custom_resource.run_plan([
+            ('c', ['a', 'b'], step('c')),
+            ('a', [], step('a')),
+            ('d', ['c'], step('d')),
+            ('b', ['a'], step('b'))
+        ], None, 'request')
+        self.assertEqual(finished, ['a', 'b', 'c', 'd'])
+
+    def test_resumes_after_failure(self):
+        runs = []
+        failing = [True]
+        def step(name):
+            def run():
+                runs.append(name)
+                if name == 'b' and failing[0]:
+                    raise Exception('%s failed'%name)
+            return run
+        steps = [('a', [], step('a')), ('b', [], step('b')), ('c', ['b'], step('c'))]
+
+        with self.assertRaises(Exception):
+            custom_resource.run_plan(steps, BUCKET, 'request')
+        # nothing depending on the failed step ran; the marker records what did
+        self.assertEqual(sorted(runs), ['a', 'b'])
+        self.assertEqual(sync_state.load_state(self.s3, BUCKET, sync_state.teardown_key('request')), {'done': ['a']})
+
+        failing[0] = False
+        runs[:] = []
+        custom_resource.run_plan(steps, BUCKET, 'request')
+        self.assertEqual(runs, ['b', 'c'])
+        self.assertNotIn((BUCKET, sync_state.teardown_key('request')), self.s3.objects)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.   #
+#                                                                            #
+#  Licensed under the Amazon Software License (the "License"). You may not   #
+#  use this file except in compliance with the License. A copy of the        #
+#  License is located at                                                     #
+#                                                                            #
+#      http://aws.amazon.com/asl/                                            #
+#                                                                            #
+#  or in the "license" file accompanying this file. This file is distributed #
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,        #
+#  express or implied. See the License for the specific language governing   #
+#  permissions and limitations under the License.                            #
+##############################################################################
+
+#------------------------------------------------------------------------------
+# Streaming embargo file reader (embargo_file.py) against json.loads, with the
+# document cut into chunks at every possible offset: tokens, numbers and
+# multi-byte characters split across reads.
+#
+# python -m pytest source/tests      (or: python -m unittest discover source/tests)
+#------------------------------------------------------------------------------
+
+import io
+import json
+import os
+import sys
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(TESTS_DIR, '..', 'embargoed-countries-parser'), os.path.join(TESTS_DIR, '..', 'lib')]
+
+from embargo_file import JsonStreamReader, read_embargo_file
+
+DOCUMENT = u'''{
+    "version" : "2017-09-01 édition",
+    "description": {"text": "Embargo 日本 ☃ \\"quoted\\" \\u00e9", "tags": [1, 2.5, -3e2, true, false, null, [], {}]},
+    "priority": 12345,
+    "effect": "deny",
+    "embargoed-countries": [
+        {"code": "CU", "name": "Cuba"},
+        {"name": "Iran", "code": "IR", "extra": {"nested": [1, [2, [3]]]}},
+        {"code": "KP"}
+    ],
+    "embargoed-ips": [
+        {"name": "first", "ips": [{"Type": "IPV4", "Value": "10.0.0.0/8"}, {"Value": "2001:db8::/32", "Type": "IPV6"}]},
+        {"ips": [], "comment": "empty"},
+        {"comment": "ééé", "ips": [{"Type": "IPV4", "Value": "192.0.2.1/32"}], "trailing": 1.25e-3}
+    ],
+    "unknown": {"a": [{"b": "c"}], "d": 0}
+}'''
+
+def expected(document):
+    # what read_embargo_file yields for a document loaded as a whole
+    data = json.loads(document)
+    countries = [c['code'] for c in data.get('embargoed-countries', [])]
+    ips = {}
+    for group in data.get('embargoed-ips', []):
+        for ip in group.get('ips', []):
+            ips[ip['Value']] = ip['Type']
+    metadata = dict((k, data[k]) for k in ['version', 'priority', 'effect'] if k in data)
+    return countries, ips, metadata
+
+class ReadEmbargoFileTest(unittest.TestCase):
+    def read(self, document, chunk_size):
+        metadata = {}
+        countries, ips = read_embargo_file(io.BytesIO(document.encode('utf-8')), chunk_size, metadata)
+        return countries, ips, metadata
+
+    def test_every_chunk_size(self):
+        data = DOCUMENT.encode('utf-8')
+        for chunk_size in range(1, len(data) + 1):
+            self.assertEqual(self.read(DOCUMENT, chunk_size), expected(DOCUMENT), 'chunk size %d'%chunk_size)
+
+    def test_compact_document(self):
+        document = json.dumps(json.loads(DOCUMENT), separators = (',', ':'), ensure_ascii = False)
+        for chunk_size in range(1, 64):
+            self.assertEqual(self.read(document, chunk_size), expected(document), 'chunk size %d'%chunk_size)
+
+    def test_numbers_split_at_chunk_boundaries(self):
+        for value in ['12345', '-7', '2.5', '1e3', '1.5E+10', '-0.25e-2']:
+            document = '{"priority":%s}'%value
+            for chunk_size in range(1, len(document) + 1):
+                self.assertEqual(self.read(document, chunk_size)[2], {'priority': json.loads(value)}, '%s, chunk size %d'%(value, chunk_size))
+
+    def test_empty_document(self):
+        self.assertEqual(self.read('{}', 1), ([], {}, {}))
+
+    def test_truncated_document(self):
+        # every prefix misses the closing brace at least
+        for end in range(1, len(DOCUMENT)):
+            with self.assertRaises(ValueError, msg = 'cut at %d'%end):
+                self.read(DOCUMENT[:end], 7)
+
+    def test_malformed_document(self):
+        for document in ['[]', '{"a" 1}', '{"a": 1 "b": 2}', '{"embargoed-countries": [{"code": "CU"} {"code": "IR"}]}', '{1: 2}']:
+            with self.assertRaises(ValueError, msg = document):
+                self.read(document, 3)
+
+class JsonStreamReaderTest(unittest.TestCase):
+    def test_walk_and_skip(self):
+        for chunk_size in range(1, 16):
+            reader = JsonStreamReader(io.BytesIO(b' { "skip" : {"x": [1, {"y": "}]"}]}, "list": [ "a" , 2 , {"k": null} ] } '), chunk_size)
+            values = []
+            for key in reader.iter_object():
+                if key == 'list':
+                    for _ in reader.iter_array():
+                        values.append(reader.read_value())
+                else:
+                    reader.skip_value()
+            self.assertEqual(values, ['a', 2, {'k': None}], 'chunk size %d'%chunk_size)
+
+    def test_invalid_utf8(self):
+        with self.assertRaises(ValueError):
+            JsonStreamReader(io.BytesIO(b'{"a": "\xff"}'), 2).read_value()
+
+if __name__ == '__main__':
+    unittest.main()
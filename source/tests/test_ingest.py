@@ -0,0 +1,167 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.   #
+#                                                                            #
+#  Licensed under the Amazon Software License (the "License"). You may not   #
+#  use this file except in compliance with the License. A copy of the        #
+#  License is located at                                                     #
+#                                                                            #
+#      http://aws.amazon.com/asl/                                            #
+#                                                                            #
+#  or in the "license" file accompanying this file. This file is distributed #
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,        #
+#  express or implied. See the License for the specific language governing   #
+#  permissions and limitations under the License.                            #
+##############################################################################
+
+#------------------------------------------------------------------------------
+# Bursts of S3 notifications (ingest.py): records collected from S3 and SQS
+# events, coalesced into jobs, and SQS batches through the parser handler
+# against the WAF Classic / S3 fakes of the benchmarks, with the failed
+# batches going back to the queue.
+#
+# python -m pytest source/tests      (or: python -m unittest discover source/tests)
+#------------------------------------------------------------------------------
+
+import importlib.util
+import json
+import os
+import sys
+import unittest
+from unittest import mock
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+PARSER_DIR = os.path.join(TESTS_DIR, '..', 'embargoed-countries-parser')
+sys.path[:0] = [PARSER_DIR, os.path.join(TESTS_DIR, '..', 'lib'), os.path.join(TESTS_DIR, '..', 'benchmark')]
+
+import fakes
+import ingest
+
+BUCKET = 'embargoed-countries-bucket'
+OBJECT_KEY = 'embargoed-countries.json'
+PATCH_PREFIX = 'patches/'
+SOURCES_PREFIX = 'sources/'
+
+def load_parser():
+    # both functions ship a module called lambda_function. One copy for
+    # every test module: fakes.install patches the modules in sys.modules.
+    if 'parser_lambda_function' in sys.modules:
+        return sys.modules['parser_lambda_function']
+    spec = importlib.util.spec_from_file_location('parser_lambda_function', os.path.join(PARSER_DIR, 'lambda_function.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+parser = load_parser()
+
+def record(key, time, bucket=BUCKET):
+    return {'bucket': bucket, 'key': key, 'time': time, 'sequencer': ''}
+
+class CollectRecordsTest(unittest.TestCase):
+    def test_s3_and_sqs_events(self):
+        s3_record = {'eventSource': 'aws:s3', 'eventTime': '2018-06-01T00:00:01.000Z', 's3': {'bucket': {'name': BUCKET}, 'object': {'key': 'patches/0001+%281%29.json', 'sequencer': '01'}}}
+        self.assertEqual(ingest.collect_records({'Records': [s3_record]}), [
+            {'bucket': BUCKET, 'key': 'patches/0001 (1).json', 'time': '2018-06-01T00:00:01.000Z', 'sequencer': '01'}
+        ])
+
+        queue = ingest.MemoryQueue()
+        queue.send({'Records': [s3_record, s3_record]})
+        # sent by S3 when the queue notification is configured
+        queue.send({'Service': 'Amazon S3', 'Event': 's3:TestEvent', 'Bucket': BUCKET})
+        self.assertEqual(len(ingest.collect_records(queue.receive())), 2)
+
+    def test_no_records(self):
+        self.assertEqual(ingest.collect_records({'action': 'reconcile'}), [])
+
+class CoalesceTest(unittest.TestCase):
+    def test_last_full_state_file(self):
+        records = [record(OBJECT_KEY, '3'), record('other.json', '2'), record(OBJECT_KEY, '1')]
+        self.assertEqual(ingest.coalesce(records, PATCH_PREFIX, SOURCES_PREFIX), [(BUCKET, OBJECT_KEY)])
+
+    def test_patches_after_full_state_file(self):
+        records = [record('patches/0003.json', '5'), record('patches/0001.json', '1'), record(OBJECT_KEY, '2'), record('patches/0002.json', '4'), record('patches/0002.json', '6')]
+        # patch 1 came before the full-state file, which the sync reads as it is now
+        self.assertEqual(ingest.coalesce(records, PATCH_PREFIX, SOURCES_PREFIX), [(BUCKET, OBJECT_KEY), (BUCKET, 'patches/0002.json'), (BUCKET, 'patches/0003.json')])
+        # without a full-state file every patch is applied, in key order
+        self.assertEqual(ingest.coalesce([r for r in records if r['key'] != OBJECT_KEY], PATCH_PREFIX, SOURCES_PREFIX), [(BUCKET, 'patches/0001.json'), (BUCKET, 'patches/0002.json'), (BUCKET, 'patches/0003.json')])
+
+    def test_sources(self):
+        records = [record('sources/b.json', '1'), record('sources/a.json', '2'), record('sources/b.json', '3')]
+        self.assertEqual(ingest.coalesce(records, PATCH_PREFIX, SOURCES_PREFIX), [(BUCKET, 'sources/a.json'), (BUCKET, 'sources/b.json')])
+        # without a source prefix they are full-state files
+        self.assertEqual(ingest.coalesce(records, PATCH_PREFIX), [(BUCKET, 'sources/b.json')])
+
+    def test_buckets(self):
+        records = [record(OBJECT_KEY, '2', 'bucket-b'), record('patches/0001.json', '1', 'bucket-b'), record(OBJECT_KEY, '1', 'bucket-a')]
+        self.assertEqual(ingest.coalesce(records, PATCH_PREFIX, SOURCES_PREFIX), [('bucket-a', OBJECT_KEY), ('bucket-b', OBJECT_KEY)])
+
+    def test_same_time(self):
+        # the sequencer orders the events of one second
+        records = [dict(record(OBJECT_KEY, '1'), sequencer = '02'), dict(record('other.json', '1'), sequencer = '01')]
+        self.assertEqual(ingest.coalesce(records, PATCH_PREFIX, SOURCES_PREFIX), [(BUCKET, OBJECT_KEY)])
+
+class QueueTest(unittest.TestCase):
+    def setUp(self):
+        self.waf = fakes.FakeWAF()
+        self.s3 = fakes.FakeS3()
+        self.geo_match_set_id = self.waf.add_geo_match_set()
+        self.ip_set_id = self.waf.add_ip_set()
+        environ = mock.patch.dict(os.environ, {'LOG_LEVEL': 'ERROR', 'API_TYPE': 'waf', 'GEO_MATCH_SET_ID': self.geo_match_set_id, 'IP_SET_ID': self.ip_set_id, 'STATE_BUCKET': BUCKET})
+        environ.start()
+        self.addCleanup(environ.stop)
+        self.addCleanup(fakes.install(self.waf, self.s3))
+        self.queue = ingest.MemoryQueue()
+
+    def upload(self, countries, generation):
+        self.s3.objects[(BUCKET, OBJECT_KEY)] = json.dumps({
+            'embargoed-countries': [{'name': c, 'code': c} for c in countries],
+            'embargoed-ips': [{'name': 'ranges', 'ips': [{'Type': 'IPV4', 'Value': '10.%d.0.0/16'%generation}]}]
+        }).encode('utf-8')
+        self.queue.send_object_created(BUCKET, OBJECT_KEY)
+
+    def process(self):
+        event = self.queue.receive()
+        response = parser.lambda_handler(event, None)
+        self.queue.complete(event, response)
+        return event, response
+
+    def test_burst(self):
+        for generation in range(5):
+            self.upload(['CU', 'IR'][:generation % 2 + 1], generation)
+
+        event, response = self.process()
+        self.assertEqual(len(event['Records']), 5)
+        self.assertEqual(response, {'batchItemFailures': []})
+        self.assertEqual(self.queue.messages, [])
+        # the burst is one sync of the last upload
+        self.assertEqual(self.waf.calls['UpdateIPSet'], 1)
+        self.assertEqual(self.waf.calls['UpdateGeoMatchSet'], 1)
+        self.assertEqual(self.waf.ip_sets[self.ip_set_id], {'10.4.0.0/16': 'IPV4'})
+        self.assertEqual(self.waf.geo_match_sets[self.geo_match_set_id], set(['CU']))
+
+    def test_failed_batch(self):
+        self.upload(['CU'], 0)
+        self.upload(['CU', 'IR'], 1)
+        del self.waf.geo_match_sets[self.geo_match_set_id]
+
+        event, response = self.process()
+        # every message of the batch goes back to the queue
+        self.assertEqual(sorted(f['itemIdentifier'] for f in response['batchItemFailures']), sorted(r['messageId'] for r in event['Records']))
+        self.assertEqual(len(self.queue.messages), 2)
+
+        self.waf.add_geo_match_set(self.geo_match_set_id)
+        event, response = self.process()
+        self.assertEqual(response, {'batchItemFailures': []})
+        self.assertEqual(self.queue.messages, [])
+        self.assertEqual(self.waf.geo_match_sets[self.geo_match_set_id], set(['CU', 'IR']))
+
+    def test_test_event(self):
+        self.queue.send({'Service': 'Amazon S3', 'Event': 's3:TestEvent', 'Bucket': BUCKET})
+        event, response = self.process()
+        self.assertEqual(response, {'batchItemFailures': []})
+        self.assertEqual(self.waf.api_calls(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.   #
+#                                                                            #
+#  Licensed under the Amazon Software License (the "License"). You may not   #
+#  use this file except in compliance with the License. A copy of the        #
+#  License is located at                                                     #
+#                                                                            #
+#      http://aws.amazon.com/asl/                                            #
+#                                                                            #
+#  or in the "license" file accompanying this file. This file is distributed #
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,        #
+#  express or implied. See the License for the specific language governing   #
+#  permissions and limitations under the License.                            #
+##############################################################################
+
+#------------------------------------------------------------------------------
+# Feed merge (merge.py) checked by brute force: every address of a small IPv4
+# and IPv6 range is decided on its own, with ipaddress, from the feeds that
+# list it, and compared with the effective set kept by random sequences of
+# incremental changes (apply_change) and with a rebuild from scratch.
+#
+# python -m pytest source/tests      (or: python -m unittest discover source/tests)
+#------------------------------------------------------------------------------
+
+import ipaddress
+import os
+import random
+import sys
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(TESTS_DIR, '..', 'embargoed-countries-parser'), os.path.join(TESTS_DIR, '..', 'lib')]
+
+import cidr
+import merge
+
+UNIVERSE = {
+    cidr.IPV4: ipaddress.ip_network('10.0.0.0/23'),
+    cidr.IPV6: ipaddress.ip_network('2001:db8::/120')
+}
+COUNTRIES = ['CU', 'IR', 'KP', 'SY', 'RU']
+
+def random_value(rng, family):
+    universe = UNIVERSE[family]
+    prefix = rng.randrange(universe.prefixlen, universe.max_prefixlen + 1)
+    address = universe.network_address + rng.randrange(universe.num_addresses)
+    return str(ipaddress.ip_network('%s/%d'%(address, prefix), strict = False))
+
+def random_values(rng):
+    return [random_value(rng, rng.choice(merge.FAMILIES)) for _ in range(rng.randrange(0, 8))]
+
+def feed(name, values, countries, priority, effect):
+    feed = merge.contribution(name, 'etag-%s'%name, countries, cidr.aggregate(values), priority, effect)
+    feed['values'] = values
+    return feed
+
+def random_feed(rng, name):
+    return feed(name, random_values(rng), rng.sample(COUNTRIES, rng.randrange(0, 4)), rng.randrange(3), rng.choice(merge.EFFECTS))
+
+def decided(feeds, family):
+    # {address: deciding feed} of the denied addresses, one address at a time
+    ranges = []
+    for f in feeds:
+        for value in f['values']:
+            network = ipaddress.ip_network(value)
+            if network.version == UNIVERSE[family].version:
+                ranges.append((int(network.network_address), int(network.broadcast_address), f))
+
+    denied = {}
+    first = int(UNIVERSE[family].network_address)
+    for address in range(first, first + UNIVERSE[family].num_addresses):
+        listing = [f for low, high, f in ranges if low <= address <= high]
+        if listing:
+            # highest priority, deny before allow, then name
+            winner = max(listing, key = lambda f: (f['priority'], f['effect'] == merge.DENY, f['name']))
+            if winner['effect'] == merge.DENY:
+                denied[address] = winner['name']
+    return denied
+
+def decided_countries(feeds):
+    countries = {}
+    for code in COUNTRIES:
+        listing = [f for f in feeds if code in f['countries']]
+        if listing:
+            winner = max(listing, key = lambda f: (f['priority'], f['effect'] == merge.DENY, f['name']))
+            if winner['effect'] == merge.DENY:
+                countries[code] = winner['name']
+    return countries
+
+def expand(intervals):
+    addresses = {}
+    for interval in intervals:
+        for address in range(interval[0], interval[1] + 1):
+            addresses[address] = interval[2]
+    return addresses
+
+class MergeTestCase(unittest.TestCase):
+    def check(self, merged, feeds):
+        self.assertEqual(merged['countries'], decided_countries(feeds))
+        self.assertEqual(sorted(merged['sources']), sorted(f['name'] for f in feeds))
+
+        for family in merge.FAMILIES:
+            denied = decided(feeds, family)
+            intervals = merged['ips'][family]
+            self.assertEqual(expand(intervals), denied)
+            for previous, following in zip(intervals, intervals[1:]):
+                self.assertLess(previous[1], following[0], 'sorted and disjoint')
+                self.assertFalse(previous[1] + 1 == following[0] and previous[2] == following[2], 'adjacent intervals of one feed are joined')
+
+            # the descriptors cover the denied addresses exactly, without overlaps
+            networks = [ipaddress.ip_network(v) for v, t in merged['descriptors'].items() if t == family]
+            covered = set()
+            for network in networks:
+                covered.update(range(int(network.network_address), int(network.broadcast_address) + 1))
+            self.assertEqual(covered, set(denied))
+            self.assertEqual(sum(n.num_addresses for n in networks), len(denied))
+            for network in networks:
+                self.assertIn(network.prefixlen, cidr.SUPPORTED_PREFIXES[family], str(network))
+
+class ApplyChangeTest(MergeTestCase):
+    def test_random_changes(self):
+        for seed in range(12):
+            rng = random.Random(seed)
+            feeds = {}
+            merged = merge.empty()
+            for step in range(30):
+                name = 'feed-%d'%rng.randrange(5)
+                old = feeds.get(name)
+                if old is None:
+                    new = random_feed(rng, name)
+                elif rng.random() < 0.2:
+                    new = None
+                else:
+                    # small delta, and now and then another priority or effect
+                    values = [v for v in old['values'] if rng.random() < 0.8] + random_values(rng)[:2]
+                    priority, effect = old['priority'], old['effect']
+                    if rng.random() < 0.3:
+                        priority, effect = rng.randrange(3), rng.choice(merge.EFFECTS)
+                    new = feed(name, values, rng.sample(COUNTRIES, rng.randrange(0, 4)), priority, effect)
+
+                others = [f for n, f in sorted(feeds.items()) if n != name]
+                merge.apply_change(merged, old, new, others)
+                if new is None:
+                    del feeds[name]
+                else:
+                    feeds[name] = new
+
+                message = 'seed %d, step %d'%(seed, step)
+                with self.subTest(message):
+                    self.check(merged, list(feeds.values()))
+                    rebuilt = merge.rebuild([f for n, f in sorted(feeds.items())])
+                    self.assertEqual(merged['descriptors'], rebuilt['descriptors'])
+                    self.assertEqual(merged['ips'], rebuilt['ips'])
+
+    def test_rebuild(self):
+        rng = random.Random(100)
+        for _ in range(50):
+            feeds = [random_feed(rng, 'feed-%d'%i) for i in range(rng.randrange(1, 5))]
+            self.check(merge.rebuild(feeds), feeds)
+
+    def test_precedence(self):
+        deny = feed('deny', ['192.0.2.0/24'], ['CU', 'IR'], 0, merge.DENY)
+        allow = feed('allow', ['192.0.2.0/25'], ['CU'], 0, merge.ALLOW)
+        # at equal priority deny wins
+        merged = merge.rebuild([deny, allow])
+        self.assertEqual(merged['descriptors'], {'192.0.2.0/24': cidr.IPV4})
+        self.assertEqual(merged['countries'], {'CU': 'deny', 'IR': 'deny'})
+
+        # a higher priority exemption carves a hole
+        exemption = feed('allow', ['192.0.2.0/25'], ['CU'], 1, merge.ALLOW)
+        merge.apply_change(merged, allow, exemption, [deny])
+        self.assertEqual(merged['descriptors'], {'192.0.2.128/25': cidr.IPV4})
+        self.assertEqual(merged['countries'], {'IR': 'deny'})
+
+        # and removing it restores the deny feed's entries
+        merge.apply_change(merged, exemption, None, [deny])
+        self.assertEqual(merged['descriptors'], {'192.0.2.0/24': cidr.IPV4})
+        self.assertEqual(merged['countries'], {'CU': 'deny', 'IR': 'deny'})
+        self.assertEqual(sorted(merged['sources']), ['deny'])
+
+    def test_unexpressible_hole(self):
+        deny = feed('deny', ['2001:db8::/32'], [], 0, merge.DENY)
+        allow = feed('allow', ['2001:db8::1/128'], [], 1, merge.ALLOW)
+        with self.assertRaises(ValueError):
+            merge.rebuild([deny, allow])
+        # widened, the exemption is lost
+        merged = merge.rebuild([deny, allow], widen = True)
+        self.assertIn('2001:db8::/32', merged['descriptors'])
+
+    def test_invalid_feeds(self):
+        for priority, effect in [(0, 'block'), ('1', merge.DENY), (True, merge.DENY), (1.5, merge.ALLOW)]:
+            with self.assertRaises(ValueError, msg = '%r %r'%(priority, effect)):
+                merge.contribution('feed', 'etag', [], {}, priority, effect)
+
+class DecideTest(unittest.TestCase):
+    def test_random_regions(self):
+        rng = random.Random(200)
+        for _ in range(200):
+            feeds = [random_feed(rng, 'feed-%d'%i) for i in range(rng.randrange(1, 5))]
+            for family in merge.FAMILIES:
+                first = int(UNIVERSE[family].network_address)
+                bounds = sorted(rng.sample(range(first, first + UNIVERSE[family].num_addresses), 4))
+                region = cidr.merge_intervals([(bounds[0], bounds[1]), (bounds[2], bounds[3])])
+
+                denied = decided(feeds, family)
+                expected = dict((a, n) for a, n in denied.items() if any(low <= a <= high for low, high in region))
+                self.assertEqual(expand(merge.decide(region, feeds, family)), expected)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.   #
+#                                                                            #
+#  Licensed under the Amazon Software License (the "License"). You may not   #
+#  use this file except in compliance with the License. A copy of the        #
+#  License is located at                                                     #
+#                                                                            #
+#      http://aws.amazon.com/asl/                                            #
+#                                                                            #
+#  or in the "license" file accompanying this file. This file is distributed #
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,        #
+#  express or implied. See the License for the specific language governing   #
+#  permissions and limitations under the License.                            #
+##############################################################################
+
+#------------------------------------------------------------------------------
+# Incremental patches of the parser against the WAF Classic / S3 fakes of the
+# benchmarks: patches applied on top of the state cache, replayed after a
+# sequence gap and replayed by a resync. Entries of the full-state file are
+# aggregated before they reach WAF, so a patch may remove part of a wider
+# descriptor; what WAF blocks is compared address by address.
+#
+# python -m pytest source/tests      (or: python -m unittest discover source/tests)
+#------------------------------------------------------------------------------
+
+import importlib.util
+import ipaddress
+import json
+import os
+import sys
+import unittest
+from unittest import mock
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+PARSER_DIR = os.path.join(TESTS_DIR, '..', 'embargoed-countries-parser')
+sys.path[:0] = [PARSER_DIR, os.path.join(TESTS_DIR, '..', 'lib'), os.path.join(TESTS_DIR, '..', 'benchmark')]
+
+import fakes
+
+BUCKET = 'embargoed-countries-bucket'
+OBJECT_KEY = 'embargoed-countries.json'
+
+def load_parser():
+    # both functions ship a module called lambda_function. One copy for
+    # every test module: fakes.install patches the modules in sys.modules.
+    if 'parser_lambda_function' in sys.modules:
+        return sys.modules['parser_lambda_function']
+    spec = importlib.util.spec_from_file_location('parser_lambda_function', os.path.join(PARSER_DIR, 'lambda_function.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+parser = load_parser()
+
+def embargo_document(version, countries, ips):
+    return json.dumps({
+        'version': version,
+        'embargoed-countries': [{'name': c, 'code': c} for c in countries],
+        'embargoed-ips': [{'name': 'ranges', 'ips': [{'Type': 'IPV6' if ':' in v else 'IPV4', 'Value': v} for v in ips]}]
+    }).encode('utf-8')
+
+def patch_document(sequence, add=None, remove=None, countries=None):
+    return json.dumps({
+        'base-version': 'v1',
+        'sequence': sequence,
+        'add': {'embargoed-countries': countries or [], 'embargoed-ips': [{'Type': 'IPV4', 'Value': v} for v in add or []]},
+        'remove': {'embargoed-countries': [], 'embargoed-ips': [{'Type': 'IPV4', 'Value': v} for v in remove or []]}
+    }).encode('utf-8')
+
+def patch_key(sequence):
+    return '%s%04d.json'%(parser.PATCH_PREFIX, sequence)
+
+def notification(object_key):
+    return {'Records': [{'s3': {'bucket': {'name': BUCKET}, 'object': {'key': object_key}}}]}
+
+def addresses(values):
+    return sorted(ipaddress.collapse_addresses(ipaddress.ip_network(v) for v in values))
+
+class PatchTestCase(unittest.TestCase):
+    # 10.0.0.0/24 and 10.0.1.0/24 reach WAF as 10.0.0.0/23
+    full_state = ['10.0.0.0/24', '10.0.1.0/24', '192.0.2.0/24']
+
+    def setUp(self):
+        self.waf = fakes.FakeWAF()
+        self.s3 = fakes.FakeS3()
+        self.geo_match_set_id = self.waf.add_geo_match_set()
+        self.ip_set_ids = [self.waf.add_ip_set(), self.waf.add_ip_set()]
+        environ = mock.patch.dict(os.environ, {'LOG_LEVEL': 'ERROR', 'API_TYPE': 'waf', 'GEO_MATCH_SET_ID': self.geo_match_set_id, 'IP_SET_ID': self.ip_set_ids[0], 'IP_SET_IDS': ','.join(self.ip_set_ids), 'STATE_BUCKET': BUCKET})
+        environ.start()
+        self.addCleanup(environ.stop)
+        self.addCleanup(fakes.install(self.waf, self.s3))
+
+        self.s3.objects[(BUCKET, OBJECT_KEY)] = embargo_document('v1', ['CU'], self.full_state)
+        self.assertEqual(self.handle(notification(OBJECT_KEY)), '200')
+        self.assertIn('10.0.0.0/23', self.blocked_descriptors())
+
+    def handle(self, event):
+        return json.loads(parser.lambda_handler(event, None))['statusCode']
+
+    def upload_patch(self, sequence, **changes):
+        self.s3.objects[(BUCKET, patch_key(sequence))] = patch_document(sequence, **changes)
+
+    def blocked_descriptors(self):
+        values = [v for ip_set_id in self.ip_set_ids for v in self.waf.ip_sets[ip_set_id]]
+        self.assertEqual(len(values), len(set(values)), 'a descriptor is in one IP set only')
+        return values
+
+    def check_blocked(self, expected):
+        self.assertEqual(addresses(self.blocked_descriptors()), addresses(expected))
+        # the state cache matches WAF
+        state = parser.load_target_state(parser.load_targets()[0])
+        self.assertEqual(sorted(state['waf']['ips']), sorted(self.blocked_descriptors()))
+        for c, entry in state['waf']['ips'].items():
+            self.assertIn(entry[1], self.waf.ip_sets[self.ip_set_ids[parser.ip_shard(entry)]])
+
+class ApplyPatchTest(PatchTestCase):
+    def test_remove_folded_entry(self):
+        self.upload_patch(1, remove = ['10.0.1.0/24'])
+        self.assertEqual(self.handle(notification(patch_key(1))), '200')
+        self.check_blocked(['10.0.0.0/24', '192.0.2.0/24'])
+
+        # the chain goes on from the patched state
+        self.upload_patch(2, add = ['10.0.1.128/25'], countries = ['IR'])
+        self.assertEqual(self.handle(notification(patch_key(2))), '200')
+        self.check_blocked(['10.0.0.0/24', '10.0.1.128/25', '192.0.2.0/24'])
+        self.assertEqual(sorted(self.waf.geo_match_sets[self.geo_match_set_id]), ['CU', 'IR'])
+
+    def test_remove_inside_descriptor(self):
+        self.upload_patch(1, remove = ['10.0.0.5/32', '192.0.2.128/26'])
+        self.assertEqual(self.handle(notification(patch_key(1))), '200')
+        self.check_blocked([str(n) for n in ipaddress.ip_network('10.0.0.0/23').address_exclude(ipaddress.ip_network('10.0.0.5/32'))] + ['192.0.2.0/25', '192.0.2.192/26'])
+
+    def test_remove_wider_than_descriptors(self):
+        self.upload_patch(1, remove = ['10.0.0.0/8', '198.51.100.0/24'])
+        self.assertEqual(self.handle(notification(patch_key(1))), '200')
+        self.check_blocked(['192.0.2.0/24'])
+
+    def test_add_around_descriptors(self):
+        # inside a descriptor: nothing to do; around one: replaces it
+        self.upload_patch(1, add = ['10.0.0.128/25', '192.0.0.0/22'])
+        self.assertEqual(self.handle(notification(patch_key(1))), '200')
+        self.check_blocked(['10.0.0.0/23', '192.0.0.0/22'])
+        self.assertNotIn('192.0.2.0/24', self.blocked_descriptors())
+
+        # removed, then added again
+        self.upload_patch(2, remove = ['192.0.0.0/22'], add = ['192.0.2.0/24'])
+        self.assertEqual(self.handle(notification(patch_key(2))), '200')
+        self.check_blocked(self.full_state)
+
+class ReplayTest(PatchTestCase):
+    def test_sequence_gap(self):
+        # the notification of patch 1 is lost: patch 2 replays it first
+        self.upload_patch(1, remove = ['10.0.1.0/24'])
+        self.upload_patch(2, remove = ['10.0.0.128/25'])
+        self.assertEqual(self.handle(notification(patch_key(2))), '200')
+        self.check_blocked(['10.0.0.0/25', '192.0.2.0/24'])
+
+    def test_resync(self):
+        self.upload_patch(1, remove = ['10.0.1.0/24'])
+        self.assertEqual(self.handle(notification(patch_key(1))), '200')
+        # a full sync from the full-state file (no ETag skip once patched),
+        # then the patch again on top of it
+        self.assertEqual(self.handle({'action': 'resync', 'bucket': BUCKET, 'key': OBJECT_KEY}), '200')
+        self.check_blocked(['10.0.0.0/24', '192.0.2.0/24'])
+        self.assertEqual(parser.load_target_state(parser.load_targets()[0])['sequence'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
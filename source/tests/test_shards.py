@@ -0,0 +1,152 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.   #
+#                                                                            #
+#  Licensed under the Amazon Software License (the "License"). You may not   #
+#  use this file except in compliance with the License. A copy of the        #
+#  License is located at                                                     #
+#                                                                            #
+#      http://aws.amazon.com/asl/                                            #
+#                                                                            #
+#  or in the "license" file accompanying this file. This file is distributed #
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,        #
+#  express or implied. See the License for the specific language governing   #
+#  permissions and limitations under the License.                            #
+##############################################################################
+
+#------------------------------------------------------------------------------
+# IP set shards: placement of the descriptors (ip_shards.py), stable across
+# processes and moving as few descriptors as possible when the shard count
+# changes, and the parser's updates moving them between IP sets.
+#
+# python -m pytest source/tests      (or: python -m unittest discover source/tests)
+#------------------------------------------------------------------------------
+
+import collections
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+PARSER_DIR = os.path.join(TESTS_DIR, '..', 'embargoed-countries-parser')
+LIB_DIR = os.path.join(TESTS_DIR, '..', 'lib')
+sys.path[:0] = [PARSER_DIR, LIB_DIR]
+
+import ip_shards
+
+def load_parser():
+    # both functions ship a module called lambda_function. One copy for
+    # every test module: fakes.install patches the modules in sys.modules.
+    if 'parser_lambda_function' in sys.modules:
+        return sys.modules['parser_lambda_function']
+    spec = importlib.util.spec_from_file_location('parser_lambda_function', os.path.join(PARSER_DIR, 'lambda_function.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+parser = load_parser()
+
+VALUES = ['10.%d.%d.0/24'%(i >> 8, i & 255) for i in range(4000)] + ['2001:db8:%x::/48'%i for i in range(1000)]
+
+class ShardIndexTest(unittest.TestCase):
+    def test_stable_across_processes(self):
+        # unlike hash(), the placement does not depend on the interpreter's hash seed
+        script = 'import json, sys, ip_shards; print(json.dumps([ip_shards.shard_index(v, 7) for v in json.load(sys.stdin)]))'
+        expected = [ip_shards.shard_index(v, 7) for v in VALUES]
+        for seed in ['1', '2']:
+            environment = dict(os.environ, PYTHONHASHSEED = seed, PYTHONPATH = LIB_DIR)
+            output = subprocess.run([sys.executable, '-c', script], input = json.dumps(VALUES).encode('utf-8'), stdout = subprocess.PIPE, env = environment, check = True).stdout
+            self.assertEqual(json.loads(output.decode('utf-8')), expected)
+
+    def test_balanced(self):
+        for shard_count in [2, 3, 5, 8]:
+            counts = collections.Counter(ip_shards.shard_index(v, shard_count) for v in VALUES)
+            self.assertEqual(sorted(counts), list(range(shard_count)))
+            for shard, count in counts.items():
+                self.assertLess(abs(count - len(VALUES) / shard_count), 0.15 * len(VALUES) / shard_count, 'shard %d of %d'%(shard, shard_count))
+
+    def test_minimal_movement(self):
+        for shard_count in range(1, 9):
+            before = [ip_shards.shard_index(v, shard_count) for v in VALUES]
+            after = [ip_shards.shard_index(v, shard_count + 1) for v in VALUES]
+            moved = [(b, a) for b, a in zip(before, after) if b != a]
+            # adding a shard only fills the new one; removing it only empties it
+            self.assertEqual(set(a for b, a in moved), set([shard_count]))
+            self.assertLess(abs(len(moved) - len(VALUES) / (shard_count + 1)), 0.15 * len(VALUES) / (shard_count + 1))
+
+    def test_single_shard(self):
+        self.assertEqual(set(ip_shards.shard_index(v, 1) for v in VALUES), set([0]))
+        self.assertEqual(ip_shards.shard_index(VALUES[0], 0), 0)
+
+class ComputeUpdatesTest(unittest.TestCase):
+    def waf_state(self, values, shard_count, ip_set_count):
+        ips = dict((v, ['IPV6' if ':' in v else 'IPV4', v, ip_shards.shard_index(v, shard_count)]) for v in values)
+        return {'countries': ['CU'], 'ips': ips, 'ip_set_ids': ['ip-set-%d'%i for i in range(ip_set_count)]}
+
+    def check_moves(self, old_shard_count, shard_count):
+        values = VALUES[:600]
+        json_embargoed_ips = dict((v, 'IPV6' if ':' in v else 'IPV4') for v in values)
+        waf_state = self.waf_state(values, old_shard_count, shard_count)
+        updates = parser.compute_updates(['CU'], json_embargoed_ips, waf_state)
+
+        moved = [v for v in values if ip_shards.shard_index(v, old_shard_count) != ip_shards.shard_index(v, shard_count)]
+        self.assertGreater(len(moved), 0)
+        deletes = dict((u['IPSetDescriptor']['Value'], shard) for shard in updates["ips"] for u in updates["ips"][shard] if u['Action'] == 'DELETE')
+        inserts = dict((u['IPSetDescriptor']['Value'], shard) for shard in updates["ips"] for u in updates["ips"][shard] if u['Action'] == 'INSERT')
+        self.assertEqual(sorted(deletes), sorted(moved))
+        self.assertEqual(sorted(inserts), sorted(moved))
+        for v in moved:
+            self.assertEqual(deletes[v], ip_shards.shard_index(v, old_shard_count))
+            self.assertEqual(inserts[v], ip_shards.shard_index(v, shard_count))
+        self.assertEqual(updates["countries"], [])
+
+        # once applied, nothing is left to move
+        ips = parser.applied_ips(json_embargoed_ips, waf_state)
+        self.assertEqual(parser.compute_updates(['CU'], json_embargoed_ips, dict(waf_state, ips = ips))["ips"], {})
+        return updates
+
+    def test_added_shard(self):
+        updates = self.check_moves(3, 4)
+        # the existing sets only lose descriptors, the new one only gains them
+        self.assertEqual(set(u['Action'] for shard in [0, 1, 2] for u in updates["ips"].get(shard, [])), set(['DELETE']))
+        self.assertEqual(set(u['Action'] for u in updates["ips"][3]), set(['INSERT']))
+
+    def test_removed_shard(self):
+        # the custom resource moved the descriptors of the removed set to
+        # shard_index(value, 3): the resync has nothing left to move
+        values = VALUES[:600]
+        ips = dict((v, ['IPV6' if ':' in v else 'IPV4', v, ip_shards.shard_index(v, 4) if ip_shards.shard_index(v, 4) < 3 else ip_shards.shard_index(v, 3)]) for v in values)
+        waf_state = {'countries': ['CU'], 'ips': ips, 'ip_set_ids': ['ip-set-%d'%i for i in range(3)]}
+        json_embargoed_ips = dict((v, ips[v][0]) for v in values)
+        self.assertEqual(parser.compute_updates(['CU'], json_embargoed_ips, waf_state)["ips"], {})
+
+    def test_changes_and_moves(self):
+        values = VALUES[:300]
+        waf_state = self.waf_state(values, 2, 3)
+        json_embargoed_ips = dict((v, 'IPV4') for v in VALUES[100:400])
+        updates = parser.compute_updates(['CU'], json_embargoed_ips, waf_state)
+
+        deletes = [u['IPSetDescriptor']['Value'] for shard in updates["ips"] for u in updates["ips"][shard] if u['Action'] == 'DELETE']
+        inserts = dict((u['IPSetDescriptor']['Value'], shard) for shard in updates["ips"] for u in updates["ips"][shard] if u['Action'] == 'INSERT')
+        kept = [v for v in VALUES[100:300] if ip_shards.shard_index(v, 2) == ip_shards.shard_index(v, 3)]
+        self.assertEqual(sorted(deletes), sorted(set(VALUES[:300]) - set(kept)))
+        self.assertEqual(sorted(inserts), sorted(set(VALUES[100:400]) - set(kept)))
+        for v, shard in inserts.items():
+            self.assertEqual(shard, ip_shards.shard_index(v, 3))
+
+    def test_duplicates(self):
+        # left behind by an interrupted move: deleted from the set they should not be in
+        waf_state = self.waf_state(VALUES[:10], 2, 2)
+        duplicate = VALUES[0]
+        other = 1 - ip_shards.shard_index(duplicate, 2)
+        waf_state['duplicates'] = [['IPV4', duplicate, other]]
+        updates = parser.compute_updates(['CU'], dict((v, 'IPV4') for v in VALUES[:10]), waf_state)
+        self.assertEqual(updates["ips"], {other: [parser.ip_update('DELETE', 'IPV4', duplicate)]})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.   #
+#                                                                            #
+#  Licensed under the Amazon Software License (the "License"). You may not   #
+#  use this file except in compliance with the License. A copy of the        #
+#  License is located at                                                     #
+#                                                                            #
+#      http://aws.amazon.com/asl/                                            #
+#                                                                            #
+#  or in the "license" file accompanying this file. This file is distributed #
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,        #
+#  express or implied. See the License for the specific language governing   #
+#  permissions and limitations under the License.                            #
+##############################################################################
+
+#------------------------------------------------------------------------------
+# Binary embargo snapshots (snapshot.py): encoding and decoding round trips,
+# rejection of damaged buffers and the merge diff against a sorted list.
+#
+# python -m pytest source/tests      (or: python -m unittest discover source/tests)
+#------------------------------------------------------------------------------
+
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(TESTS_DIR, '..', 'embargoed-countries-parser'), os.path.join(TESTS_DIR, '..', 'lib')]
+
+import cidr
+import snapshot
+
+def random_ips(rng, count):
+    values = []
+    for _ in range(count):
+        if rng.random() < 0.5:
+            values.append('%d.%d.%d.%d/%d'%(rng.randrange(256), rng.randrange(256), rng.randrange(256), rng.randrange(256), rng.choice(cidr.SUPPORTED_PREFIXES[cidr.IPV4])))
+        else:
+            values.append('%x:%x::%x:%x/%d'%(rng.randrange(1 << 16), rng.randrange(1 << 16), rng.randrange(1 << 16), rng.randrange(1 << 16), rng.choice(cidr.SUPPORTED_PREFIXES[cidr.IPV6])))
+    return cidr.aggregate(values)
+
+def decoded_ips(loaded):
+    return dict((cidr.format_network(ip_type, network, prefix), ip_type) for ip_type, network, prefix in loaded.entries())
+
+class RoundTripTest(unittest.TestCase):
+    def test_random_snapshots(self):
+        rng = random.Random(3)
+        codes = [a + b for a in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ' for b in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ']
+        for count in [0, 1, 2, 7, 8, 9, 100, 1000]:
+            ips = random_ips(rng, count)
+            countries = rng.sample(codes, rng.randrange(0, 40))
+            version = rng.choice([None, '', '2018-06-01', u'édition 日本'])
+
+            loaded = snapshot.load(snapshot.build(countries, ips, version))
+            self.assertEqual(loaded.countries(), sorted(countries))
+            self.assertEqual(decoded_ips(loaded), ips)
+            self.assertEqual(list(loaded.entries()), sorted(snapshot.network_key(v) for v in ips))
+            self.assertEqual(len(loaded), len(ips))
+            self.assertEqual(loaded.version, version or None)
+
+    def test_bounds(self):
+        ips = {'0.0.0.0/8': cidr.IPV4, '255.255.255.255/32': cidr.IPV4, '::/24': cidr.IPV6, 'ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff/128': cidr.IPV6, '8000::1/128': cidr.IPV6}
+        loaded = snapshot.load(snapshot.build(['AA', 'ZZ', 'AZ', 'ZA'], ips))
+        self.assertEqual(loaded.countries(), ['AA', 'AZ', 'ZA', 'ZZ'])
+        self.assertEqual(decoded_ips(loaded), ips)
+
+    def test_digest(self):
+        ips = {'192.0.2.0/24': cidr.IPV4}
+        digest = snapshot.load(snapshot.build(['CU'], ips, '1')).digest
+        # the version names the content, it is not part of it
+        self.assertEqual(snapshot.load(snapshot.build(['CU'], ips, '2')).digest, digest)
+        self.assertNotEqual(snapshot.load(snapshot.build(['CU', 'IR'], ips, '1')).digest, digest)
+        self.assertNotEqual(snapshot.load(snapshot.build(['CU'], {'192.0.3.0/24': cidr.IPV4}, '1')).digest, digest)
+
+    def test_sections_are_aligned(self):
+        data = snapshot.build(['CU'], {'192.0.2.0/24': cidr.IPV4, '10.0.0.0/8': cidr.IPV4, '2001:db8::/32': cidr.IPV6})
+        self.assertEqual(len(data) % 8, 0)
+
+    def test_invalid_country_codes(self):
+        for code in ['cu', 'C', 'CUB', '1A', '']:
+            with self.assertRaises(ValueError, msg = code):
+                snapshot.build([code], {})
+
+class DamagedSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.data = bytearray(snapshot.build(['CU', 'IR'], {'192.0.2.0/24': cidr.IPV4, '2001:db8::/32': cidr.IPV6}, '2018-06-01'))
+
+    def test_every_flipped_byte(self):
+        for index in range(len(self.data)):
+            if 6 <= index < 8:
+                # reserved
+                continue
+            data = bytearray(self.data)
+            data[index] ^= 0x01
+            with self.assertRaises(ValueError, msg = 'byte %d'%index):
+                snapshot.load(bytes(data))
+
+    def test_truncated(self):
+        for end in range(len(self.data)):
+            with self.assertRaises(ValueError, msg = 'cut at %d'%end):
+                snapshot.load(bytes(self.data[:end]))
+
+    def test_format_version(self):
+        self.data[4] = snapshot.FORMAT_VERSION + 1
+        with self.assertRaises(ValueError):
+            snapshot.load(bytes(self.data))
+
+class ConvertTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_convert(self):
+        json_path = os.path.join(self.directory, 'embargoed-countries.json')
+        snapshot_path = os.path.join(self.directory, 'embargoed-countries' + snapshot.SUFFIX)
+        with open(json_path, 'w') as f:
+            json.dump({
+                'version': '2018-06-01',
+                'embargoed-countries': [{'name': 'Cuba', 'code': 'CU'}, {'name': 'Iran', 'code': 'IR'}],
+                'embargoed-ips': [{'name': 'ranges', 'ips': [
+                    {'Type': 'IPV4', 'Value': '192.0.2.0/25'},
+                    {'Type': 'IPV4', 'Value': '192.0.2.128/25'},
+                    {'Type': 'IPV6', 'Value': '2001:db8::1/64'}
+                ]}]
+            }, f)
+
+        size = snapshot.convert(json_path, snapshot_path)
+        self.assertEqual(size, os.path.getsize(snapshot_path))
+        loaded = snapshot.open_file(snapshot_path)
+        self.assertEqual(loaded.countries(), ['CU', 'IR'])
+        self.assertEqual(decoded_ips(loaded), {'192.0.2.0/24': cidr.IPV4, '2001:db8::/64': cidr.IPV6})
+        self.assertEqual(loaded.version, '2018-06-01')
+
+class MergeTest(unittest.TestCase):
+    def test_random_lists(self):
+        rng = random.Random(4)
+        for _ in range(200):
+            current = sorted(rng.sample(range(100), rng.randrange(0, 30)))
+            entries = sorted(rng.sample(range(100), rng.randrange(0, 30)))
+            result = list(snapshot.merge([(key, 'item-%d'%key) for key in current], entries))
+
+            expected = []
+            for key in sorted(set(current) | set(entries)):
+                expected.append(('item-%d'%key if key in current else None, key if key in entries else None))
+            self.assertEqual(result, expected)
+
+    def test_unsorted_entries(self):
+        for entries in [[1, 3, 2], [1, 1]]:
+            with self.assertRaises(ValueError, msg = str(entries)):
+                list(snapshot.merge([], entries))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.   #
+#                                                                            #
+#  Licensed under the Amazon Software License (the "License"). You may not   #
+#  use this file except in compliance with the License. A copy of the        #
+#  License is located at                                                     #
+#                                                                            #
+#      http://aws.amazon.com/asl/                                            #
+#                                                                            #
+#  or in the "license" file accompanying this file. This file is distributed #
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,        #
+#  express or implied. See the License for the specific language governing   #
+#  permissions and limitations under the License.                            #
+##############################################################################
+
+#------------------------------------------------------------------------------
+# Several sync targets in one deployment: the TARGETS configuration
+# (load_targets), the bounded fan-out over the targets and the per-target
+# reports of a full sync, against the WAF Classic / S3 fakes of the
+# benchmarks. A failing target must not keep the others from syncing.
+#
+# python -m pytest source/tests      (or: python -m unittest discover source/tests)
+#------------------------------------------------------------------------------
+
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+PARSER_DIR = os.path.join(TESTS_DIR, '..', 'embargoed-countries-parser')
+sys.path[:0] = [PARSER_DIR, os.path.join(TESTS_DIR, '..', 'lib'), os.path.join(TESTS_DIR, '..', 'benchmark')]
+
+import fakes
+
+BUCKET = 'embargoed-countries-bucket'
+OBJECT_KEY = 'embargoed-countries.json'
+
+def load_parser():
+    # both functions ship a module called lambda_function. One copy for
+    # every test module: fakes.install patches the modules in sys.modules.
+    if 'parser_lambda_function' in sys.modules:
+        return sys.modules['parser_lambda_function']
+    spec = importlib.util.spec_from_file_location('parser_lambda_function', os.path.join(PARSER_DIR, 'lambda_function.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+parser = load_parser()
+
+def target(name, **settings):
+    return dict({'api_type': 'waf', 'region': None, 'geo_match_set_id': 'geo-%s'%name, 'ip_set_id': 'ip-%s'%name, 'ip_set_ids': ['ip-%s'%name]}, **settings)
+
+class LoadTargetsTest(unittest.TestCase):
+    def load(self, environ):
+        with mock.patch.dict(os.environ, dict({'API_TYPE': 'waf-regional'}, **environ), clear = True):
+            return parser.load_targets()
+
+    def test_deployed_sets(self):
+        self.assertEqual(self.load({'GEO_MATCH_SET_ID': 'geo', 'IP_SET_ID': 'ip'}), [
+            {'api_type': 'waf-regional', 'region': None, 'geo_match_set_id': 'geo', 'ip_set_id': 'ip', 'ip_set_ids': ['ip']}
+        ])
+        targets = self.load({'GEO_MATCH_SET_ID': 'geo', 'IP_SET_ID': 'ip', 'IP_SET_IDS': 'ip,ip-1,ip-2'})
+        self.assertEqual(targets[0]['ip_set_ids'], ['ip', 'ip-1', 'ip-2'])
+        self.assertEqual(targets[0]['ip_set_id'], 'ip')
+
+    def test_targets(self):
+        targets = self.load({'GEO_MATCH_SET_ID': 'geo', 'IP_SET_ID': 'ip', 'TARGETS': json.dumps([
+            {'geo_match_set_id': 'geo-a', 'ip_set_id': 'ip-a'},
+            {'api_type': 'waf', 'region': 'us-east-1', 'geo_match_set_id': 'geo-b', 'ip_set_ids': ['ip-b', 'ip-b-1']}
+        ])})
+        # TARGETS replaces the deployed sets; the first IP set identifies a target
+        self.assertEqual(targets, [
+            {'api_type': 'waf-regional', 'region': None, 'geo_match_set_id': 'geo-a', 'ip_set_id': 'ip-a', 'ip_set_ids': ['ip-a']},
+            {'api_type': 'waf', 'region': 'us-east-1', 'geo_match_set_id': 'geo-b', 'ip_set_id': 'ip-b', 'ip_set_ids': ['ip-b', 'ip-b-1']}
+        ])
+        self.assertEqual(parser.target_name(targets[1]), 'waf:us-east-1:geo-b/ip-b')
+
+class FanOutTest(unittest.TestCase):
+    def setUp(self):
+        environ = mock.patch.dict(os.environ, {'LOG_LEVEL': 'ERROR'})
+        environ.start()
+        self.addCleanup(environ.stop)
+
+    def test_results_in_target_order(self):
+        targets = [target(str(i)) for i in range(6)]
+        def sync(t, suffix):
+            # the first targets finish last
+            time.sleep(0.01 * (6 - int(t['ip_set_id'][3:])))
+            if t['ip_set_id'] == 'ip-2':
+                raise Exception('%s failed'%t['ip_set_id'])
+            return t['ip_set_id'] + suffix
+
+        results = parser.fan_out(sync, targets, '-synced')
+        self.assertEqual([t for t, result, error in results], targets)
+        self.assertEqual([result for t, result, error in results], ['ip-0-synced', 'ip-1-synced', None, 'ip-3-synced', 'ip-4-synced', 'ip-5-synced'])
+        self.assertEqual([str(error) if error else None for t, result, error in results], [None, None, 'ip-2 failed', None, None, None])
+
+    def test_bounded_concurrency(self):
+        lock = threading.Lock()
+        running = [0, 0]
+        def sync(t):
+            with lock:
+                running[0] += 1
+                running[1] = max(running[1], running[0])
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+
+        with mock.patch.dict(os.environ, {'MAX_CONCURRENCY': '3'}):
+            parser.fan_out(sync, [target(str(i)) for i in range(10)])
+        self.assertEqual(running[1], 3)
+
+    def test_no_targets(self):
+        self.assertEqual(parser.fan_out(lambda t: t, []), [])
+
+class SyncFullStateTest(unittest.TestCase):
+    def setUp(self):
+        self.waf = fakes.FakeWAF()
+        self.s3 = fakes.FakeS3()
+        # target b has no geo match set (e.g. deleted by hand)
+        self.targets = [target('a'), target('b'), target('c', ip_set_ids = ['ip-c', 'ip-c-1'])]
+        for t in self.targets:
+            for ip_set_id in t['ip_set_ids']:
+                self.waf.add_ip_set(ip_set_id)
+            if t['geo_match_set_id'] != 'geo-b':
+                self.waf.add_geo_match_set(t['geo_match_set_id'])
+
+        environ = mock.patch.dict(os.environ, {'LOG_LEVEL': 'ERROR', 'API_TYPE': 'waf', 'STATE_BUCKET': BUCKET, 'TARGETS': json.dumps(self.targets)})
+        environ.start()
+        self.addCleanup(environ.stop)
+        self.addCleanup(fakes.install(self.waf, self.s3))
+
+        self.s3.objects[(BUCKET, OBJECT_KEY)] = json.dumps({
+            'embargoed-countries': [{'name': 'Cuba', 'code': 'CU'}, {'name': 'Iran', 'code': 'IR'}],
+            'embargoed-ips': [{'name': 'ranges', 'ips': [{'Type': 'IPV4', 'Value': '192.0.2.%d/32'%(2 * i)} for i in range(40)]}]
+        }).encode('utf-8')
+
+    def sync(self):
+        result = json.loads(parser.lambda_handler({'Records': [{'s3': {'bucket': {'name': BUCKET}, 'object': {'key': OBJECT_KEY}}}]}, None))
+        return result['statusCode'], result['body']
+
+    def test_one_target_failing(self):
+        status, body = self.sync()
+        self.assertEqual(status, '500')
+        self.assertEqual(body['message'], '1 of 3 targets failed')
+
+        report = body['updates']['jobs'][0]
+        self.assertEqual(report['failed'], 1)
+        self.assertEqual([r['target'] for r in report['targets']], ['waf:default:geo-a/ip-a', 'waf:default:geo-b/ip-b', 'waf:default:geo-c/ip-c'])
+        self.assertEqual([r['status'] for r in report['targets']], ['success', 'failed', 'success'])
+        self.assertIn('WAFNonexistentItemException', report['targets'][1]['error'])
+
+        # the others are synced, spread over their IP sets
+        for t in [self.targets[0], self.targets[2]]:
+            self.assertEqual(sorted(self.waf.geo_match_sets[t['geo_match_set_id']]), ['CU', 'IR'])
+            self.assertEqual(sum(len(self.waf.ip_sets[i]) for i in t['ip_set_ids']), 40)
+        self.assertEqual(self.waf.ip_sets['ip-b'], {})
+
+    def test_failed_target_synced_again(self):
+        self.sync()
+        self.waf.add_geo_match_set('geo-b')
+        status, body = self.sync()
+        self.assertEqual(status, '200')
+        # only the target that failed needed the file again
+        self.assertEqual([r['status'] for r in body['updates']['jobs'][0]['targets']], ['skipped', 'success', 'skipped'])
+        self.assertEqual(len(self.waf.ip_sets['ip-b']), 40)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+##############################################################################
+#  Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.   #
+#                                                                            #
+#  Licensed under the Amazon Software License (the "License"). You may not   #
+#  use this file except in compliance with the License. A copy of the        #
+#  License is located at                                                     #
+#                                                                            #
+#      http://aws.amazon.com/asl/                                            #
+#                                                                            #
+#  or in the "license" file accompanying this file. This file is distributed #
+#  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,        #
+#  express or implied. See the License for the specific language governing   #
+#  permissions and limitations under the License.                            #
+##############################################################################
+
+#------------------------------------------------------------------------------
+# Chunked WAF updates and the change token pipeline (waf_batch.py) against the
+# WAF Classic fake of the benchmarks, which rejects reused change tokens and
+# requests of more than 1000 updates like the service does.
+#
+# python -m pytest source/tests      (or: python -m unittest discover source/tests)
+#------------------------------------------------------------------------------
+
+import os
+import sys
+import threading
+import unittest
+from unittest import mock
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(TESTS_DIR, '..', 'lib'), os.path.join(TESTS_DIR, '..', 'benchmark')]
+
+import waf_batch
+from fakes import FakeClientError, FakeWAF
+
+def inserts(count, offset=0):
+    return [{'Action': 'INSERT', 'IPSetDescriptor': {'Type': 'IPV4', 'Value': '10.%d.%d.%d/32'%((i >> 16) & 255, (i >> 8) & 255, i & 255)}} for i in range(offset, offset + count)]
+
+class RacingWAF(FakeWAF):
+    # Holds every update until its change token was handed out a second
+    # time, i.e. until the pipeline prefetched the next token while the
+    # current one was still unconsumed.
+    def __init__(self, **kwargs):
+        FakeWAF.__init__(self, **kwargs)
+        self.handed_out = {}
+        self.condition = threading.Condition()
+
+    def get_change_token(self):
+        response = FakeWAF.get_change_token(self)
+        with self.condition:
+            self.handed_out[response['ChangeToken']] = self.handed_out.get(response['ChangeToken'], 0) + 1
+            self.condition.notify_all()
+        return response
+
+    def update_ip_set(self, IPSetId, ChangeToken, Updates):
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.handed_out.get(ChangeToken, 0) >= 2, timeout = 5):
+                raise AssertionError('%s was not prefetched'%ChangeToken)
+        return FakeWAF.update_ip_set(self, IPSetId, ChangeToken, Updates)
+
+class ChunkUpdatesTest(unittest.TestCase):
+    def test_chunk_sizes(self):
+        self.assertEqual([len(c) for c in waf_batch.chunk_updates(inserts(2500))], [1000, 1000, 500])
+        self.assertEqual([len(c) for c in waf_batch.chunk_updates(inserts(1000))], [1000])
+        self.assertEqual([len(c) for c in waf_batch.chunk_updates(inserts(1001))], [1000, 1])
+        self.assertEqual(waf_batch.chunk_updates([]), [])
+
+    def test_chunks_keep_order(self):
+        updates = inserts(2345)
+        self.assertEqual(sum(waf_batch.chunk_updates(updates, 100), []), updates)
+
+class ApplyUpdatesTest(unittest.TestCase):
+    def test_chunked_at_1000(self):
+        waf = FakeWAF()
+        ip_set_id = waf.add_ip_set()
+        report = waf_batch.apply_updates(waf, waf.update_ip_set, inserts(2500), IPSetId = ip_set_id)
+
+        self.assertEqual(report, {'updates': 2500, 'chunks': 3, 'applied': 3, 'retries': 0, 'change_token': 'token-2'})
+        self.assertEqual(waf.calls['UpdateIPSet'], 3)
+        self.assertEqual(len(waf.ip_sets[ip_set_id]), 2500)
+
+    def test_no_updates(self):
+        waf = FakeWAF()
+        report = waf_batch.apply_updates(waf, waf.update_ip_set, [], IPSetId = waf.add_ip_set())
+        self.assertEqual(report, {'updates': 0, 'chunks': 0, 'applied': 0, 'retries': 0, 'change_token': None})
+        self.assertEqual(waf.api_calls(), 0)
+
+    def test_stale_chunk_gets_a_new_token(self):
+        waf = FakeWAF()
+        ip_set_id, other_ip_set_id = waf.add_ip_set(), waf.add_ip_set()
+        tokens = []
+
+        def update_ip_set(ChangeToken, **params):
+            # another writer consumes the token of the first attempt
+            tokens.append(ChangeToken)
+            if len(tokens) == 1:
+                waf.update_ip_set(IPSetId = other_ip_set_id, ChangeToken = ChangeToken, Updates = inserts(1))
+            return waf.update_ip_set(ChangeToken = ChangeToken, **params)
+
+        with mock.patch.object(waf_batch, 'backoff_delay', return_value = 0):
+            report = waf_batch.apply_updates(waf, update_ip_set, inserts(1500), IPSetId = ip_set_id)
+
+        self.assertEqual(report['retries'], 1)
+        self.assertEqual(report['applied'], 2)
+        self.assertEqual(tokens, ['token-0', 'token-1', 'token-2'])
+        self.assertEqual(len(waf.ip_sets[ip_set_id]), 1500)
+
+    def test_throttling_left_to_the_client(self):
+        # botocore already retried it (adaptive mode): not retried again
+        waf = FakeWAF()
+        calls = []
+        def update_ip_set(ChangeToken, **params):
+            calls.append(ChangeToken)
+            raise FakeClientError('ThrottlingException', 'UpdateIPSet', 'Rate exceeded')
+
+        with self.assertRaises(FakeClientError):
+            waf_batch.apply_updates(waf, update_ip_set, inserts(10), IPSetId = waf.add_ip_set())
+        with self.assertRaises(FakeClientError):
+            waf_batch.call_with_change_token(waf, update_ip_set, IPSetId = 'ip-set')
+        self.assertEqual(len(calls), 2)
+
+    def test_non_retryable_error(self):
+        waf = FakeWAF()
+        with self.assertRaises(FakeClientError):
+            waf_batch.apply_updates(waf, waf.update_ip_set, inserts(10), IPSetId = 'missing')
+        self.assertEqual(waf.calls['UpdateIPSet'], 1)
+
+    def test_concurrent_sets_share_the_pipeline(self):
+        waf = FakeWAF(latency = 0.002)
+        ip_set_ids = [waf.add_ip_set() for _ in range(4)]
+        reports = {}
+
+        def apply(index):
+            reports[index] = waf_batch.apply_updates(waf, waf.update_ip_set, inserts(2200, index * 10000), IPSetId = ip_set_ids[index])
+
+        threads = [threading.Thread(target = apply, args = (i,)) for i in range(len(ip_set_ids))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # a reused token would have been rejected as stale and retried
+        self.assertEqual([reports[i]['retries'] for i in range(4)], [0] * 4)
+        self.assertEqual(waf.calls['UpdateIPSet'], 12)
+        self.assertEqual([len(waf.ip_sets[i]) for i in ip_set_ids], [2200] * 4)
+
+class ChangeTokenPipelineTest(unittest.TestCase):
+    def test_prefetched_unconsumed_token_is_fetched_again(self):
+        waf = RacingWAF()
+        ip_set_id = waf.add_ip_set()
+        pipeline = waf_batch.ChangeTokenPipeline(waf)
+
+        tokens = [pipeline.write(waf.update_ip_set, prefetch = True, IPSetId = ip_set_id, Updates = inserts(10, i * 10))[1] for i in range(3)]
+
+        # every prefetch returned the token of the write in flight
+        self.assertEqual(tokens, ['token-0', 'token-1', 'token-2'])
+        self.assertEqual(waf.handed_out, {'token-0': 2, 'token-1': 2, 'token-2': 2})
+        self.assertEqual(len(waf.ip_sets[ip_set_id]), 30)
+
+    def test_failed_write_token_is_reused(self):
+        waf = FakeWAF()
+        ip_set_id = waf.add_ip_set()
+        pipeline = waf_batch.ChangeTokenPipeline(waf)
+
+        with self.assertRaises(FakeClientError):
+            pipeline.write(waf.update_ip_set, IPSetId = 'missing', Updates = inserts(1))
+        token = pipeline.write(waf.update_ip_set, IPSetId = ip_set_id, Updates = inserts(1))[1]
+        self.assertEqual(token, 'token-0')
+
+    def test_one_pipeline_per_client(self):
+        first, second = FakeWAF(), FakeWAF()
+        self.assertIs(waf_batch.change_token_pipeline(first), waf_batch.change_token_pipeline(first))
+        self.assertIsNot(waf_batch.change_token_pipeline(first), waf_batch.change_token_pipeline(second))
+
+if __name__ == '__main__':
+    unittest.main()